@@ -0,0 +1,93 @@
+"""
+Module containing the detection of binary files
+"""
+
+import codecs
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Only the start of the file is checked, so big binaries cost a single read
+SNIFF_SIZE = 8 * 1024
+# Text in the wrong encoding has a few bytes that can't be decoded, binary data has a lot of them
+MAX_DECODE_ERROR_RATE = 0.1
+
+
+def peek_file(file, size=SNIFF_SIZE):
+    """
+    Returns up to `size` bytes from the start of the file without consuming them, or None if the file can't be peeked
+    (e.g. it isn't backed by a buffered binary file). At most one read is made.
+    """
+
+    peek = getattr(getattr(file, 'buffer', None), 'peek', None)
+    if peek is None:
+        return None
+    data = peek(size)
+    if not isinstance(data, bytes):
+        return None
+    return data[:size]
+
+
+def count_decode_errors(data, encoding='utf-8', limit=None, final=False):
+    """
+    Returns the number of parts of `data` that can't be decoded with `encoding` (it stops counting at `limit`). A
+    character cut at the end of `data` is only an error if `final` is set (`data` is the whole file).
+    """
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+    errors = 0
+    while data and errors != limit:
+        try:
+            decoder.decode(data, final=final)
+            break
+        except UnicodeDecodeError as e:
+            errors += 1
+            data = e.object[e.end:]
+            decoder.reset()
+    return errors
+
+
+def is_ascii_compatible(encoding):
+    return len('a'.encode(encoding)) == 1
+
+
+def is_binary(data, encoding='utf-8'):
+    """
+    Returns True if `data` (the start of a file) looks binary: it has NUL bytes (which text in ASCII compatible
+    encodings never has) or too much of it can't be decoded.
+    """
+
+    if not data:
+        return False
+    if b'\0' in data and is_ascii_compatible(encoding):
+        return True
+    max_errors = int(len(data) * MAX_DECODE_ERROR_RATE)
+    return count_decode_errors(data, encoding, limit=max_errors + 1) > max_errors
+
+
+def check_binary_file(file, binary_files='skip'):
+    """
+    Checks the start of `file` before it's read. Returns False if it's binary and `binary_files` is 'skip'. Otherwise,
+    if `binary_files` is 'text', it looks binary or some of it couldn't be decoded, the parts of the file that can't be
+    decoded are replaced with U+FFFD so reading it doesn't fail.
+    """
+
+    data = peek_file(file)
+    encoding = getattr(file, 'encoding', None)
+    if data is None or not isinstance(encoding, str):
+        return True
+
+    binary = is_binary(data, encoding)
+    if binary and binary_files == 'skip':
+        logger.debug('Skipping binary file %s', getattr(file, 'name', None))
+        return False
+
+    # With 'text', the errors past the checked start of the file are replaced too. Getting less than asked means `data`
+    # is the whole file, so a character cut at its end is an error.
+    replace = binary_files == 'text' or binary or count_decode_errors(
+        data, encoding, limit=1, final=len(data) < SNIFF_SIZE,
+    )
+    if replace and hasattr(file, 'reconfigure'):
+        file.reconfigure(errors='replace')
+    return True
@@ -1,37 +1,112 @@
+import codecs
+import io
 import logging
+import re
 from abc import ABC, abstractmethod
 from collections import deque
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Maximum number of lines of each part of a context when the contexts are streamed (see `iter_parts`)
+DEFAULT_PART_SIZE = 1024
+
+# Returned by `read_until` instead of a line when it stops early because of `max_lines`
+MORE_LINES = object()
+
+NON_ASCII_REGEXP = re.compile('[^\x00-\x7f]')
+
 
 class Context:
     """
     Class that encapsulates a context. A context is a collection of lines that exist within a set of delimiters.
+
+    When the context factory tracks positions, `line_number` (starting at 1) and `byte_offset` are the position of the
+    context's first line in the file and `byte_offsets` has the byte offset of each line. The lines are consecutive
+    unless `line_numbers` (the number of each line) says otherwise, e.g. after a line filter.
     """
 
-    def __init__(self, lines):
+    def __init__(self, lines, line_number=None, byte_offset=None, line_numbers=None, byte_offsets=None):
         self._lines = lines
+        self.line_number = line_number
+        self.byte_offset = byte_offset
+        self._line_numbers = line_numbers
+        self.byte_offsets = byte_offsets
 
     @property
     def lines(self):
         return self._lines
 
+    @property
+    def line_numbers(self):
+        """
+        Returns the number of each line or None if the positions aren't tracked.
+        """
+        if self._line_numbers is not None:
+            return self._line_numbers
+        if self.line_number is None:
+            return None
+        return range(self.line_number, self.line_number + len(self._lines))
+
     def __repr__(self):
-        return f'{self.__class__.__name__}(lines={self.lines})'
+        if self.line_number is None:
+            return f'{self.__class__.__name__}(lines={self.lines})'
+        return (f'{self.__class__.__name__}(lines={self.lines}, line_number={self.line_number}, '
+                f'byte_offset={self.byte_offset})')
 
     def __str__(self):
         return '\n'.join(self.lines)
 
 
+def get_chunk_reader(file, chunk_size):
+    """
+    Returns a function that returns the next chunk of text of the file ('' at EOF).
+
+    For regular text files, the bytes are read with `read1` (which returns as soon as some data is available instead of
+    waiting for the whole chunk, so pipes keep streaming) and decoded the same way `TextIOWrapper` does it.
+    """
+
+    read1 = getattr(getattr(file, 'buffer', None), 'read1', None)
+    encoding = getattr(file, 'encoding', None)
+    if read1 is None or not isinstance(encoding, str):
+        return lambda: file.read(chunk_size)
+
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder(encoding)(errors=file.errors or 'strict'), translate=True,
+    )
+
+    def read_chunk():
+        while True:
+            data = read1(chunk_size)
+            text = decoder.decode(data, final=not data)
+            # The decoder might hold on to incomplete characters (or a \r) so we keep reading until we get some text
+            if text or not data:
+                return text
+
+    # The kinds of new lines that were translated are in `decoder.newlines`
+    read_chunk.decoder = decoder
+    return read_chunk
+
+
 class FileIterator:
     """
     Iterator to read a file that provides the ability to unread lines.
+
+    The file is read in large chunks that are split into lines in bulk, which is a lot cheaper than calling readline
+    for every line. The chunks also allow searching for a literal over many lines at once (see `read_until`).
     """
 
-    def __init__(self, file):
+    def __init__(self, file, chunk_size=DEFAULT_CHUNK_SIZE):
         self.file = file
         self.queue = deque()
+        self.read_chunk = get_chunk_reader(file, chunk_size)
+
+        # Lines that were already split from the buffer and haven't been returned yet.
+        self.lines = iter(())
+        # Text that hasn't been split into lines. Everything before `position` was already returned.
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
 
     def __iter__(self):
         return self
@@ -39,27 +114,297 @@ class FileIterator:
     def __next__(self):
         if len(self.queue):
             return self.queue.popleft()
-        line = self.file.readline()
-        if line == '':
+        for line in self.lines:
+            return line
+        if not self.split_buffer():
             raise StopIteration
-        return line.rstrip('\n')
+        return next(self.lines)
 
     def unread(self, line):
         self.queue.append(line)
 
+    def skip_line(self, line):
+        """
+        Called with each line (already split) that `read_until` skips without keeping it.
+        """
+
+    def skip_text(self, start, end):
+        """
+        Called with the part of the buffer that `read_until` skips without keeping its lines (from `start` to `end`).
+        """
+
+    def fill_buffer(self):
+        """
+        Reads the next chunks into the buffer, dropping the text that was already consumed. Returns False at EOF.
+
+        It keeps reading until a chunk has a new line (or the file ends), so a long line is joined once instead of
+        being copied again with every chunk.
+        """
+        chunks = [self.buffer[self.position:]]
+        while True:
+            chunk = self.read_chunk()
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            if '\n' in chunk:
+                break
+        if len(chunks) == 1:
+            return False
+        self.buffer = ''.join(chunks)
+        self.position = 0
+        return True
+
+    def split_buffer(self):
+        """
+        Splits all of the complete lines in the buffer. Returns False if there are no more lines.
+        """
+        while True:
+            end = self.buffer.rfind('\n', self.position)
+            if end != -1:
+                self.lines = iter(self.buffer[self.position:end].split('\n'))
+                self.position = end + 1
+                return True
+
+            if self.eof or not self.fill_buffer():
+                if self.position < len(self.buffer):
+                    # The last line doesn't end with a new line
+                    self.lines = iter([self.buffer[self.position:]])
+                    self.buffer = ''
+                    self.position = 0
+                    return True
+                return False
+
+    def read_until(self, text, matches=None, keep_lines=True, max_lines=None):
+        """
+        Reads lines until it finds a line that contains `text` (and for which `matches(line)` is True, if `matches` is
+        set). Returns a tuple with the list of lines before that line (empty if `keep_lines` is False) and the line
+        itself (None if the end of the file is reached first).
+
+        Instead of checking every line, the buffer is searched with `str.find` and each hit is mapped back to its
+        line. Only the lines with a hit are passed to `matches`. `text` must not contain new lines.
+
+        With `max_lines`, once a chunk is consumed and there are at least that many lines, it returns them with
+        MORE_LINES instead of the line. Calling it again continues from there.
+        """
+        lines = []
+
+        # Lines that were unread or already split are checked one by one.
+        while len(self.queue):
+            line = self.queue.popleft()
+            if text in line and (matches is None or matches(line)):
+                return lines, line
+            if keep_lines:
+                lines.append(line)
+            else:
+                self.skip_line(line)
+        for line in self.lines:
+            if text in line and (matches is None or matches(line)):
+                return lines, line
+            if keep_lines:
+                lines.append(line)
+            else:
+                self.skip_line(line)
+
+        search_from = self.position
+        while True:
+            buffer = self.buffer
+            hit = buffer.find(text, search_from)
+            if hit != -1:
+                line_start = buffer.rfind('\n', self.position, hit) + 1 or self.position
+                line_end = buffer.find('\n', hit + len(text))
+                if line_end == -1 and not self.eof:
+                    # The line continues in the next chunk
+                    search_from = line_start - self.position
+                    if not self.fill_buffer():
+                        search_from = line_start
+                    continue
+                if line_end == -1:
+                    line_end = len(buffer)
+
+                line = buffer[line_start:line_end]
+                if matches is not None and not matches(line):
+                    # Not a match. The line stays in the buffer and is consumed with the lines around it.
+                    search_from = line_end + 1
+                    continue
+
+                if line_start > self.position:
+                    if keep_lines:
+                        lines.extend(buffer[self.position:line_start - 1].split('\n'))
+                    else:
+                        self.skip_text(self.position, line_start)
+                self.position = line_end + 1
+                return lines, line
+
+            if self.eof:
+                if self.position < len(buffer):
+                    if keep_lines:
+                        lines.extend(buffer[self.position:].split('\n'))
+                    else:
+                        self.skip_text(self.position, len(buffer))
+                self.buffer = ''
+                self.position = 0
+                return lines, None
+
+            # Consume all of the complete lines. `text` may start in the last (incomplete) line.
+            last_line_start = buffer.rfind('\n', self.position) + 1
+            if last_line_start:
+                if keep_lines:
+                    lines.extend(buffer[self.position:last_line_start - 1].split('\n'))
+                else:
+                    self.skip_text(self.position, last_line_start)
+                self.position = last_line_start
+                if max_lines is not None and len(lines) >= max_lines:
+                    return lines, MORE_LINES
+            search_from = max(self.position, len(buffer) - len(text) + 1)
+
+            position = self.position
+            if self.fill_buffer():
+                search_from -= position
+            else:
+                search_from = self.position
+
+
+class PositionTrackingFileIterator(FileIterator):
+    """
+    FileIterator that also keeps the line number and the byte offset of the next line (see `tell`). Nothing else is
+    read from the file. The byte offsets come from the size of the lines encoded back with the file's encoding, which
+    is exact for ASCII compatible encodings. If the file has \r\n new lines (they're translated to \n when reading), each
+    new line counts as 2 bytes. Files that mix both kinds of new lines get approximate offsets.
+    """
+
+    def __init__(self, file, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(file, chunk_size=chunk_size)
+        self.encoding = getattr(file, 'encoding', None)
+        if not isinstance(self.encoding, str):
+            self.encoding = 'utf-8'
+        self.errors = getattr(file, 'errors', None)
+        if not isinstance(self.errors, str):
+            self.errors = 'strict'
+        self.ascii_compatible = len('a'.encode(self.encoding)) == 1
+        self.newline_size = 1
+        self.line_number = 0
+        self.byte_offset = 0
+
+    def tell(self):
+        """
+        Returns the line number (starting at 1) and the byte offset of the next line.
+        """
+        return self.line_number + 1, self.byte_offset
+
+    def get_size(self, line):
+        """
+        Returns the number of bytes of the line (without the new line) in the file.
+        """
+        if self.ascii_compatible and NON_ASCII_REGEXP.search(line) is None:
+            return len(line)
+        return len(line.encode(self.encoding, self.errors))
+
+    def get_lines_size(self, lines):
+        """
+        Returns the number of bytes of the lines, including their new lines.
+        """
+        return sum(map(self.get_size, lines)) + self.newline_size * len(lines)
+
+    def get_offsets(self, lines, end):
+        """
+        Returns the byte offset of each of the lines, given that they end at the `end` offset.
+        """
+        offsets = []
+        offset = end
+        newline_size = self.newline_size
+        for line in reversed(lines):
+            offset -= self.get_size(line) + newline_size
+            offsets.append(offset)
+        offsets.reverse()
+        return offsets
+
+    def fill_buffer(self):
+        filled = super().fill_buffer()
+        decoder = getattr(self.read_chunk, 'decoder', None)
+        # Files read with `read` (like the ones of `tee_file`) have the new lines of their own decoder
+        newlines = getattr(decoder if decoder is not None else self.file, 'newlines', None)
+        if newlines == '\r\n':
+            self.newline_size = 2
+        elif isinstance(newlines, tuple) and self.newline_size == 1:
+            logger.debug('%s mixes new lines, the byte offsets are approximate', getattr(self.file, 'name', None))
+        return filled
+
+    def __next__(self):
+        line = super().__next__()
+        self.line_number += 1
+        self.byte_offset += self.get_size(line) + self.newline_size
+        return line
+
+    def unread(self, line):
+        super().unread(line)
+        self.line_number -= 1
+        self.byte_offset -= self.get_size(line) + self.newline_size
+
+    def skip_line(self, line):
+        self.line_number += 1
+        self.byte_offset += self.get_size(line) + self.newline_size
+
+    def skip_text(self, start, end):
+        # The skipped lines are counted in the buffer, without splitting them. Encoding the whole text at once is about
+        # as fast as checking if it's ASCII.
+        text = self.buffer[start:end]
+        newlines = text.count('\n')
+        size = len(text.encode(self.encoding, self.errors))
+        self.line_number += newlines
+        self.byte_offset += size + (self.newline_size - 1) * newlines
+
+    def read_until(self, text, matches=None, keep_lines=True, max_lines=None):
+        lines, line = super().read_until(text, matches=matches, keep_lines=keep_lines, max_lines=max_lines)
+        self.line_number += len(lines)
+        self.byte_offset += self.get_lines_size(lines)
+        if line is not None and line is not MORE_LINES:
+            self.line_number += 1
+            self.byte_offset += self.get_size(line) + self.newline_size
+        return lines, line
+
 
 class ContextFactoryBase(ABC):
     """
-    Abstract ContextFactoryBase class.
+    Abstract ContextFactoryBase class. When `track_positions` is set, the contexts have the line number and the byte
+    offset where they start in the file.
     """
 
-    def __init__(self, file):
-        self.file_iterator = FileIterator(file)
+    def __init__(self, file, track_positions=False):
+        self.track_positions = track_positions
+        if track_positions:
+            self.file_iterator = PositionTrackingFileIterator(file)
+        else:
+            self.file_iterator = FileIterator(file)
 
     @abstractmethod
     def __iter__(self): # pragma: no cover
         pass
 
+    def iter_parts(self, max_lines=DEFAULT_PART_SIZE):
+        """
+        Returns the lines of the contexts in parts of about `max_lines` lines as (lines, is_last) tuples, where
+        `is_last` is True for the last part of each context, so a context doesn't need to be kept in memory to be
+        written. Every context has a last part, which might have no lines. By default, each context is a single part.
+        """
+        for context in self:
+            yield context.lines, True
+
+    def create_context(self, lines, lines_after=()):
+        """
+        Creates the context with `lines`. They must be the last lines read from the file, except for `lines_after`,
+        which were read after them and aren't part of the context (e.g. an excluded end delimiter).
+        """
+        if not self.track_positions:
+            return Context(lines)
+
+        line_number, end = self.file_iterator.tell()
+        line_number -= len(lines) + len(lines_after)
+        end -= self.file_iterator.get_lines_size(lines_after)
+        byte_offsets = self.file_iterator.get_offsets(lines, end)
+        byte_offset = byte_offsets[0] if byte_offsets else end
+        return Context(lines, line_number=line_number, byte_offset=byte_offset, byte_offsets=byte_offsets)
+
 
 class SingleDelimiterContextFactory(ContextFactoryBase):
     """
@@ -81,8 +426,8 @@ class SingleDelimiterContextFactory(ContextFactoryBase):
             Context(lines=["Last thing"])
     """
 
-    def __init__(self, file, delimiter_matcher, exclude_delimiter=True):
-        super().__init__(file)
+    def __init__(self, file, delimiter_matcher, exclude_delimiter=True, track_positions=False):
+        super().__init__(file, track_positions=track_positions)
         self.delimiter_matcher = delimiter_matcher
         self.exclude_delimiter = exclude_delimiter
 
@@ -90,10 +435,17 @@ class SingleDelimiterContextFactory(ContextFactoryBase):
         return self.delimiter_matcher.matches(line)
 
     def __iter__(self):
+        if self.delimiter_matcher.literal is not None:
+            return self.iter_literal_delimiter()
+        return self.iter_lines()
+
+    def iter_lines(self):
         context_lines = []
 
         # Only add delimiter if it's not the first line or if exclude_delimiter=False
-        line = next(iter(self.file_iterator))
+        line = next(self.file_iterator, None)
+        if line is None:
+            return
         if not (self.matches_delimiter(line) and self.exclude_delimiter):
             context_lines.append(line)
 
@@ -104,13 +456,126 @@ class SingleDelimiterContextFactory(ContextFactoryBase):
                     context_lines.append(line)
                 # Only yield if we actually have something to yield and it's not the first line
                 if context_lines:
-                    yield Context(context_lines)
+                    yield self.create_context(context_lines, (line,) if self.exclude_delimiter else ())
                     context_lines = []
                     continue
             context_lines.append(line)
 
         if context_lines:
-            yield Context(context_lines)
+            yield self.create_context(context_lines)
+
+    def iter_literal_delimiter(self):
+        """
+        Same as `iter_lines` but the candidate delimiter lines are found by searching for the delimiter matcher's literal
+        in the file buffer, so the lines in between delimiters are never checked one by one.
+        """
+        literal = self.delimiter_matcher.literal
+        matches = self.delimiter_matcher.matches
+
+        def read_until(literal):
+            return self.file_iterator.read_until(literal, matches=matches)
+
+        context_lines, delimiter_line = read_until(literal)
+        if not context_lines and delimiter_line is not None:
+            # The first line is a delimiter
+            context_lines = [] if self.exclude_delimiter else [delimiter_line]
+            lines, delimiter_line = read_until(literal)
+            context_lines += lines
+
+        while delimiter_line is not None:
+            if not self.exclude_delimiter:
+                context_lines.append(delimiter_line)
+            if context_lines:
+                yield self.create_context(context_lines, (delimiter_line,) if self.exclude_delimiter else ())
+                context_lines = []
+            else:
+                context_lines.append(delimiter_line)
+
+            lines, delimiter_line = read_until(literal)
+            context_lines += lines
+
+        if context_lines:
+            yield self.create_context(context_lines)
+
+    def iter_parts(self, max_lines=DEFAULT_PART_SIZE):
+        if self.track_positions:
+            return super().iter_parts(max_lines)
+        if self.delimiter_matcher.literal is not None:
+            return self.iter_literal_delimiter_parts(max_lines)
+        return self.iter_lines_parts(max_lines)
+
+    def iter_lines_parts(self, max_lines):
+        """
+        Same as `iter_lines` but the lines are returned in parts (see `iter_parts`). `started` is True when some of
+        the lines of the current context were already returned.
+        """
+        context_lines = []
+        started = False
+
+        line = next(self.file_iterator, None)
+        if line is None:
+            return
+        if not (self.matches_delimiter(line) and self.exclude_delimiter):
+            context_lines.append(line)
+
+        for line in self.file_iterator:
+
+            if self.matches_delimiter(line):
+                if not self.exclude_delimiter:
+                    context_lines.append(line)
+                if context_lines or started:
+                    yield context_lines, True
+                    context_lines = []
+                    started = False
+                    continue
+            context_lines.append(line)
+
+            if len(context_lines) >= max_lines:
+                yield context_lines, False
+                context_lines = []
+                started = True
+
+        if context_lines or started:
+            yield context_lines, True
+
+    def iter_literal_delimiter_parts(self, max_lines):
+        """
+        Same as `iter_literal_delimiter` but the lines are returned in parts (see `iter_parts`).
+        """
+        literal = self.delimiter_matcher.literal
+        matches = self.delimiter_matcher.matches
+
+        def read_until(literal):
+            return self.file_iterator.read_until(literal, matches=matches, max_lines=max_lines)
+
+        started = False
+        context_lines, delimiter_line = read_until(literal)
+        if not context_lines and delimiter_line is not None:
+            # The first line is a delimiter
+            context_lines = [] if self.exclude_delimiter else [delimiter_line]
+            lines, delimiter_line = read_until(literal)
+            context_lines += lines
+
+        while delimiter_line is not None:
+            if delimiter_line is MORE_LINES:
+                yield context_lines, False
+                context_lines = []
+                started = True
+            else:
+                if not self.exclude_delimiter:
+                    context_lines.append(delimiter_line)
+                if context_lines or started:
+                    yield context_lines, True
+                    context_lines = []
+                    started = False
+                else:
+                    context_lines.append(delimiter_line)
+
+            lines, delimiter_line = read_until(literal)
+            context_lines += lines
+
+        if context_lines or started:
+            yield context_lines, True
 
 
 class StartAndEndDelimiterContextFactory(ContextFactoryBase):
@@ -132,14 +597,18 @@ class StartAndEndDelimiterContextFactory(ContextFactoryBase):
             Context(lines=["this should be included", "and so should this"])
     """
 
-    def __init__(self, file, start_delimiter_matcher, end_delimiter_matcher, exclude_start_delimiter=False, exclude_end_delimiter=False, ignore_end_delimiter=True,):
+    def __init__(self, file, start_delimiter_matcher, end_delimiter_matcher, exclude_start_delimiter=False, exclude_end_delimiter=False, ignore_end_delimiter=True,
+                 nested=False, min_depth=1, max_depth=None, track_positions=False):
 
-        super().__init__(file)
+        super().__init__(file, track_positions=track_positions)
         self.start_delimiter_matcher = start_delimiter_matcher
         self.end_delimiter_matcher = end_delimiter_matcher
         self.exclude_start_delimiter = exclude_start_delimiter
         self.exclude_end_delimiter = exclude_end_delimiter
         self.ignore_end_delimiter = ignore_end_delimiter
+        self.nested = nested
+        self.min_depth = min_depth
+        self.max_depth = max_depth
 
         self.stack = deque()
 
@@ -150,6 +619,46 @@ class StartAndEndDelimiterContextFactory(ContextFactoryBase):
         return self.end_delimiter_matcher.matches(line)
 
     def __iter__(self):
+        if self.nested:
+            return self.iter_nested()
+        return self.iter_flat()
+
+    def iter_flat(self):
+        while True:
+            start_line = self.get_next_start_line()
+
+            if start_line is None:
+                break
+
+            context_lines = []
+            if not self.exclude_start_delimiter:
+                context_lines.append(start_line)
+
+            lines, end_line = self.read_until_end()
+            context_lines += lines
+
+            lines_after = ()
+            if end_line is not None:
+                if not self.exclude_end_delimiter:
+                    context_lines.append(end_line)
+                elif not self.ignore_end_delimiter:
+                    # This end delimiter might be used as a start delimiter later
+                    self.file_iterator.unread(end_line)
+                else:
+                    lines_after = (end_line,)
+
+            yield self.create_context(context_lines, lines_after)
+
+    def iter_parts(self, max_lines=DEFAULT_PART_SIZE):
+        if self.nested or self.track_positions:
+            # The lines of nested contexts are part of the contexts around them
+            return super().iter_parts(max_lines)
+        return self.iter_flat_parts(max_lines)
+
+    def iter_flat_parts(self, max_lines):
+        """
+        Same as `iter_flat` but the lines are returned in parts (see `iter_parts`).
+        """
         while True:
             start_line = self.get_next_start_line()
 
@@ -160,22 +669,114 @@ class StartAndEndDelimiterContextFactory(ContextFactoryBase):
             if not self.exclude_start_delimiter:
                 context_lines.append(start_line)
 
+            lines, end_line = self.read_until_end(max_lines)
+            context_lines += lines
+            while end_line is MORE_LINES:
+                yield context_lines, False
+                context_lines, end_line = self.read_until_end(max_lines)
+
+            if end_line is not None:
+                if not self.exclude_end_delimiter:
+                    context_lines.append(end_line)
+                elif not self.ignore_end_delimiter:
+                    # This end delimiter might be used as a start delimiter later
+                    self.file_iterator.unread(end_line)
+
+            yield context_lines, True
+
+    def is_depth_included(self, depth):
+        return depth >= self.min_depth and (self.max_depth is None or depth <= self.max_depth)
+
+    def iter_nested(self):
+        """
+        Creates a context for every start delimiter, closed by its matching end delimiter. A start delimiter inside a
+        context opens a nested one (depth 1 is the outermost context) and the delimiters of nested contexts are part
+        of the contexts around them. Contexts are created when they're closed, so inner contexts come before the
+        contexts around them.
+
+        Example:
+            file text:
+                BEGIN
+                a
+                BEGIN
+                b
+                END
+                END
+            delimiters:
+                "BEGIN", "END"
+            outputs:
+                Context(lines=["BEGIN", "b", "END"])
+                Context(lines=["BEGIN", "a", "BEGIN", "b", "END", "END"])
+
+        The stack holds the index in `lines` where each open context starts. All of the open contexts end at the last
+        line so `lines` only holds the lines of the outermost context.
+        """
+        exclude_start = int(self.exclude_start_delimiter)
+        exclude_end = int(self.exclude_end_delimiter)
+
+        while True:
+            start_line = self.get_next_start_line()
+
+            if start_line is None:
+                break
+
+            lines = [start_line]
+            self.stack.append(0)
+
             for line in self.file_iterator:
                 if self.is_end(line):
-                    if not self.exclude_end_delimiter:
-                        context_lines.append(line)
-                    elif not self.ignore_end_delimiter:
-                        # This end delimiter might be used as a start delimiter later
-                        self.file_iterator.unread(line)
-                    break
-
-                context_lines.append(line)
+                    lines.append(line)
+                    start = self.stack.pop()
+                    if self.is_depth_included(len(self.stack) + 1):
+                        end = len(lines) - exclude_end
+                        yield self.create_context(lines[start + exclude_start:end], lines[end:])
+
+                    if exclude_end and not self.ignore_end_delimiter and self.is_start(line):
+                        # This end delimiter is also a start delimiter
+                        if not self.stack:
+                            self.file_iterator.unread(line)
+                            break
+                        self.stack.append(len(lines) - 1)
+
+                    if not self.stack:
+                        break
+                    continue
 
-            yield Context(context_lines)
+                if self.is_start(line):
+                    self.stack.append(len(lines))
+                lines.append(line)
+            else:
+                # The file ended before the contexts were closed
+                while self.stack:
+                    start = self.stack.pop()
+                    if self.is_depth_included(len(self.stack) + 1):
+                        yield self.create_context(lines[start + exclude_start:])
 
     def get_next_start_line(self):
+        literal = self.start_delimiter_matcher.literal
+        if literal is not None:
+            return self.file_iterator.read_until(literal, matches=self.is_start, keep_lines=False)[1]
+
         for line in self.file_iterator:
             if self.is_start(line):
                 return line
         return None
 
+    def read_until_end(self, max_lines=None):
+        """
+        Returns the lines before the next end delimiter and the end delimiter line (None if the file ends first). With
+        `max_lines`, it can return early with MORE_LINES instead of the end delimiter line (see `read_until`).
+        """
+        literal = self.end_delimiter_matcher.literal
+        if literal is not None:
+            return self.file_iterator.read_until(literal, matches=self.is_end, max_lines=max_lines)
+
+        lines = []
+        for line in self.file_iterator:
+            if self.is_end(line):
+                return lines, line
+            lines.append(line)
+            if max_lines is not None and len(lines) >= max_lines:
+                return lines, MORE_LINES
+        return lines, None
+
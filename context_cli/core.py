@@ -1,60 +1,97 @@
 import argparse
 import logging
+import os
+import random
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 from pathlib import Path
 
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
+# Exit status when some of the files couldn't be read (like grep)
+ERROR_EXIT_STATUS = 2
+
+from .binary import check_binary_file
 from .context import StartAndEndDelimiterContextFactory, SingleDelimiterContextFactory
 from .filter import (
     # ContextFilters
     ContainsRegexContextFilter, ContainsTextContextFilter, MatchesTextContextFilter, MatchesRegexContextFilter,
     NotContainsTextContextFilter, NotContainsRegexContextFilter, NotMatchesTextContextFilter, NotMatchesRegexContextFilter,
-    NotEmptyContextFilter,
+    NotEmptyContextFilter, QueryContextFilter, SampleContextFilter, UniqueContextFilter,
 
     # LineFilters
     ContainsTextLineFilter, ContainsRegexLineFilter, NotContainsTextLineFilter, NotContainsRegexLineFilter,
 )
-from .matcher import ContainsTextMatcher, RegexMatcher
+from .matcher import ContainsTextMatcher, MemoizedMatcher, memoize_matcher, plan_regex_matcher
+from .memo import LineMemo
+from .output import (
+    DEFAULT_MAX_OPEN_FILES, CountOutput, FilesWithMatchesOutput, FramedOutput, GroupByOutput, JsonLinesOutput,
+    SampleOutput, SortedOutput, SplitOutput, TextOutput, TopOutput,
+)
+from .prefetch import DEFAULT_PREFETCH_MEMORY, PrefetchBudget, map_ahead, open_prefetched, read_ahead
+from .query import QueryError, parse_query
+from .sample import BernoulliSampler
+from .sort import DEFAULT_SORT_MEMORY
+from .tee import tee_file
+from .unique import DEFAULT_BLOOM_CAPACITY, BloomFilter, DigestSet
 from .util import CtxRc, TypeArgDoesNotExistException
+from .vector import NumpySingleDelimiterContextFactory, NumpyStartAndEndDelimiterContextFactory
+from .walk import IGNORE_FILE_NAMES, FileWalker
+from .window import ContextWindow
 
 
-def start_and_end_delimiter_context_factory_creator(start_delimiter_matcher, end_delimiter_matcher, exclude_start, exclude_end, ignore_end_delimiter):
+def start_and_end_delimiter_context_factory_creator(start_delimiter_matcher, end_delimiter_matcher, exclude_start, exclude_end, ignore_end_delimiter,
+                                                    nested=False, min_depth=1, max_depth=None, track_positions=False,
+                                                    engine='python'):
     """Returns a factory function for StartAndEndDelimiterContextFactory where only the file is needed"""
 
+    factory_class = NumpyStartAndEndDelimiterContextFactory if engine == 'numpy' else StartAndEndDelimiterContextFactory
+
     def factory(file):
-        return StartAndEndDelimiterContextFactory(
+        return factory_class(
             file,
             start_delimiter_matcher=start_delimiter_matcher,
             end_delimiter_matcher=end_delimiter_matcher,
             exclude_start_delimiter=exclude_start,
             exclude_end_delimiter=exclude_end,
             ignore_end_delimiter=ignore_end_delimiter,
+            nested=nested,
+            min_depth=min_depth,
+            max_depth=max_depth,
+            track_positions=track_positions,
         )
 
     return factory
 
 
-def single_delimiter_context_factory_creator(delimiter_matcher, exclude_delimiter):
+def single_delimiter_context_factory_creator(delimiter_matcher, exclude_delimiter, track_positions=False,
+                                             engine='python'):
     """
-    Returns a factory function for SingleDelimiterContextFactory where only the file is neded.
+    Returns a factory function for SingleDelimiterContextFactory where only the file is neded. With the 'numpy'
+    `engine`, the delimiters are found with NumPy when it's possible (see the vector module).
     """
 
+    factory_class = NumpySingleDelimiterContextFactory if engine == 'numpy' else SingleDelimiterContextFactory
+
     def factory(file):
-        return SingleDelimiterContextFactory(
+        return factory_class(
             file,
             delimiter_matcher=delimiter_matcher,
-            exclude_delimiter=exclude_delimiter
+            exclude_delimiter=exclude_delimiter,
+            track_positions=track_positions,
         )
     return factory
 
 
-def get_context_factory_from_args(ap, args):
+def get_context_factory_from_args(ap, args, memos=None):
     """
-    Uses the arguments to create a factory of context factories.
+    Uses the arguments to create a factory of context factories. With --memo-size, the memos of the delimiter regexes
+    are added to the `memos` dict, if any, so their stats can be logged (see `log_memo_stats`).
     """
 
     start_delimiter_matcher = args.start_delimiter_matcher
@@ -68,6 +105,29 @@ def get_context_factory_from_args(ap, args):
     if delimiter_matcher and (start_delimiter_matcher or end_delimiter_matcher):
         ap.error('-d/-D cannot be used with -s/-S or -e/-E')
 
+    if (args.min_depth is not None or args.max_depth is not None) and not args.nested:
+        ap.error('--min-depth and --max-depth can only be used with --nested')
+
+    if args.nested and not (start_delimiter_matcher and end_delimiter_matcher):
+        ap.error('--nested can only be used with -s/-S and -e/-E')
+
+    if args.min_depth is not None and args.max_depth is not None and args.min_depth > args.max_depth:
+        ap.error('--min-depth cannot be greater than --max-depth')
+
+    if args.memo_size:
+        start_delimiter_matcher = start_delimiter_matcher and memoize_matcher(start_delimiter_matcher, args.memo_size)
+        end_delimiter_matcher = end_delimiter_matcher and memoize_matcher(end_delimiter_matcher, args.memo_size)
+        delimiter_matcher = delimiter_matcher and memoize_matcher(delimiter_matcher, args.memo_size)
+        if memos is not None:
+            for kind, matcher in (('start delimiter', start_delimiter_matcher),
+                                  ('end delimiter', end_delimiter_matcher), ('delimiter', delimiter_matcher)):
+                if type(matcher) is MemoizedMatcher:
+                    memos[kind, matcher.matcher.regexp.pattern] = matcher.memo
+
+    # Only needed when they're written (the JSON objects always have them). The lines skipped between contexts are only
+    # counted, so tracking them doesn't keep them in memory.
+    track_positions = bool(args.line_number or args.byte_offset or args.format == 'jsonl')
+
     context_factory_factory = None
     if start_delimiter_matcher and end_delimiter_matcher:
         context_factory_factory = start_and_end_delimiter_context_factory_creator(
@@ -76,11 +136,18 @@ def get_context_factory_from_args(ap, args):
             exclude_start=exclude_start,
             exclude_end=exclude_end,
             ignore_end_delimiter=ignore_end_delimiter,
+            nested=args.nested,
+            min_depth=args.min_depth if args.min_depth is not None else 1,
+            max_depth=args.max_depth,
+            track_positions=track_positions,
+            engine=args.engine,
         )
     elif delimiter_matcher:
         context_factory_factory = single_delimiter_context_factory_creator(
             delimiter_matcher=delimiter_matcher,
             exclude_delimiter=True,
+            track_positions=track_positions,
+            engine=args.engine,
         )
     else:
         ap.error('Expected delimiters to be set. Use -d/-D or -s/-S and -e/-E.')
@@ -88,13 +155,21 @@ def get_context_factory_from_args(ap, args):
     return context_factory_factory
 
 
-def build_pipeline(context_factory, args):
+def build_pipeline(context_factory, args, unique_set=None, sampler=None, line_memos=None):
     """
-    Builds the pipeline to execute for the context_factory and all of the arguments.
+    Builds the pipeline to execute for the context_factory and all of the arguments. When there's a `unique_set`, the
+    contexts that are already in it are filtered out (the same set is used for all of the files). When there's a
+    `sampler`, only the contexts it accepts are kept. `line_memos` has the memo of each regex filter (see
+    `get_line_memos_from_args`).
     """
 
     curr = context_factory
 
+    # Whether a context is sampled doesn't depend on its lines so, unless the sample is of the unique contexts, we
+    # sample first and the filters never see the rejected contexts.
+    if sampler is not None and unique_set is None:
+        curr = SampleContextFilter(context_generator=curr, sampler=sampler)
+
     # We do text matching first because it's a bit faster. This helps filter out some contexts before they reach the
     # regex matchers which are slower.
     for text in args.matches_text:
@@ -109,17 +184,29 @@ def build_pipeline(context_factory, args):
     for text in args.not_contains_text:
         curr = NotContainsTextContextFilter(context_generator=curr, text=text)
 
+    line_memos = line_memos or {}
     for regexp in args.matches_regex:
-        curr = MatchesRegexContextFilter(context_generator=curr, regexp=regexp)
+        curr = MatchesRegexContextFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('fullmatch', regexp)),
+        )
 
     for regexp in args.not_matches_regex:
-        curr = NotMatchesRegexContextFilter(context_generator=curr, regexp=regexp)
+        curr = NotMatchesRegexContextFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('fullmatch', regexp)),
+        )
 
     for regexp in args.contains_regex:
-        curr = ContainsRegexContextFilter(context_generator=curr, regexp=regexp)
+        curr = ContainsRegexContextFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('search', regexp)),
+        )
 
     for regexp in args.not_contains_regex:
-        curr = NotContainsRegexContextFilter(context_generator=curr, regexp=regexp)
+        curr = NotContainsRegexContextFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('search', regexp)),
+        )
+
+    for query in args.query:
+        curr = QueryContextFilter(context_generator=curr, query=query.compile(line_memos))
 
     for text in args.line_contains_text:
         curr = ContainsTextLineFilter(context_generator=curr, text=text)
@@ -128,17 +215,564 @@ def build_pipeline(context_factory, args):
         curr = NotContainsTextLineFilter(context_generator=curr, text=text)
 
     for regexp in args.line_contains_regex:
-        curr = ContainsRegexLineFilter(context_generator=curr, regexp=regexp)
+        curr = ContainsRegexLineFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('search', regexp)),
+        )
 
     for regexp in args.not_line_contains_regex:
-        curr = NotContainsRegexLineFilter(context_generator=curr, regexp=regexp)
+        curr = NotContainsRegexLineFilter(
+            context_generator=curr, regexp=regexp, memo=line_memos.get(('search', regexp)),
+        )
 
     # Ensure no empty contexts
     curr = NotEmptyContextFilter(context_generator=curr)
 
+    # Last, so we compare the contexts that are written
+    if unique_set is not None:
+        curr = UniqueContextFilter(context_generator=curr, seen=unique_set, ignore_regexps=args.unique_ignore)
+
+        if sampler is not None:
+            curr = SampleContextFilter(context_generator=curr, sampler=sampler)
+
     return curr
 
 
+def write_pipeline(context_factory, args, output, limit=None, **kwargs):
+    """
+    Writes the contexts that make it through the pipeline (see `build_pipeline`) and, with
+    --contexts-before/--contexts-after, the contexts around them. The pipeline is lazy so, after `limit` contexts, the
+    file isn't read anymore (except for the contexts after the last one). Returns the number of contexts that made it
+    through the pipeline, the contexts around them don't count.
+    """
+
+    before, after = get_window_sizes(args)
+    if not before and not after:
+        pipeline = build_pipeline(context_factory, args, **kwargs)
+        if limit is not None:
+            pipeline = islice(pipeline, limit)
+
+        written = 0
+        for context in pipeline:
+            output.write(context)
+            written += 1
+        return written
+
+    window = ContextWindow(context_factory, before=before, after=after)
+    for context in window.filter(build_pipeline(window, args, **kwargs), limit=limit):
+        output.write(context)
+    return window.matches
+
+
+def get_line_filters(args, line_memos=None):
+    """
+    Returns the line filters of the arguments, in the same order as in `build_pipeline`. They don't have a context
+    generator, only their `filter_line` is used (see `stream_file`).
+    """
+
+    line_memos = line_memos or {}
+    line_filters = []
+    for text in args.line_contains_text:
+        line_filters.append(ContainsTextLineFilter(None, text))
+    for text in args.not_line_contains_text:
+        line_filters.append(NotContainsTextLineFilter(None, text))
+    for regexp in args.line_contains_regex:
+        line_filters.append(ContainsRegexLineFilter(None, regexp, memo=line_memos.get(('search', regexp))))
+    for regexp in args.not_line_contains_regex:
+        line_filters.append(NotContainsRegexLineFilter(None, regexp, memo=line_memos.get(('search', regexp))))
+    return line_filters
+
+
+def can_stream(args, output, unique_set=None, sampler=None):
+    """
+    Returns True if the contexts can be streamed (see `stream_file`): the only filters are line filters, which don't
+    need the whole context, and the contexts are written as text as soon as they come out of the pipeline. The
+    contexts are always streamed with the Python engine.
+    """
+
+    line_filters = (args.line_contains_text, args.not_line_contains_text, args.line_contains_regex,
+                    args.not_line_contains_regex)
+    context_filters = (args.matches_text, args.not_matches_text, args.contains_text, args.not_contains_text,
+                       args.matches_regex, args.not_matches_regex, args.contains_regex, args.not_contains_regex,
+                       args.query)
+    streaming = (
+        any(line_filters) and not any(context_filters) and unique_set is None and sampler is None
+        and get_window_sizes(args) == (0, 0) and type(output) is TextOutput
+        and not (args.line_number or args.byte_offset)
+    )
+    if streaming and args.engine == 'numpy':
+        # The NumPy engine finds whole contexts in each block, so the parts of the contexts are read with Python
+        logger.debug('Using the Python engine to stream the contexts')
+    return streaming
+
+
+def stream_file(context_factory, line_filters, output, limit=None):
+    """
+    Writes the contexts of a file without keeping them in memory: each part of a context (see `iter_parts`) goes
+    through the line filters and its lines are written right away. The output delimiter is written when the first
+    lines of a context are. Like in the pipeline, the contexts without lines left are skipped and, after `limit`
+    contexts, the file isn't read anymore. Returns the number of contexts written.
+    """
+
+    written = 0
+    in_context = False
+    try:
+        for lines, is_last in context_factory.iter_parts():
+            for line_filter in line_filters:
+                lines = list(filter(line_filter.filter_line, lines))
+
+            if lines:
+                if not in_context:
+                    output.start_context()
+                    in_context = True
+                    written += 1
+                output.write_lines(lines)
+
+            if is_last and in_context:
+                output.end_context()
+                in_context = False
+                if written == limit:
+                    break
+    finally:
+        if in_context:
+            output.end_context()
+
+    return written
+
+
+def get_window_sizes(args):
+    """
+    Returns the number of contexts written before and after each context. --contexts-around sets both unless they're
+    set.
+    """
+
+    around = args.contexts_around or 0
+    before = args.contexts_before if args.contexts_before is not None else around
+    after = args.contexts_after if args.contexts_after is not None else around
+    return before, after
+
+
+def get_sampler_from_args(ap, args):
+    """
+    Creates the sampler used by --sample-rate or returns None if every context is kept.
+    """
+
+    if args.sample and args.sample_rate:
+        ap.error('--sample cannot be used with --sample-rate')
+
+    if args.seed is not None and not (args.sample or args.sample_rate):
+        ap.error('--seed can only be used with --sample or --sample-rate')
+
+    if not args.sample_rate:
+        return None
+    return BernoulliSampler(args.sample_rate, random.Random(args.seed))
+
+
+def get_unique_set_from_args(ap, args):
+    """
+    Creates the set used by --unique or returns None if repeated contexts are kept.
+    """
+
+    if not args.unique:
+        if args.unique_error_rate is not None or args.unique_ignore:
+            ap.error('--unique-error-rate and --unique-ignore can only be used with --unique')
+        return None
+
+    if args.unique_error_rate is None:
+        return DigestSet()
+    return BloomFilter(capacity=args.unique_capacity, error_rate=args.unique_error_rate)
+
+
+def get_line_memos_from_args(args):
+    """
+    With --memo-size, creates the memo of each regex filter (-C/-C!/-M/-M!/-L/-L! and the regexes of the queries). The
+    same one is used for all of the files and for all of the filters that check the lines the same way (e.g. -C, -L!
+    and `contains regex` with the same regex). Returns a dict from (method, regex), where the method is 'search' or
+    'fullmatch', to its memo.
+    """
+
+    if not args.memo_size:
+        return {}
+    keys = [('fullmatch', regexp) for regexp in args.matches_regex + args.not_matches_regex]
+    keys += [
+        ('search', regexp)
+        for regexp in args.contains_regex + args.not_contains_regex + args.line_contains_regex +
+        args.not_line_contains_regex
+    ]
+    keys += [predicate.memo_key for query in args.query for predicate in query.iter_predicates() if predicate.memo_key]
+    return {key: LineMemo(args.memo_size) for key in keys}
+
+
+def log_memo_stats(memos, type=None):
+    """
+    Logs the hits, misses and hit rate of each memo (see `get_line_memos_from_args`) once all of the files were read.
+    """
+
+    for (kind, regexp), memo in memos.items():
+        if type is None:
+            logger.debug('Memo of %s %r: %r', kind, regexp, memo)
+        else:
+            logger.debug('Memo of %s %r (type %s): %r', kind, regexp, type, memo)
+
+
+def get_max_count_per_file(args, output):
+    """
+    Returns the maximum number of contexts needed from each file or None if all of them are needed.
+    """
+
+    limits = [limit for limit in (args.max_count, output.max_count_per_file) if limit is not None]
+    return min(limits) if limits else None
+
+
+def get_output_from_args(ap, args, stream=None):
+    """
+    Creates the output that receives the contexts coming out of the pipeline. The output is written to `stream`
+    (stdout by default).
+    """
+
+    if stream is None:
+        stream = sys.stdout
+
+    output_modes = [
+        option for option, value in (
+            ('--count', args.count),
+            ('--files-with-matches', args.files_with_matches),
+            ('--split-by', args.split_by),
+            ('--group-by', args.group_by),
+        ) if value
+    ]
+    if len(output_modes) > 1:
+        ap.error(f'{output_modes[0]} cannot be used with {output_modes[1]}')
+
+    orders = [
+        option for option, value in (
+            ('--sample', args.sample),
+            ('--sort-by', args.sort_by),
+            ('--top', args.top),
+            ('--bottom', args.bottom),
+        ) if value
+    ]
+    if len(orders) > 1 and orders[0] != '--sample':
+        ap.error(f'{orders[0]} cannot be used with {orders[1]}')
+
+    # The order doesn't change the count, the files or the groups
+    if orders and output_modes and output_modes[0] != '--split-by':
+        ap.error(f'{orders[0]} cannot be used with {output_modes[0]}')
+
+    if bool(args.top or args.bottom) != bool(args.by):
+        ap.error('--top and --bottom require --by (and the other way around)')
+
+    if args.group_value and not args.group_by:
+        ap.error('--group-value can only be used with --group-by')
+
+    if args.format != 'text' and output_modes:
+        ap.error(f'--format {args.format} cannot be used with {output_modes[0]}')
+
+    # The contexts around the matches aren't matches, so they'd only be counted (or their file listed) by mistake
+    if output_modes and output_modes[0] in ('--count', '--files-with-matches') and any(get_window_sizes(args)):
+        ap.error(f'--contexts-before/--contexts-after/--contexts-around cannot be used with {output_modes[0]}')
+
+    if args.group_by:
+        return GroupByOutput(stream, args.group_by, value_regexp=args.group_value)
+
+    if args.count:
+        return CountOutput(stream)
+
+    if args.files_with_matches:
+        return FilesWithMatchesOutput(stream)
+
+    if args.split_by:
+        if not args.out_dir:
+            ap.error('--split-by requires --out-dir')
+        output = SplitOutput(
+            args.out_dir, args.split_by, output_delimiter=args.output_delimiter, max_open_files=args.max_open_files,
+            line_numbers=args.line_number, byte_offset=args.byte_offset,
+        )
+    elif args.format == 'jsonl':
+        output = JsonLinesOutput(stream)
+    elif args.format == 'binary':
+        output = FramedOutput(stream)
+    else:
+        output = TextOutput(
+            stream, output_delimiter=args.output_delimiter, line_numbers=args.line_number, byte_offset=args.byte_offset,
+        )
+
+    if args.sort_by:
+        output = SortedOutput(
+            output, args.sort_by, numeric=args.sort_numeric, reverse=args.sort_reverse, memory=args.sort_memory,
+        )
+    elif args.sort_numeric or args.sort_reverse:
+        ap.error('--sort-numeric and --sort-reverse can only be used with --sort-by')
+
+    if args.top:
+        output = TopOutput(output, args.by, args.top)
+    elif args.bottom:
+        output = TopOutput(output, args.by, args.bottom, largest=False)
+
+    # The sample is picked first and then sorted
+    if args.sample:
+        output = SampleOutput(output, args.sample, random.Random(args.seed))
+
+    return output
+
+
+def get_file_walker_from_args(ap, args):
+    """
+    Creates the walker that finds the files in the directories passed as arguments. Returns None without
+    -r/--recursive.
+    """
+
+    if (args.include or args.exclude or args.no_ignore) and not args.recursive:
+        ap.error('--include, --exclude and --no-ignore can only be used with -r/--recursive')
+
+    if not args.recursive:
+        return None
+
+    return FileWalker(
+        includes=args.include, excludes=args.exclude, ignore_file_names=() if args.no_ignore else IGNORE_FILE_NAMES,
+    )
+
+
+def read_file_list(path, chunk_size=64 * 1024):
+    """
+    Yields the paths listed in the file at `path` ('-' for stdin) as they're read. The paths are separated by NUL
+    characters if there's one before the first new line (like the output of `find -print0`) and by new lines
+    otherwise.
+    """
+
+    file = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        separator = None
+        pending = b''
+        while True:
+            chunk = file.read(chunk_size)
+            pending += chunk
+            if separator is None:
+                if b'\0' in pending:
+                    separator = b'\0'
+                elif b'\n' in pending or not chunk:
+                    separator = b'\n'
+                else:
+                    continue
+
+            entries = pending.split(separator)
+            pending = entries.pop() if chunk else b''
+            for entry in entries:
+                if separator == b'\n':
+                    entry = entry.rstrip(b'\r')
+                if entry:
+                    yield os.fsdecode(entry)
+
+            if not chunk:
+                break
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+def get_paths(args):
+    """
+    Yields the paths of the files (and directories) to read: the arguments followed by the ones in --files-from.
+    Without either, stdin ('-') is read.
+    """
+
+    yield from args.files
+    if args.files_from:
+        yield from read_file_list(args.files_from)
+    elif not args.files:
+        yield '-'
+
+
+def open_file(path, prefetch_size=0, budget=None):
+    """
+    Opens the file at `path` ('-' for stdin) to read it. With a `prefetch_size`, up to that many bytes (of what's left
+    in the `budget`) are read right away. IsADirectoryError is raised for directories, other errors are logged and None
+    is returned.
+    """
+
+    if path == '-':
+        return sys.stdin
+    try:
+        if prefetch_size:
+            return open_prefetched(path, prefetch_size, budget=budget)
+        return open(path)
+    except IsADirectoryError:
+        raise
+    except OSError as e:
+        logger.error('Cannot open %s: %s', path, e)
+        return None
+
+
+def close_opened_file(opened_file):
+    _, file, _ = opened_file
+    if file is not None:
+        file.close()
+
+
+def iter_files(paths, file_walker, prefetch=0, prefetch_memory=DEFAULT_PREFETCH_MEMORY, errors=None):
+    """
+    Yields the files to read. Each file is opened right before it's read (and closed by the caller once it's done), so
+    only one file is open at a time. The files in the directories are found by `file_walker` while the previous ones
+    are read. The paths that can't be read (including the directories and entries found by `file_walker`) are skipped
+    and, if `errors` is a list, appended to it.
+
+    With `prefetch`, the next `prefetch` files are opened, and the start of each one is read, in a thread pool while
+    the current one is read. Each one reads up to its share of `prefetch_memory` (the current file keeps its share
+    until it's read). The paths after a directory are opened ahead while the directory's files are, so they all share
+    the same threads and `prefetch_memory` is never exceeded (the files that go over it aren't read ahead).
+    """
+
+    if not prefetch:
+        yield from iter_opened_files(paths, file_walker, errors=errors)
+        return
+
+    budget = PrefetchBudget(prefetch_memory)
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        yield from iter_opened_files(
+            paths, file_walker, errors=errors, prefetch=prefetch, prefetch_size=prefetch_memory // (prefetch + 1),
+            budget=budget, executor=executor,
+        )
+
+
+def iter_opened_files(paths, file_walker, errors=None, prefetch=0, prefetch_size=0, budget=None, executor=None):
+    """
+    Yields the files to read (see `iter_files`).
+    """
+
+    def open_path(path):
+        try:
+            return path, open_file(path, prefetch_size, budget=budget), False
+        except IsADirectoryError:
+            return path, None, True
+
+    def open_paths(paths):
+        return map_ahead(open_path, paths, prefetch, discard=close_opened_file, executor=executor)
+
+    def add_error(path):
+        if errors is not None:
+            errors.append(path)
+
+    for path, file, is_directory in open_paths(paths):
+        if is_directory:
+            if file_walker is None:
+                logger.error('%s is a directory (use -r/--recursive)', path)
+                add_error(path)
+                continue
+            for walked_path, file, _ in open_paths(file_walker.walk(path, on_error=add_error)):
+                if file is not None:
+                    yield file
+                else:
+                    add_error(walked_path)
+            continue
+
+        if file is not None:
+            yield file
+        else:
+            add_error(path)
+
+
+def get_files_from_args(ap, args, errors=None):
+    """
+    Returns an iterator of the files to read. They're opened as they're needed. The paths that can't be read are
+    appended to `errors` (see `iter_files`).
+    """
+
+    file_walker = get_file_walker_from_args(ap, args)
+    files = iter_files(
+        get_paths(args), file_walker, prefetch=args.prefetch, prefetch_memory=args.prefetch_memory, errors=errors,
+    )
+    files = check_binary_files(files, args.binary_files)
+    if args.read_ahead:
+        files = map(read_ahead, files)
+    return files
+
+
+def check_binary_files(files, binary_files):
+    """
+    Yields the files that aren't skipped by the `binary_files` policy (see `check_binary_file`). The skipped files are
+    closed.
+    """
+
+    for file in files:
+        if check_binary_file(file, binary_files):
+            yield file
+        else:
+            file.close()
+
+
+def query(value):
+    """
+    Type of --query. The query is parsed once, when the arguments are parsed, and compiled with the memos of its regexes
+    in `build_pipeline`.
+    """
+    try:
+        return parse_query(value)
+    except QueryError as e:
+        raise argparse.ArgumentTypeError(f'invalid query {value!r}: {e}')
+
+
+def non_negative_int(value):
+    """
+    argparse type for arguments that must be an integer >= 0.
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'{value} is not an integer >= 0')
+    return number
+
+
+def positive_int(value):
+    """
+    argparse type for arguments that must be an integer >= 1.
+    """
+
+    number = non_negative_int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not an integer >= 1')
+    return number
+
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def byte_size(value):
+    """
+    argparse type for sizes in bytes with an optional K, M or G suffix (e.g. 512M).
+    """
+
+    number = value.strip().upper()
+    multiplier = 1
+    if number[-1:] in _SIZE_SUFFIXES:
+        multiplier = _SIZE_SUFFIXES[number[-1]]
+        number = number[:-1]
+
+    try:
+        size = int(float(number) * multiplier)
+    except ValueError:
+        size = 0
+
+    if size < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a size (e.g. 1024, 64K, 512M or 2G)')
+    return size
+
+
+def fraction(value):
+    """
+    argparse type for arguments that must be a number between 0 and 1 (exclusive).
+    """
+
+    try:
+        number = float(value)
+    except ValueError:
+        number = -1
+
+    if not 0 < number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a number between 0 and 1')
+    return number
 
 
 def construct_arg_parser():
@@ -148,21 +782,23 @@ def construct_arg_parser():
         description=__doc__
     )
 
-    ap.add_argument('-t', '--type', help='type of search as specified in .ctxrc', type=str)
+    ap.add_argument('-t', '--type',
+                    help='type of search as specified in .ctxrc (can be repeated to run several types in a single pass, '
+                         'see --out-dir)', type=str, action='append')
     ap.add_argument('-w', '--write',
                     help='write the current context search to .ctxrc', action='store_const', const=True, default=False)
 
     ap.add_argument('-d', '--delimiter-text', help="delimiter text", dest='delimiter_matcher', type=ContainsTextMatcher)
-    ap.add_argument('-D', '--delimiter-regex', help="delimiter regex", dest='delimiter_matcher', type=RegexMatcher)
+    ap.add_argument('-D', '--delimiter-regex', help="delimiter regex", dest='delimiter_matcher', type=plan_regex_matcher)
 
     ap.add_argument('-s', '--delimiter-start-text', help="delimiter start text", dest='start_delimiter_matcher',
                     type=ContainsTextMatcher)
     ap.add_argument('-S', '--delimiter-start-regex', help='delimiter start regex', dest='start_delimiter_matcher',
-                    type=RegexMatcher)
+                    type=plan_regex_matcher)
     ap.add_argument('-e', '--delimiter-end-text', help='delimiter end text', dest='end_delimiter_matcher',
                     type=ContainsTextMatcher)
     ap.add_argument('-E', '--delimiter-end-regex', help='delimiter end regex', dest='end_delimiter_matcher',
-                    type=RegexMatcher)
+                    type=plan_regex_matcher)
 
     ap.add_argument('-x', '--exclude-start-delimiter',
                     help='exclude start delimiter from the context', action='store_const', const=True, default=False)
@@ -171,6 +807,13 @@ def construct_arg_parser():
     ap.add_argument('-i', '--ignore-end-delimiter',
                     help='prevent end delimiter from being considered as a start delimiter (only applies if -X is used)',
                     action='store_const', const=True, default=False)
+    ap.add_argument('--nested',
+                    help='a start delimiter inside a context opens a nested context instead of being part of it',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--min-depth', help='only display nested contexts at this depth or deeper (1 is the outermost)',
+                    type=positive_int, metavar='N')
+    ap.add_argument('--max-depth', help='only display nested contexts at this depth or shallower (1 is the outermost)',
+                    type=positive_int, metavar='N')
 
     # Context filters
     ap.add_argument('-c', '--contains-text',
@@ -196,6 +839,10 @@ def construct_arg_parser():
     ap.add_argument('-M!', '--not-matches-regex',
                     help="display only contexts that have line(s) that don't exactly match this regex", action='append',
                     default=[])
+    ap.add_argument('-q', '--query', type=query, action='append', default=[],
+                    help='display only contexts that match this expression of contains/matches [text|regex] "..." '
+                         'combined with and, or, not and parentheses, e.g. \'(contains "A" or contains regex "B+") and '
+                         'not matches "C"\'')
 
     # Line filters
     ap.add_argument('-l', '--line-contains-text',
@@ -209,7 +856,109 @@ def construct_arg_parser():
 
     # Output
     ap.add_argument('-o', '--output-delimiter', help='Output delimiter', default='')
-    ap.add_argument('files', nargs='*', type=argparse.FileType('r'), default=[sys.stdin])
+    ap.add_argument('-n', '--line-number', help='start each line with its line number',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--byte-offset', help='start each line with the byte offset where its context starts in the file',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--format', help='text (default), jsonl (a JSON object with the file, the positions and the lines '
+                                     'of each context) or binary (each context is its size in UTF-8 as a 4 byte '
+                                     'big-endian integer followed by its text)',
+                    choices=['text', 'jsonl', 'binary'], default='text')
+    ap.add_argument('--count', help='only display the number of contexts of each file (and the total)',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--files-with-matches',
+                    help='only display the names of the files that have contexts (stops reading a file at its first '
+                         'context)', action='store_const', const=True, default=False)
+    ap.add_argument('--max-count', help='stop reading a file after this many contexts', type=non_negative_int,
+                    metavar='N')
+    ap.add_argument('--max-total', help='stop reading all of the files after this many contexts in total',
+                    type=non_negative_int, metavar='N')
+    ap.add_argument('--out-dir',
+                    help='with -t/--type, write the contexts of each type to a file named after the type in this '
+                         'directory. With --split-by, the directory where the files are written')
+    ap.add_argument('--split-by', metavar='REGEX',
+                    help='write each context to a file in --out-dir named after the first capture group of this regex '
+                         '(contexts that don\'t match are not written)')
+    ap.add_argument('--max-open-files', metavar='N', type=positive_int, default=DEFAULT_MAX_OPEN_FILES,
+                    help=f'maximum number of files kept open by --split-by (default: {DEFAULT_MAX_OPEN_FILES})')
+    ap.add_argument('--group-by', metavar='REGEX',
+                    help='only display the number of contexts for each value of the first capture group of this regex '
+                         '(like `grep -o ... | sort | uniq -c`)')
+    ap.add_argument('--group-value', metavar='REGEX',
+                    help='with --group-by, also display the sum, min and max of the number captured by this regex')
+    ap.add_argument('--sort-by', metavar='REGEX',
+                    help='sort the contexts by the first capture group of this regex (contexts without it go first)')
+    ap.add_argument('--sort-numeric', help='with --sort-by, compare the keys as numbers',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--sort-reverse', help='with --sort-by, sort in descending order',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--sort-memory', metavar='SIZE', type=byte_size, default=DEFAULT_SORT_MEMORY,
+                    help='with --sort-by, keep about this many bytes of contexts in memory and spill the rest to '
+                         'temporary files (default: 256M)')
+    ap.add_argument('--top', metavar='K', type=positive_int,
+                    help='only display the K contexts with the largest number captured by --by, largest first')
+    ap.add_argument('--bottom', metavar='K', type=positive_int,
+                    help='only display the K contexts with the smallest number captured by --by, smallest first')
+    ap.add_argument('--by', metavar='REGEX',
+                    help='with --top/--bottom, regex whose first capture group is the number contexts are ranked by '
+                         '(contexts without it are skipped)')
+    ap.add_argument('--sample', metavar='N', type=positive_int,
+                    help='only display a uniform random sample of N of the contexts (keeps N contexts in memory)')
+    ap.add_argument('--sample-rate', metavar='P', type=fraction,
+                    help='only display each context with probability P (the rest are not filtered)')
+    ap.add_argument('--seed', type=int, help='with --sample or --sample-rate, seed of the random numbers')
+    ap.add_argument('--contexts-before', metavar='N', type=non_negative_int,
+                    help='also display the N contexts before each context (like grep -B but for contexts)')
+    ap.add_argument('--contexts-after', metavar='N', type=non_negative_int,
+                    help='also display the N contexts after each context (like grep -A but for contexts)')
+    ap.add_argument('--contexts-around', metavar='N', type=non_negative_int,
+                    help='also display the N contexts before and after each context (like grep -C but for contexts)')
+    ap.add_argument('--unique', help='drop the contexts that are the same as a previous one (in any file)',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--unique-ignore', metavar='REGEX', action='append', default=[],
+                    help='with --unique, ignore the text that matches this regex (e.g. timestamps) when comparing '
+                         'contexts (can be repeated)')
+    ap.add_argument('--unique-error-rate', metavar='P', type=fraction,
+                    help='with --unique, use a fixed-size Bloom filter instead of remembering every context. About P '
+                         'of the new contexts are dropped by mistake once --unique-capacity contexts were seen')
+    ap.add_argument('--unique-capacity', metavar='N', type=positive_int, default=DEFAULT_BLOOM_CAPACITY,
+                    help=f'number of different contexts the Bloom filter of --unique-error-rate is sized for '
+                         f'(default: {DEFAULT_BLOOM_CAPACITY})')
+    ap.add_argument('--binary-files', choices=['skip', 'text'], default='skip',
+                    help='skip (default) the files that look binary (they have NUL bytes or too much of their first '
+                         '8 KB cannot be decoded) or read them as text (text that cannot be decoded is replaced)')
+    ap.add_argument('-r', '--recursive', help='search the files in the directories (and their subdirectories)',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--include', metavar='GLOB', action='append', default=[],
+                    help='with -r, only search the files that match this .gitignore-style glob (can be repeated)')
+    ap.add_argument('--exclude', metavar='GLOB', action='append', default=[],
+                    help='with -r, skip the files and directories that match this .gitignore-style glob (can be '
+                         'repeated)')
+    ap.add_argument('--no-ignore', help=f'with -r, don\'t skip the files in {" and ".join(IGNORE_FILE_NAMES)} files',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--prefetch', metavar='N', type=non_negative_int, default=0,
+                    help='open the next N files, and read their start, in the background while the current one is read '
+                         '(for storage with a high latency, like NFS)')
+    ap.add_argument('--prefetch-memory', metavar='SIZE', type=byte_size, default=DEFAULT_PREFETCH_MEMORY,
+                    help='with --prefetch, maximum number of bytes read ahead, shared between the files (default: 64M)')
+    ap.add_argument('--read-ahead', help='read the next blocks of each file in the background while the current one is '
+                                         'matched (for slow sources, like pipes or cold disks)',
+                    action='store_const', const=True, default=False)
+    ap.add_argument('--engine', choices=['python', 'numpy'], default='python',
+                    help='python (default) or numpy, which finds the new lines and the delimiter lines of large '
+                         'blocks of the file at once. It needs NumPy and delimiters that are texts, or regexes that '
+                         'are a text at the start or the end of the line or that have a literal. Otherwise python is '
+                         'used')
+    ap.add_argument('--memo-size', metavar='N', type=non_negative_int, default=0,
+                    help='remember whether the last N different lines match each delimiter regex and regex filter '
+                         '(-C/-C!/-M/-M!/-L/-L! and -q), so repeated lines are only matched once. The memo turns '
+                         'itself off if too few lines repeat')
+    ap.add_argument('--files-from', metavar='PATH',
+                    help="read the paths of the files from this file ('-' for stdin), one per line or separated by NUL "
+                         "characters (like find's -print0)")
+    ap.add_argument('files', nargs='*', help="files (and directories with -r) to read. Without files, stdin ('-') is "
+                                             "read")
+    ap.set_defaults(type_args=None)
 
     return ap
 
@@ -219,68 +968,220 @@ def parse_args(ap, argv):
     Parses the arguments. It checks whether the `--type` arg is set, and, if it is, either writes the arguments to the
     .ctxrc file or gets the args from there. If `--write` is specified, th ctxrx is written to and then this function
     exits the program.
+
+    When more than one type is used (or `--out-dir` is set), the arguments of each type are in `args.type_args` as a
+    list of (type, args) tuples.
     """
 
     args = ap.parse_args(argv[1:])
 
     if not args.type:
+        if args.out_dir and not args.split_by:
+            ap.error('--out-dir can only be used with -t/--type or --split-by')
         return args
 
     path = Path.home() / '.ctxrc'
     ctxrc = CtxRc.from_path(path)
 
     if args.write:
+        if len(args.type) > 1:
+            ap.error('Only one type can be written at a time')
+            return # We never get here but unit tests keep going since ap.error is mocked
+
         # Adding files to types doesn't make sense. Since it's a bit hard to remove the files from the argumnents, we
         # add this restriction.
-        if args.files[0].name != '<stdin>':
+        if args.files or args.files_from:
             ap.error("Don't specify files when writing a type")
             return # We never get here but unit tests keep going since ap.error is mocked
 
-        ctxrc.add_type(args.type, argv[1:])
+        ctxrc.add_type(args.type[0], argv[1:])
         ctxrc.save(path)
         ap.exit(0)
         return # We never get here but unit tests keep going since ap.exit is mocked
 
-    try:
-        type_argv = ctxrc.get_type_argv(args.type)
-    except TypeArgDoesNotExistException as e:
-        ap.error(str(e))
+    if len(args.type) > 1 and not args.out_dir:
+        ap.error('--out-dir is required when using more than one type')
         return None # We never get here
 
+    if len(args.type) > 1 and args.split_by:
+        ap.error('--split-by cannot be used with more than one type')
+        return None # We never get here
+
+    type_args = []
+    for type in args.type:
+        try:
+            type_args.append((type, parse_type_args(ap, ctxrc, type, argv, args)))
+        except TypeArgDoesNotExistException as e:
+            ap.error(str(e))
+            return None # We never get here
+
+    if len(type_args) == 1 and (not args.out_dir or args.split_by):
+        return type_args[0][1]
+
+    args.type_args = type_args
+    return args
+
+
+def parse_type_args(ap, ctxrc, type, argv, args):
+    """
+    Parses the arguments saved for `type` in the .ctxrc followed by the arguments in argv.
+    """
+
+    type_argv = ctxrc.get_type_argv(type)
+
     new_argv = type_argv + argv[1:]
     new_args = ap.parse_args(new_argv)
+
     new_args.files = args.files
+    new_args.files_from = args.files_from
     new_args.write = False
     new_args.type = None
+    new_args.type_args = None
     return new_args
 
 
+def get_file_limit(max_count, max_total, total):
+    """
+    Returns the maximum number of contexts to take from the next file (None if there's no limit) when `total` contexts
+    were already taken.
+    """
+
+    limit = max_count
+    if max_total is not None:
+        remaining = max(max_total - total, 0)
+        limit = remaining if limit is None else min(limit, remaining)
+    return limit
+
+
+class TypeRun:
+    """
+    Runs the pipeline of one type when more than one type is used. The contexts go to the type's own output.
+    """
+
+    def __init__(self, type, args, context_factory_factory, output, unique_set=None, sampler=None, line_memos=None):
+        self.type = type
+        self.args = args
+        self.context_factory_factory = context_factory_factory
+        self.output = output
+        self.unique_set = unique_set
+        self.sampler = sampler
+        self.line_memos = line_memos
+        self.max_count = get_max_count_per_file(args, output)
+        self.total = 0
+
+    def __call__(self, file):
+        self.output.start_file(file)
+
+        limit = get_file_limit(self.max_count, self.args.max_total, self.total)
+        self.total += write_pipeline(
+            self.context_factory_factory(file), self.args, self.output, limit=limit, unique_set=self.unique_set,
+            sampler=self.sampler, line_memos=self.line_memos,
+        )
+
+
+def main_multiple_types(ap, args):
+    """
+    Reads every file once and runs the pipelines of all of the types side by side. The output of each type is written
+    to a file named after the type in `--out-dir`. Returns ERROR_EXIT_STATUS if some of the files couldn't be read.
+    """
+
+    errors = []
+    files = get_files_from_args(ap, args, errors=errors)
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    streams = []
+    type_runs = []
+    memos = []
+    for type, type_args in args.type_args:
+        delimiter_memos = {}
+        context_factory_factory = get_context_factory_from_args(ap, type_args, memos=delimiter_memos)
+        line_memos = get_line_memos_from_args(type_args)
+        memos.append((type, {**delimiter_memos, **line_memos}))
+        stream = open(out_dir / type, 'w')
+        streams.append(stream)
+        type_runs.append(TypeRun(
+            type, type_args, context_factory_factory, get_output_from_args(ap, type_args, stream),
+            unique_set=get_unique_set_from_args(ap, type_args), sampler=get_sampler_from_args(ap, type_args),
+            line_memos=line_memos,
+        ))
+
+    try:
+        for file in files:
+            try:
+                tee_file(file, type_runs)
+            except UnicodeDecodeError as e:
+                # Only the start of the file is checked before reading it
+                logger.error('Cannot decode %s, skipping the rest of it: %s', file.name, e)
+                errors.append(file.name)
+            file.close()
+
+        for type_run in type_runs:
+            type_run.output.close()
+
+        for type, type_memos in memos:
+            log_memo_stats(type_memos, type=type)
+    finally:
+        for stream in streams:
+            stream.close()
+
+    return ERROR_EXIT_STATUS if errors else 0
+
+
 def main(argv):
     """
-    Main method.
+    Main method. Returns the exit status: ERROR_EXIT_STATUS if some of the files couldn't be read (or decoded), 0
+    otherwise.
     """
 
     ap = construct_arg_parser()
 
     args = parse_args(ap, argv)
 
-    context_factory_factory = get_context_factory_from_args(ap, args)
+    if args.type_args:
+        return main_multiple_types(ap, args)
+
+    errors = []
+    files = get_files_from_args(ap, args, errors=errors)
+    delimiter_memos = {}
+    context_factory_factory = get_context_factory_from_args(ap, args, memos=delimiter_memos)
+    output = get_output_from_args(ap, args)
+    max_count = get_max_count_per_file(args, output)
+    unique_set = get_unique_set_from_args(ap, args)
+    sampler = get_sampler_from_args(ap, args)
+    line_memos = get_line_memos_from_args(args)
+    streaming = can_stream(args, output, unique_set=unique_set, sampler=sampler)
+    line_filters = get_line_filters(args, line_memos) if streaming else None
+
+    total = 0
+    for file in files:
+        limit = get_file_limit(max_count, args.max_total, total)
+        if limit == 0:
+            # We already have all the contexts we need. Don't open the rest of the files.
+            file.close()
+            break
+
+        output.start_file(file)
 
-    first = True
-    for file in args.files:
         context_factory = context_factory_factory(file)
-        pipeline = build_pipeline(context_factory, args)
 
-        for context in pipeline:
-            if not first and args.output_delimiter:
-                sys.stdout.write(args.output_delimiter)
-                sys.stdout.write('\n')
-            first = False
-
-            text = str(context)
-            sys.stdout.write(text)
-            if not text.endswith('\n'):
-                sys.stdout.write('\n')
-            sys.stdout.flush()
-
-    return 0
+        try:
+            if streaming:
+                total += stream_file(context_factory, line_filters, output, limit=limit)
+            else:
+                total += write_pipeline(
+                    context_factory, args, output, limit=limit, unique_set=unique_set, sampler=sampler,
+                    line_memos=line_memos,
+                )
+        except UnicodeDecodeError as e:
+            # Only the start of the file is checked before reading it
+            logger.error('Cannot decode %s, skipping the rest of it: %s', file.name, e)
+            errors.append(file.name)
+
+        file.close()
+
+    output.close()
+    log_memo_stats({**delimiter_memos, **line_memos})
+
+    return ERROR_EXIT_STATUS if errors else 0
@@ -6,7 +6,8 @@ import logging
 from abc import ABC, abstractmethod
 
 from .context import Context
-from .util import build_regexp_if_needed
+from .unique import get_context_digest
+from .util import build_regexp_if_needed, get_required_literal
 
 
 logger = logging.getLogger(__name__)
@@ -74,14 +75,34 @@ class ContainsRegexContextFilter(ContextFilter):
 
         regex: '^[a-zA-Z]$'
         matches: 'abc', 'ABc'
+
+    With a `memo` (a LineMemo that is only used to search this regex), the lines that were already checked aren't
+    matched again.
     """
 
-    def __init__(self, context_generator, regexp):
+    def __init__(self, context_generator, regexp, memo=None):
         super().__init__(context_generator)
         self.regexp = build_regexp_if_needed(regexp)
+        # Lines that don't contain this literal can't match so we skip the (much slower) regex for them.
+        self.literal = get_required_literal(self.regexp)
+        self.memo = memo
+
+    def search(self, line):
+        if self.literal is not None and self.literal not in line:
+            return False
+        return self.regexp.search(line) is not None
 
     def is_context_valid(self, context):
-        return any(self.regexp.search(line) for line in context.lines)
+        if self.memo is not None:
+            get = self.memo.get
+            search = self.search
+            return any(get(line, search) for line in context.lines)
+
+        search = self.regexp.search
+        literal = self.literal
+        if literal is None:
+            return any(search(line) for line in context.lines)
+        return any(literal in line and search(line) for line in context.lines)
 
 
 class MatchesTextContextFilter(ContextFilter):
@@ -108,13 +129,32 @@ class MatchesRegexContextFilter(ContextFilter):
         regex: '[a-zA-Z]'
         matches: 'abc', 'ABC'
         doesn't match: 'abc1', '1abc'
+
+    With a `memo` (a LineMemo that is only used to fully match this regex), the lines that were already checked aren't
+    matched again.
     """
-    def __init__(self, context_generator, regexp):
+    def __init__(self, context_generator, regexp, memo=None):
         super().__init__(context_generator)
         self.regexp = build_regexp_if_needed(regexp)
+        self.literal = get_required_literal(self.regexp)
+        self.memo = memo
+
+    def fullmatch(self, line):
+        if self.literal is not None and self.literal not in line:
+            return False
+        return self.regexp.fullmatch(line) is not None
 
     def is_context_valid(self, context):
-        return any(self.regexp.fullmatch(line) for line in context.lines)
+        if self.memo is not None:
+            get = self.memo.get
+            fullmatch = self.fullmatch
+            return any(get(line, fullmatch) for line in context.lines)
+
+        fullmatch = self.regexp.fullmatch
+        literal = self.literal
+        if literal is None:
+            return any(fullmatch(line) for line in context.lines)
+        return any(literal in line and fullmatch(line) for line in context.lines)
 
 
 class NotContainsTextContextFilter(NegateContextFilterMixin, ContainsTextContextFilter):
@@ -145,6 +185,19 @@ class NotMatchesRegexContextFilter(NegateContextFilterMixin, MatchesRegexContext
     pass
 
 
+class QueryContextFilter(ContextFilter):
+    """
+    Checks whether the context matches a query, given as the function compiled by `query.compile_query`.
+    """
+
+    def __init__(self, context_generator, query):
+        super().__init__(context_generator)
+        self.query = query
+
+    def is_context_valid(self, context):
+        return self.query(context)
+
+
 class NotEmptyContextFilter(ContextFilter):
     """
     Checks whether the context is not empty.
@@ -154,6 +207,36 @@ class NotEmptyContextFilter(ContextFilter):
         return len(context.lines) > 0
 
 
+class UniqueContextFilter(ContextFilter):
+    """
+    Filters out the contexts that were already seen. `seen` keeps the digests of the contexts (see `unique.py`) and
+    can be shared by the pipelines of several files. The parts of the contexts that match the `ignore_regexps` don't
+    count when comparing them.
+    """
+
+    def __init__(self, context_generator, seen, ignore_regexps=()):
+        super().__init__(context_generator)
+        self.seen = seen
+        self.ignore_regexps = [build_regexp_if_needed(regexp) for regexp in ignore_regexps]
+
+    def is_context_valid(self, context):
+        return self.seen.add(get_context_digest(context, self.ignore_regexps))
+
+
+class SampleContextFilter(ContextFilter):
+    """
+    Keeps each context with the probability of the `sampler` (see `sample.py`). The decision doesn't look at the
+    context so it can go before the rest of the filters and the rejected contexts are never filtered.
+    """
+
+    def __init__(self, context_generator, sampler):
+        super().__init__(context_generator)
+        self.sampler = sampler
+
+    def is_context_valid(self, context):
+        return self.sampler.accept()
+
+
 class LineFilter(BaseFilter):
 
     def __init__(self, context_generator):
@@ -172,9 +255,29 @@ class LineFilter(BaseFilter):
         return filter(self.filter_line, context.lines)
 
     def get_filtered_context(self, context):
+        if context.line_number is not None:
+            return self.get_filtered_context_with_positions(context)
         context_filter = self.get_filter(context)
         return Context(lines=list(context_filter))
 
+    def get_filtered_context_with_positions(self, context):
+        """
+        Same as `get_filtered_context` but the new context keeps the position of the context and the number (and the
+        byte offset) of each line.
+        """
+        lines = context.lines
+        filter_line = self.filter_line
+        kept = [index for index, line in enumerate(lines) if filter_line(line)]
+        line_numbers = context.line_numbers
+        byte_offsets = context.byte_offsets
+        return Context(
+            lines=[lines[index] for index in kept],
+            line_number=context.line_number,
+            byte_offset=context.byte_offset,
+            line_numbers=[line_numbers[index] for index in kept],
+            byte_offsets=[byte_offsets[index] for index in kept] if byte_offsets is not None else None,
+        )
+
 
 class NegateLineFilterMixin:
     """
@@ -200,15 +303,25 @@ class ContainsTextLineFilter(LineFilter):
 
 class ContainsRegexLineFilter(LineFilter):
     """
-    Filters out the lines that don't match the regex.
+    Filters out the lines that don't match the regex. With a `memo` (a LineMemo that is only used for this regex), the
+    lines that were already checked aren't matched again.
     """
 
-    def __init__(self, context_generator, regexp):
+    def __init__(self, context_generator, regexp, memo=None):
         super().__init__(context_generator)
         self.regexp = build_regexp_if_needed(regexp)
+        self.literal = get_required_literal(self.regexp)
+        self.memo = memo
+
+    def search(self, line):
+        if self.literal is not None and self.literal not in line:
+            return False
+        return self.regexp.search(line) is not None
 
     def filter_line(self, line):
-        return self.regexp.search(line)
+        if self.memo is not None:
+            return self.memo.get(line, self.search)
+        return self.search(line)
 
 
 class NotContainsTextLineFilter(NegateLineFilterMixin, ContainsTextLineFilter):
@@ -2,9 +2,11 @@
 Module containing matchers
 """
 
+import re
 from abc import ABC, abstractmethod
 
-from .util import build_regexp_if_needed
+from .memo import LineMemo
+from .util import build_regexp_if_needed, get_required_literal, sre_parse
 
 
 import logging
@@ -12,6 +14,13 @@ logger = logging.getLogger(__name__)
 
 
 class Matcher(ABC):
+    """
+    Abstract Matcher class. Matchers receive lines without the trailing new line.
+    """
+
+    # When set, every line that matches contains this literal (which has no new lines). This allows searching for the
+    # candidate lines over large buffers instead of checking the lines one by one.
+    literal = None
 
     @abstractmethod
     def matches(self, line): # pragma: no cover
@@ -25,14 +34,30 @@ class RegexMatcher(Matcher):
 
     def __init__(self, regexp):
         self.regexp = build_regexp_if_needed(regexp)
+        self.literal = get_required_literal(self.regexp) or None
 
     def matches(self, line):
         """
         Returns True if the line argument matches the regex.
         """
+        if self.literal is not None and self.literal not in line:
+            return False
         return self.regexp.search(line) is not None
 
 
+class AnchoredRegexMatcher(RegexMatcher):
+    """
+    Matcher for regexes that can only match at the beginning of the line (e.g. '^\\d{4}-\\d{2}-\\d{2}'). `match` only
+    tries the first position of the line.
+    """
+
+    def matches(self, line):
+        """
+        Returns True if the line argument matches the regex at its beginning.
+        """
+        return self.regexp.match(line) is not None
+
+
 class ContainsTextMatcher(Matcher):
     """
     Matches a line against a text.
@@ -40,6 +65,8 @@ class ContainsTextMatcher(Matcher):
 
     def __init__(self, text):
         self.text = text
+        if text and '\n' not in text:
+            self.literal = text
 
     def matches(self, line):
         """
@@ -48,3 +75,148 @@ class ContainsTextMatcher(Matcher):
         return self.text in line
 
 
+class ExactTextMatcher(ContainsTextMatcher):
+    """
+    Matches lines that are exactly the text (e.g. '^```$' or '^$').
+    """
+
+    def matches(self, line):
+        """
+        Returns true if the line argument is the text.
+        """
+        return line == self.text
+
+
+class PrefixTextMatcher(ContainsTextMatcher):
+    """
+    Matches lines that start with the text and, if there's a regexp, that also match it at the beginning of the line
+    (e.g. '^BEGIN' or '^ERROR \\d+').
+    """
+
+    def __init__(self, text, regexp=None):
+        super().__init__(text)
+        self.regexp = build_regexp_if_needed(regexp) if regexp is not None else None
+
+    def matches(self, line):
+        """
+        Returns true if the line argument starts with the text (and matches the regexp).
+        """
+        if not line.startswith(self.text):
+            return False
+        return self.regexp is None or self.regexp.match(line) is not None
+
+
+class SuffixTextMatcher(ContainsTextMatcher):
+    """
+    Matches lines that end with the text (e.g. 'END$').
+    """
+
+    def matches(self, line):
+        """
+        Returns true if the line argument ends with the text.
+        """
+        return line.endswith(self.text)
+
+
+class MemoizedMatcher(Matcher):
+    """
+    Remembers whether the last lines that were checked match `matcher` (see LineMemo) so repeated lines are only matched
+    once.
+    """
+
+    def __init__(self, matcher, memo):
+        self.matcher = matcher
+        self.memo = memo
+        self.literal = matcher.literal
+
+    def matches(self, line):
+        """
+        Returns True if the line argument matches the matcher.
+        """
+        return self.memo.get(line, self.matcher.matches)
+
+
+def memoize_matcher(matcher, size):
+    """
+    Returns a MemoizedMatcher of `matcher` with a memo of `size` lines. Text matchers are returned as they are since
+    checking them costs less than hashing the line.
+    """
+    if getattr(matcher, 'regexp', None) is None:
+        return matcher
+    return MemoizedMatcher(matcher, LineMemo(size))
+
+
+_START_ANCHORS = {sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING}
+_END_ANCHORS = {sre_parse.AT_END, sre_parse.AT_END_STRING}
+
+
+def _flatten_groups(items):
+    """
+    Replaces the groups that don't change flags with their contents. Whether a line matches doesn't depend on groups.
+    """
+    flattened = []
+    for op, av in items:
+        if op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+            flattened.extend(_flatten_groups(av[-1]))
+        else:
+            flattened.append((op, av))
+    return flattened
+
+
+def plan_regex_matcher(regexp):
+    """
+    Looks at the regexp once and returns the cheapest matcher that is equivalent to `RegexMatcher(regexp)` for lines
+    without new lines:
+
+        '^```$', '^$'         -> ExactTextMatcher (==)
+        '^BEGIN'              -> PrefixTextMatcher (startswith)
+        '^ERROR \\d+'          -> PrefixTextMatcher (startswith and then match)
+        'END$'                -> SuffixTextMatcher (endswith)
+        '-----'               -> ContainsTextMatcher (in)
+        '^\\d{4}-\\d{2}-\\d{2}'  -> AnchoredRegexMatcher (match)
+        anything else         -> RegexMatcher (search)
+    """
+    regexp = build_regexp_if_needed(regexp)
+    if not isinstance(regexp.pattern, str):
+        return RegexMatcher(regexp)
+
+    try:
+        items = _flatten_groups(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception: # pragma: no cover
+        # The parser is a private module. If it ever changes, we just use the regexp.
+        logger.debug('Unable to parse %s', regexp.pattern, exc_info=True)
+        return RegexMatcher(regexp)
+
+    anchored_start = bool(items) and items[0][0] is sre_parse.AT and items[0][1] in _START_ANCHORS
+    if anchored_start:
+        items = items[1:]
+
+    anchored_end = bool(items) and items[-1][0] is sre_parse.AT and items[-1][1] in _END_ANCHORS
+    body = items[:-1] if anchored_end else items
+
+    prefix = []
+    for op, av in body:
+        if op is not sre_parse.LITERAL:
+            break
+        prefix.append(chr(av))
+    prefix = ''.join(prefix)
+    only_literals = len(prefix) == len(body)
+
+    if regexp.flags & re.IGNORECASE:
+        # Literals don't compare the same way so only the anchor can be used
+        return AnchoredRegexMatcher(regexp) if anchored_start else RegexMatcher(regexp)
+
+    if anchored_start:
+        if only_literals and anchored_end:
+            return ExactTextMatcher(prefix)
+        if only_literals:
+            return PrefixTextMatcher(prefix)
+        if prefix:
+            return PrefixTextMatcher(prefix, regexp=regexp)
+        return AnchoredRegexMatcher(regexp)
+
+    if only_literals and anchored_end:
+        return SuffixTextMatcher(prefix)
+    if only_literals:
+        return ContainsTextMatcher(prefix)
+    return RegexMatcher(regexp)
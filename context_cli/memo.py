@@ -0,0 +1,91 @@
+"""
+Module containing the memo of the results of matching repeated lines
+"""
+
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMO_SIZE = 4096
+# Hashing the line and looking it up costs about as much as matching a short regex, so the memo only pays off if a good
+# part of the lines were already seen
+MIN_HIT_RATE = 0.2
+# Number of lookups before the hit rate is checked (and then again after as many lookups)
+WARMUP_LOOKUPS = 10000
+
+
+class LineMemo:
+    """
+    Bounded LRU memo of the result of a function of a line (e.g. whether a regex matches it). Logs repeat the same
+    lines a lot (health checks, identical warnings, the same stack frames) so those are only matched once.
+
+    Every `warmup` lookups, if less than `min_hit_rate` of them were hits, the memo is turned off and the function is
+    called directly from then on.
+    """
+
+    def __init__(self, size=DEFAULT_MEMO_SIZE, min_hit_rate=MIN_HIT_RATE, warmup=WARMUP_LOOKUPS):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.size = size
+        self.min_hit_rate = min_hit_rate
+        self.warmup = warmup
+        self.results = OrderedDict()
+        self.enabled = True
+        self.lookups = 0
+        self.misses = 0
+        # Lookups and misses when the current window of `warmup` lookups started
+        self.window_lookups = 0
+        self.window_misses = 0
+
+    @property
+    def hits(self):
+        return self.lookups - self.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def __repr__(self):
+        state = 'enabled' if self.enabled else 'disabled'
+        return f'LineMemo({state}, {self.hits} hits, {self.misses} misses, {self.hit_rate:.1%} hit rate)'
+
+    def get(self, line, function):
+        """
+        Returns `function(line)`, which is only called if the result for the line isn't in the memo. The same memo must
+        always be used with the same function.
+        """
+
+        if not self.enabled:
+            return function(line)
+
+        # Hits are the common case so they only count the lookup
+        self.lookups += 1
+        results = self.results
+        if line in results:
+            results.move_to_end(line)
+            return results[line]
+
+        result = results[line] = function(line)
+        if len(results) > self.size:
+            results.popitem(last=False)
+        self.misses += 1
+        # A low hit rate means a lot of misses, so it's enough to check it on misses
+        if self.lookups - self.window_lookups >= self.warmup:
+            self.check_hit_rate()
+        return result
+
+    def check_hit_rate(self):
+        """
+        Turns the memo off if the hit rate of the last lookups is too low to pay for the hashing.
+        """
+
+        lookups = self.lookups - self.window_lookups
+        hits = lookups - (self.misses - self.window_misses)
+        if hits < lookups * self.min_hit_rate:
+            logger.debug('Disabling %r', self)
+            self.enabled = False
+            self.results.clear()
+        self.window_lookups = self.lookups
+        self.window_misses = self.misses
@@ -0,0 +1,595 @@
+"""
+Module containing the outputs that receive the contexts coming out of the pipeline
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import re
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from operator import itemgetter
+from pathlib import Path
+
+from .sample import ReservoirSampler
+from .sort import DEFAULT_SORT_MEMORY, ExternalSorter
+from .util import build_regexp_if_needed
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_OPEN_FILES = 128
+DEFAULT_WRITE_BUFFER_SIZE = 128 * 1024
+DEFAULT_BATCH_SIZE = 256
+
+# Rough number of bytes that a context and each one of its lines take in memory besides the text itself
+CONTEXT_OVERHEAD = 200
+LINE_OVERHEAD = 56
+
+
+class Output(ABC):
+    """
+    Abstract Output class. An output receives every file before its contexts go through the pipeline and then each of
+    the contexts that made it through the pipeline.
+    """
+
+    # Maximum number of contexts needed from each file. None means all of them.
+    max_count_per_file = None
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def start_file(self, file):
+        """
+        Called before the contexts of `file` are written.
+        """
+        pass
+
+    @abstractmethod
+    def write(self, context): # pragma: no cover
+        pass
+
+    def close(self):
+        """
+        Called once all of the files have been processed.
+        """
+        pass
+
+
+def format_context(context, line_numbers=False, byte_offset=False):
+    """
+    Returns the text of the context. With `line_numbers`, each line starts with its number and, with `byte_offset`,
+    with its byte offset (the one where the context starts if the context doesn't have the offset of each line).
+    Contexts without positions are returned as they are.
+
+    Example:
+        context: Context(lines=['a', 'b'], line_number=10, byte_offset=1024, byte_offsets=[1024, 1026])
+        returns: '1024:10:a\n1026:11:b'
+    """
+    if not (line_numbers or byte_offset) or context.line_number is None:
+        return str(context)
+
+    if line_numbers and byte_offset:
+        return '\n'.join(
+            f'{offset}:{line_number}:{line}'
+            for offset, line_number, line in zip(get_byte_offsets(context), context.line_numbers, context.lines)
+        )
+    if line_numbers:
+        return '\n'.join(f'{line_number}:{line}' for line_number, line in zip(context.line_numbers, context.lines))
+    return '\n'.join(f'{offset}:{line}' for offset, line in zip(get_byte_offsets(context), context.lines))
+
+
+def get_byte_offsets(context):
+    """
+    Returns the byte offset of each line of the context.
+    """
+    if context.byte_offsets is not None:
+        return context.byte_offsets
+    return itertools.repeat(context.byte_offset, len(context.lines))
+
+
+class TextOutput(Output):
+    """
+    Writes each context as text, with the output delimiter between contexts. See `format_context` for
+    `line_numbers` and `byte_offset`.
+    """
+
+    def __init__(self, stream, output_delimiter='', line_numbers=False, byte_offset=False):
+        super().__init__(stream)
+        self.output_delimiter = output_delimiter
+        self.line_numbers = line_numbers
+        self.byte_offset = byte_offset
+        self.first = True
+
+    def write_delimiter(self):
+        if not self.first and self.output_delimiter:
+            self.stream.write(self.output_delimiter)
+            self.stream.write('\n')
+        self.first = False
+
+    def write(self, context):
+        self.write_delimiter()
+
+        text = format_context(context, line_numbers=self.line_numbers, byte_offset=self.byte_offset)
+        self.stream.write(text)
+        if not text.endswith('\n'):
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def start_context(self):
+        """
+        Starts writing a context in parts: `write_lines` is called with its lines and then `end_context`. The text is
+        the same as with `write` (without line numbers or byte offsets).
+        """
+        self.write_delimiter()
+        self.lines_written = 0
+        self.last_line = None
+
+    def write_lines(self, lines):
+        # The new line after the last line is written once we know whether it's the last line of the context
+        if self.lines_written:
+            self.stream.write('\n')
+        self.stream.write('\n'.join(lines))
+        self.lines_written += len(lines)
+        self.last_line = lines[-1]
+        self.stream.flush()
+
+    def end_context(self):
+        # Like in `write`, the text of a context that ends with an empty line already ends with a new line
+        if self.lines_written < 2 or self.last_line:
+            self.stream.write('\n')
+        self.stream.flush()
+
+
+class JsonLinesOutput(Output):
+    """
+    Writes each context as a JSON object in its own line. The contexts are encoded in batches of `batch_size` and
+    written without flushing the stream after each one.
+
+    Example:
+        {"file":"app.log","line_number":57,"byte_offset":1024,"line_numbers":[57,58],"byte_offsets":[1024,1026],
+         "lines":["a","b"]}
+    """
+
+    def __init__(self, stream, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(stream)
+        self.batch_size = batch_size
+        self.encode = json.JSONEncoder(separators=(',', ':')).encode
+        self.file_name = None
+        self.batch = []
+
+    def start_file(self, file):
+        self.file_name = file.name
+
+    def write(self, context):
+        line_numbers = context.line_numbers
+        self.batch.append({
+            'file': self.file_name,
+            'line_number': context.line_number,
+            'byte_offset': context.byte_offset,
+            'line_numbers': list(line_numbers) if line_numbers is not None else None,
+            'byte_offsets': context.byte_offsets,
+            'lines': context.lines,
+        })
+        if len(self.batch) >= self.batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        if self.batch:
+            self.stream.write('\n'.join(map(self.encode, self.batch)))
+            self.stream.write('\n')
+            self.batch = []
+
+    def close(self):
+        self.write_batch()
+        self.stream.flush()
+
+
+class FramedOutput(Output):
+    """
+    Writes each context as a frame: the size of its text encoded as UTF-8 (a 4 byte big-endian unsigned integer)
+    followed by the text. Readers never need to look for delimiters. The frames are written to the binary buffer of
+    the stream (or to the stream itself if it has none) in batches of about `buffer_size` bytes.
+    """
+
+    def __init__(self, stream, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+        super().__init__(stream)
+        self.binary_stream = getattr(stream, 'buffer', stream)
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.pack_size = struct.Struct('>I').pack
+
+    def write(self, context):
+        data = str(context).encode('utf-8', 'surrogateescape')
+        self.buffer += self.pack_size(len(data))
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.write_buffer()
+
+    def write_buffer(self):
+        if self.buffer:
+            self.binary_stream.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.write_buffer()
+        self.binary_stream.flush()
+
+
+class CountOutput(Output):
+    """
+    Counts the contexts of each file without building their text. When there's more than one file, the count of each
+    file is written followed by the total.
+
+    Example:
+        file1.txt:3
+        file2.txt:0
+        total:3
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.counts = OrderedDict()
+        self.current_name = None
+
+    def start_file(self, file):
+        self.current_name = file.name
+        self.counts.setdefault(self.current_name, 0)
+
+    def write(self, context):
+        self.counts[self.current_name] += 1
+
+    def close(self):
+        total = sum(self.counts.values())
+        if len(self.counts) > 1:
+            for name, count in self.counts.items():
+                self.stream.write(f'{name}:{count}\n')
+            self.stream.write(f'total:{total}\n')
+        else:
+            self.stream.write(f'{total}\n')
+        self.stream.flush()
+
+
+class FilesWithMatchesOutput(Output):
+    """
+    Writes the name of each file that has at least one context. Only the first context of each file is needed, so the
+    rest of the file is never read.
+    """
+
+    max_count_per_file = 1
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.current_name = None
+
+    def start_file(self, file):
+        self.current_name = file.name
+
+    def write(self, context):
+        self.stream.write(self.current_name)
+        self.stream.write('\n')
+        self.stream.flush()
+
+
+def get_context_key(regexp, context):
+    """
+    Returns the first capture group (or the whole match if the regexp has no groups) of the first line of the context
+    that matches the regexp or None if no line matches.
+    """
+    for line in context.lines:
+        match = regexp.search(line)
+        if match:
+            key = match.group(1) if regexp.groups else match.group(0)
+            if key is not None:
+                return key
+    return None
+
+
+def parse_number(text):
+    """
+    Returns `text` as an int or a float or None if it isn't a number.
+    """
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+class GroupStats:
+    """
+    Aggregates of the contexts that have the same key. The numeric values are optional.
+    """
+
+    __slots__ = ('count', 'values', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.values = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value=None):
+        self.count += 1
+        if value is None:
+            return
+        self.values += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+class GroupByOutput(Output):
+    """
+    Groups the contexts by the key captured by `regexp` (see `get_context_key`) and writes a summary once all of the
+    files have been processed. Only the stats of each key are kept in memory. The groups are written by descending
+    count. When there's a `value_regexp`, the sum, min and max of the number it captures are also written (`-` when
+    none of the contexts of the group had one).
+
+    Example:
+        regexp: 'status=(\\d+)'
+        value_regexp: 'took=(\\d+)ms'
+        output:
+            count	sum	min	max	key
+            3	45	5	30	200
+            1	120	120	120	500
+    """
+
+    def __init__(self, stream, regexp, value_regexp=None):
+        super().__init__(stream)
+        self.regexp = build_regexp_if_needed(regexp)
+        self.value_regexp = build_regexp_if_needed(value_regexp) if value_regexp is not None else None
+        self.groups = {}
+
+    def write(self, context):
+        key = get_context_key(self.regexp, context)
+        if key is None:
+            return
+
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = GroupStats()
+
+        value = None
+        if self.value_regexp is not None:
+            text = get_context_key(self.value_regexp, context)
+            if text is not None:
+                value = parse_number(text)
+        stats.add(value)
+
+    def close(self):
+        groups = sorted(self.groups.items(), key=lambda item: (-item[1].count, item[0]))
+        if self.value_regexp is None:
+            self.stream.write('count\tkey\n')
+            for key, stats in groups:
+                self.stream.write(f'{stats.count}\t{key}\n')
+        else:
+            self.stream.write('count\tsum\tmin\tmax\tkey\n')
+            for key, stats in groups:
+                if stats.values:
+                    self.stream.write(f'{stats.count}\t{stats.sum}\t{stats.min}\t{stats.max}\t{key}\n')
+                else:
+                    self.stream.write(f'{stats.count}\t-\t-\t-\t{key}\n')
+        self.stream.flush()
+
+
+class FileHandlePool:
+    """
+    Keeps at most `max_open_files` files open for writing. When another one is needed, the least recently used one is
+    closed. Files are truncated the first time they're opened and appended to when they're opened again.
+    """
+
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_FILES, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.files = OrderedDict()
+        self.opened_paths = set()
+
+    def get(self, path):
+        file = self.files.get(path)
+        if file is not None:
+            self.files.move_to_end(path)
+            return file
+
+        if len(self.files) >= self.max_open_files:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+
+        mode = 'a' if path in self.opened_paths else 'w'
+        file = open(path, mode, buffering=self.buffer_size)
+        self.opened_paths.add(path)
+        self.files[path] = file
+        return file
+
+    def close(self):
+        while self.files:
+            _, file = self.files.popitem()
+            file.close()
+
+
+def get_split_file_name(key):
+    """
+    Returns a file name for the `key` that can't escape the output directory.
+    """
+    name = re.sub(r'[^\w.-]', '_', key)
+    if name in ('', '.', '..'):
+        name = '_' + name
+    return name
+
+
+class SplitOutput(Output):
+    """
+    Writes each context to a file in `out_dir` named after the first capture group (or the whole match if there are
+    no groups) of the first line that matches the regexp. Contexts without a match aren't written.
+
+    Example:
+        regexp: 'tenant=(\\w+)'
+        context: 'request tenant=acme took 3ms'
+        file: out_dir/acme
+    """
+
+    def __init__(self, out_dir, regexp, output_delimiter='', max_open_files=DEFAULT_MAX_OPEN_FILES, line_numbers=False,
+                 byte_offset=False):
+        super().__init__(stream=None)
+        self.out_dir = Path(out_dir)
+        self.regexp = build_regexp_if_needed(regexp)
+        self.output_delimiter = output_delimiter
+        self.line_numbers = line_numbers
+        self.byte_offset = byte_offset
+        self.pool = FileHandlePool(max_open_files=max_open_files)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    def write(self, context):
+        key = get_context_key(self.regexp, context)
+        if key is None:
+            return
+
+        path = self.out_dir / get_split_file_name(key)
+        first = path not in self.pool.opened_paths
+        stream = self.pool.get(path)
+
+        if not first and self.output_delimiter:
+            stream.write(self.output_delimiter)
+            stream.write('\n')
+
+        text = format_context(context, line_numbers=self.line_numbers, byte_offset=self.byte_offset)
+        stream.write(text)
+        if not text.endswith('\n'):
+            stream.write('\n')
+
+    def close(self):
+        self.pool.close()
+
+
+def get_context_size(context):
+    """
+    Returns an estimate of the memory used by the context.
+    """
+    lines = context.lines
+    return CONTEXT_OVERHEAD + LINE_OVERHEAD * len(lines) + sum(map(len, lines))
+
+
+# What `start_file` receives when the file itself is gone
+OutputFile = namedtuple('OutputFile', ['name'])
+
+
+class OutputWrapper(Output):
+    """
+    Abstract class for the outputs that hold on to the contexts and write them to another `output` at the end. The name
+    of the file of each context is kept with it so `output` gets the right file.
+    """
+
+    def __init__(self, output):
+        super().__init__(output.stream)
+        self.output = output
+        self.file_name = None
+        self.output_file_name = None
+
+    def start_file(self, file):
+        self.file_name = file.name
+
+    def write_to_output(self, file_name, context):
+        if file_name != self.output_file_name:
+            self.output.start_file(OutputFile(file_name))
+            self.output_file_name = file_name
+        self.output.write(context)
+
+    def close(self):
+        self.output.close()
+
+
+class SortedOutput(OutputWrapper):
+    """
+    Sorts the contexts by the key captured by `regexp` (see `get_context_key`) and writes them to `output` once all of
+    the files have been processed. Keys are compared as text or, with `numeric`, as numbers. Contexts without a key
+    go first (last when `reverse`) and contexts with the same key keep their order. At most about `memory` bytes of
+    contexts are kept in memory, the rest are spilled to temporary files (see `ExternalSorter`).
+    """
+
+    def __init__(self, output, regexp, numeric=False, reverse=False, memory=DEFAULT_SORT_MEMORY):
+        super().__init__(output)
+        self.regexp = build_regexp_if_needed(regexp)
+        self.numeric = numeric
+        self.sorter = ExternalSorter(key=itemgetter(0), memory=memory, reverse=reverse)
+
+    def get_sort_key(self, context):
+        key = get_context_key(self.regexp, context)
+        if key is not None and self.numeric:
+            key = parse_number(key)
+        # Tuples so that missing keys can be compared with the rest
+        return (0,) if key is None else (1, key)
+
+    def write(self, context):
+        self.sorter.add((self.get_sort_key(context), self.file_name, context), get_context_size(context))
+
+    def close(self):
+        try:
+            for _, file_name, context in self.sorter:
+                self.write_to_output(file_name, context)
+        finally:
+            self.sorter.close()
+        super().close()
+
+
+class TopOutput(OutputWrapper):
+    """
+    Keeps the `k` contexts with the largest (or, when `largest` is False, the smallest) number captured by `regexp`
+    (see `get_context_key`) in a heap and writes them to `output`, in order, once all of the files have been processed.
+    Contexts without a number are skipped. When several contexts have the same number, the first ones are kept.
+    """
+
+    def __init__(self, output, regexp, k, largest=True):
+        super().__init__(output)
+        self.regexp = build_regexp_if_needed(regexp)
+        self.k = k
+        self.largest = largest
+        # The heap's first item is the one that goes next. Its key is (value, -index) for the largest contexts and
+        # (-value, -index) for the smallest ones.
+        self.heap = []
+        self.index = 0
+
+    def write(self, context):
+        key = get_context_key(self.regexp, context)
+        value = parse_number(key) if key is not None else None
+        if value is None:
+            return
+
+        self.index += 1
+        item = (value if self.largest else -value, -self.index, self.file_name, context)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        elif item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def close(self):
+        for _, _, file_name, context in sorted(self.heap, key=lambda item: item[:2], reverse=True):
+            self.write_to_output(file_name, context)
+        self.heap = []
+        super().close()
+
+
+class SampleOutput(OutputWrapper):
+    """
+    Writes a uniform random sample of `k` of the contexts to `output`, in their original order, once all of the files
+    have been processed. Only the `k` contexts of the sample are kept in memory.
+    """
+
+    def __init__(self, output, k, rng):
+        super().__init__(output)
+        self.sampler = ReservoirSampler(k, rng)
+
+    def write(self, context):
+        self.sampler.add((self.file_name, context))
+
+    def close(self):
+        for file_name, context in self.sampler.items:
+            self.write_to_output(file_name, context)
+        super().close()
@@ -0,0 +1,257 @@
+"""
+Module containing the reading ahead of files in background threads: the next files while the current one is read and
+the next blocks of a file while the current one is matched
+"""
+
+import io
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFETCH_MEMORY = 64 * 1024 * 1024
+DEFAULT_READ_AHEAD_BLOCK_SIZE = 1024 * 1024
+# Number of blocks read ahead before the reader thread waits
+DEFAULT_MAX_PENDING_BLOCKS = 4
+
+
+class PrefetchBudget:
+    """
+    Number of bytes that the prefetched files can hold together. Each file reserves its part before reading it and
+    releases it once it was read (or the file is closed), so the data that was read ahead never goes over `size`, even
+    if more files than planned are opened ahead (e.g. the files of a directory while the paths after it are prefetched).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Reserves up to `size` bytes and returns how many were reserved (0 if the budget is used up).
+        """
+        with self.lock:
+            size = max(min(size, self.size - self.used), 0)
+            self.used += size
+            return size
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+
+class PrefetchedRawFile(io.RawIOBase):
+    """
+    Raw binary file that returns the `data` that was already read from the start of `raw` and then continues reading
+    `raw`. If all of the file was read (`eof`), `raw` is closed right away so it doesn't hold on to a file descriptor.
+    Once `data` was read (or the file is closed), its size is given back to the `budget`, if any.
+    """
+
+    def __init__(self, raw, data, eof=False, budget=None):
+        super().__init__()
+        self.raw = raw
+        self.name = raw.name
+        self.data = memoryview(data)
+        self.position = 0
+        self.eof = eof
+        self.budget = budget
+        if eof:
+            raw.close()
+
+    def release_data(self):
+        # Let go of the memory as soon as it's read
+        size = len(self.data)
+        self.data = memoryview(b'')
+        self.position = 0
+        if self.budget is not None:
+            self.budget.release(size)
+            self.budget = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position < len(self.data):
+            size = min(len(buffer), len(self.data) - self.position)
+            buffer[:size] = self.data[self.position:self.position + size]
+            self.position += size
+            if self.position == len(self.data):
+                self.release_data()
+                # Fill the rest of the buffer so the data is never returned in smaller reads than without prefetching
+                if size < len(buffer) and not self.eof:
+                    size += self.raw.readinto(memoryview(buffer)[size:]) or 0
+            return size
+        if self.eof:
+            return 0
+        return self.raw.readinto(buffer)
+
+    def close(self):
+        self.raw.close()
+        self.release_data()
+        super().close()
+
+
+def open_prefetched(path, size, budget=None):
+    """
+    Opens the file at `path` for reading text (like `open(path)`) and reads up to `size` bytes of it right away, so
+    reading it later doesn't wait on the storage until those bytes are used. With a `budget` (see PrefetchBudget), only
+    the bytes it has left are read.
+    """
+
+    raw = open(path, 'rb', buffering=0)
+    if budget is not None:
+        size = budget.reserve(size)
+    try:
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = raw.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+    except BaseException:
+        raw.close()
+        if budget is not None:
+            budget.release(size)
+        raise
+
+    if budget is not None:
+        budget.release(remaining)
+    data = b''.join(chunks)
+    # A file that's smaller than `size` is read completely
+    return io.TextIOWrapper(io.BufferedReader(PrefetchedRawFile(raw, data, eof=remaining > 0, budget=budget)))
+
+
+def map_ahead(function, items, n, discard=None, executor=None):
+    """
+    Like `map(function, items)`, but up to `n` results after the one that was returned are computed in a thread pool
+    (`executor`, or a new one with `n` threads), so their latency overlaps with the work done on the current one.
+    Exceptions are raised when their result is reached. If the caller stops early, `discard` is called with the
+    results that were already computed (e.g. to close them).
+    """
+
+    if n < 1:
+        yield from map(function, items)
+        return
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            yield from map_ahead(function, items, n, discard=discard, executor=executor)
+        return
+
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) > n:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            if future.cancel():
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            if discard is not None:
+                discard(result)
+
+
+class ReadAheadRawFile(io.RawIOBase):
+    """
+    Raw binary file that returns the bytes of the text `file`, read by a background thread in blocks of `block_size`.
+    At most `max_pending_blocks` blocks wait to be read, so the file (or pipe) is read while the previous block is
+    being matched but memory doesn't depend on the size of the file.
+
+    Closing it closes `file`. If the thread is in the middle of a read, it closes `file` once the read returns instead,
+    so closing never waits on a slow source.
+    """
+
+    def __init__(self, file, block_size=DEFAULT_READ_AHEAD_BLOCK_SIZE, max_pending_blocks=DEFAULT_MAX_PENDING_BLOCKS):
+        super().__init__()
+        self.file = file
+        self.name = getattr(file, 'name', None)
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=max_pending_blocks)
+        self.block = memoryview(b'')
+        self.eof = False
+        self.lock = threading.Lock()
+        self.reading = True
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read_blocks, daemon=True)
+        self.thread.start()
+
+    def read_blocks(self):
+        buffer = self.file.buffer
+        read = getattr(buffer, 'read1', buffer.read)
+        try:
+            while not self.stopped:
+                data = read(self.block_size)
+                self.blocks.put(data)
+                if not data:
+                    break
+        except BaseException as e:
+            self.blocks.put(e)
+        finally:
+            with self.lock:
+                self.reading = False
+                if self.stopped:
+                    self.file.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.block:
+            if self.eof:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                self.eof = True
+                raise block
+            if not block:
+                self.eof = True
+                return 0
+            self.block = memoryview(block)
+
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            with self.lock:
+                self.stopped = True
+                if not self.reading:
+                    self.file.close()
+            # Unblock the thread if it's waiting for space in the queue
+            while True:
+                try:
+                    self.blocks.get_nowait()
+                except queue.Empty:
+                    break
+            self.block = memoryview(b'')
+        super().close()
+
+
+def read_ahead(file, block_size=DEFAULT_READ_AHEAD_BLOCK_SIZE, max_pending_blocks=DEFAULT_MAX_PENDING_BLOCKS):
+    """
+    Returns a text file with the same text, encoding and errors as `file` that is read ahead by a background thread
+    (see ReadAheadRawFile). Files that aren't backed by a binary buffer are returned as they are.
+    """
+
+    encoding = getattr(file, 'encoding', None)
+    if getattr(file, 'buffer', None) is None or not isinstance(encoding, str):
+        return file
+
+    raw = ReadAheadRawFile(file, block_size=block_size, max_pending_blocks=max_pending_blocks)
+    return io.TextIOWrapper(io.BufferedReader(raw), encoding=encoding, errors=file.errors)
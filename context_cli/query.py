@@ -0,0 +1,282 @@
+"""
+Module containing the --query expressions: the context filters combined with and, or, not and parentheses
+
+    (contains "timeout" or contains regex "retry [0-9]+") and not matches "OK"
+
+The expression is parsed once and compiled into a function that tells whether a context matches it.
+"""
+
+import logging
+import re
+
+from .filter import (
+    ContainsRegexContextFilter, ContainsTextContextFilter, MatchesRegexContextFilter, MatchesTextContextFilter,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Estimated cost of checking a context with each kind of predicate. Literals are a lot cheaper than regexes, and the
+# regexes that have a required literal skip most lines without running.
+TEXT_COST = 1
+REGEX_WITH_LITERAL_COST = 4
+REGEX_COST = 16
+
+TOKEN_REGEXP = re.compile(r'''
+    \s*(?:
+        (?P<paren>[()])
+        | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+        | (?P<word>[^\s()"']+)
+    )
+''', re.VERBOSE | re.DOTALL)
+
+PREDICATE_FILTERS = {
+    ('contains', 'text'): ContainsTextContextFilter,
+    ('contains', 'regex'): ContainsRegexContextFilter,
+    ('matches', 'text'): MatchesTextContextFilter,
+    ('matches', 'regex'): MatchesRegexContextFilter,
+}
+
+# How each operator checks a line with a regex, which is the first part of the key of its memo (see `compile`)
+REGEX_METHODS = {'contains': 'search', 'matches': 'fullmatch'}
+
+
+class QueryError(ValueError):
+    """
+    Raised when a query can't be parsed.
+    """
+
+    def __init__(self, message, position):
+        super().__init__(f'{message} at position {position}')
+        self.position = position
+
+
+class Predicate:
+    """
+    Leaf of a query: one of the context filters. The regexes have a `memo_key`, (method, regex), to find their memo.
+    """
+
+    def __init__(self, operator, kind, value):
+        self.operator = operator
+        self.kind = kind
+        self.value = value
+        self.filter = PREDICATE_FILTERS[operator, kind](None, value)
+        self.memo_key = (REGEX_METHODS[operator], value) if kind == 'regex' else None
+        if kind == 'text':
+            self.cost = TEXT_COST
+        elif self.filter.literal is not None:
+            self.cost = REGEX_WITH_LITERAL_COST
+        else:
+            self.cost = REGEX_COST
+
+    def __repr__(self):
+        return f'{self.operator} {self.kind} {self.value!r}'
+
+    def iter_predicates(self):
+        yield self
+
+    def compile(self, memos=None):
+        """
+        Returns the function that checks a context. `memos` is a dict from the `memo_key` of the regexes to their
+        LineMemo.
+        """
+        memo = memos.get(self.memo_key) if memos and self.memo_key else None
+        if memo is None:
+            return self.filter.is_context_valid
+        return PREDICATE_FILTERS[self.operator, self.kind](None, self.value, memo=memo).is_context_valid
+
+
+class Not:
+    """
+    Matches when the operand doesn't.
+    """
+
+    def __init__(self, operand):
+        self.operand = operand
+        self.cost = operand.cost
+
+    def __repr__(self):
+        return f'not {self.operand!r}'
+
+    def iter_predicates(self):
+        return self.operand.iter_predicates()
+
+    def compile(self, memos=None):
+        function = self.operand.compile(memos)
+        return lambda context: not function(context)
+
+
+class BooleanOperator:
+    """
+    Abstract class of `and` and `or`. The operands are sorted by cost so the cheapest ones are checked first, which is
+    fine because checking them has no side effects.
+    """
+
+    def __init__(self, operands):
+        self.operands = sorted(flatten(type(self), operands), key=lambda operand: operand.cost)
+        self.cost = sum(operand.cost for operand in self.operands)
+
+    def __repr__(self):
+        return '(' + f' {type(self).__name__.lower()} '.join(map(repr, self.operands)) + ')'
+
+    def iter_predicates(self):
+        for operand in self.operands:
+            yield from operand.iter_predicates()
+
+
+class And(BooleanOperator):
+    """
+    Matches when all of the operands match. The rest are skipped as soon as one doesn't match.
+    """
+
+    def compile(self, memos=None):
+        functions = [operand.compile(memos) for operand in self.operands]
+        return lambda context: all(function(context) for function in functions)
+
+
+class Or(BooleanOperator):
+    """
+    Matches when any of the operands matches. The rest are skipped as soon as one matches.
+    """
+
+    def compile(self, memos=None):
+        functions = [operand.compile(memos) for operand in self.operands]
+        return lambda context: any(function(context) for function in functions)
+
+
+def flatten(cls, operands):
+    """
+    Returns the operands with the ones of the nested `cls` nodes, so `a and (b and c)` is checked as `a and b and c`.
+    """
+    for operand in operands:
+        if type(operand) is cls:
+            yield from operand.operands
+        else:
+            yield operand
+
+
+def tokenize(text):
+    """
+    Returns a list of (kind, value, position) tuples. Strings are returned without their quotes. A backslash before a
+    quote or another backslash escapes it, the rest of the backslashes are kept (so regexes don't need to be escaped
+    twice).
+    """
+
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_REGEXP.match(text, position)
+        if not match:
+            raise QueryError('Unterminated string', len(text) - len(text[position:].lstrip()))
+
+        start = match.start(match.lastgroup)
+        value = match.group(match.lastgroup)
+        if match.lastgroup == 'string':
+            value = re.sub(r'\\([\\\'"])', r'\1', value[1:-1])
+        elif match.lastgroup == 'word':
+            value = value.lower()
+        tokens.append((match.lastgroup, value, start))
+        position = match.end()
+
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser of the grammar (`not` binds tighter than `and`, which binds tighter than `or`):
+
+        query     := or
+        or        := and ('or' and)*
+        and       := not ('and' not)*
+        not       := 'not' not | primary
+        primary   := '(' or ')' | predicate
+        predicate := ('contains' | 'matches') ['text' | 'regex'] STRING
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.index = 0
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None, None, len(self.text)
+
+    def next(self):
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def accept_word(self, *words):
+        kind, value, _ = self.peek()
+        if kind == 'word' and value in words:
+            self.index += 1
+            return value
+        return None
+
+    def parse(self):
+        node = self.parse_or()
+        kind, value, position = self.peek()
+        if kind is not None:
+            raise QueryError(f'Unexpected {value!r}', position)
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.accept_word('or'):
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.accept_word('and'):
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_not(self):
+        if self.accept_word('not'):
+            return Not(self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value, position = self.peek()
+        if kind == 'paren' and value == '(':
+            self.index += 1
+            node = self.parse_or()
+            kind, value, position = self.next()
+            if kind != 'paren' or value != ')':
+                raise QueryError("Expected ')'", position)
+            return node
+
+        operator = self.accept_word('contains', 'matches')
+        if operator is None:
+            raise QueryError('Expected contains, matches, not or (' if kind else 'Unexpected end of query', position)
+
+        predicate_kind = self.accept_word('text', 'regex') or 'text'
+        kind, value, position = self.next()
+        if kind != 'string':
+            raise QueryError('Expected a quoted string', position)
+
+        try:
+            return Predicate(operator, predicate_kind, value)
+        except re.error as e:
+            raise QueryError(f'Invalid regex {value!r} ({e.msg})', position)
+
+
+def parse_query(text):
+    """
+    Parses the query and returns its tree.
+    """
+    return Parser(text).parse()
+
+
+def compile_query(text, memos=None):
+    """
+    Returns a function that receives a context and returns whether it matches the query. `memos` has the LineMemo of
+    the regexes (see `Predicate.compile`).
+    """
+    node = parse_query(text)
+    logger.debug('Compiled query %r', node)
+    return node.compile(memos)
@@ -0,0 +1,85 @@
+"""
+Module containing the samplers used to pick random contexts
+"""
+
+import logging
+import math
+
+
+logger = logging.getLogger(__name__)
+
+
+def random_open_interval(rng):
+    """
+    Returns a random number in (0, 1). `random()` can return 0, which has no logarithm.
+    """
+    while True:
+        number = rng.random()
+        if number > 0:
+            return number
+
+
+def random_skip(rng, rate):
+    """
+    Returns how many items are rejected before the next one is accepted when each one is accepted with probability
+    `rate` (a geometric distribution). This only needs one random number per accepted item.
+    """
+    return math.floor(math.log(random_open_interval(rng)) / math.log1p(-rate))
+
+
+class BernoulliSampler:
+    """
+    Accepts each item with probability `rate`, independently of the rest. Items don't need to be kept, so it works on
+    streams of any size.
+    """
+
+    def __init__(self, rate, rng):
+        if not 0 < rate < 1:
+            raise ValueError('rate must be between 0 and 1')
+        self.rate = rate
+        self.rng = rng
+        self.skip = random_skip(rng, rate)
+
+    def accept(self):
+        if self.skip:
+            self.skip -= 1
+            return False
+        self.skip = random_skip(self.rng, self.rate)
+        return True
+
+
+class ReservoirSampler:
+    """
+    Keeps a uniform random sample of `k` of the items added to it in O(k) memory (Algorithm L). The sample is returned
+    in the order the items were added.
+    """
+
+    def __init__(self, k, rng):
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        self.k = k
+        self.rng = rng
+        self.reservoir = []
+        self.count = 0
+        self.weight = math.exp(math.log(random_open_interval(rng)) / k)
+        self.next_index = k + self.get_skip()
+
+    def get_skip(self):
+        return math.floor(math.log(random_open_interval(self.rng)) / math.log1p(-self.weight))
+
+    def add(self, item):
+        index = self.count
+        self.count += 1
+
+        if index < self.k:
+            self.reservoir.append((index, item))
+            return
+
+        if index == self.next_index:
+            self.reservoir[self.rng.randrange(self.k)] = (index, item)
+            self.weight *= math.exp(math.log(random_open_interval(self.rng)) / self.k)
+            self.next_index += self.get_skip() + 1
+
+    @property
+    def items(self):
+        return [item for _, item in sorted(self.reservoir, key=lambda indexed_item: indexed_item[0])]
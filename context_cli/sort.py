@@ -0,0 +1,95 @@
+"""
+Module containing the external merge sort used to sort more contexts than fit in memory
+"""
+
+import heapq
+import logging
+import pickle
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SORT_MEMORY = 256 * 1024 * 1024
+# Maximum number of runs merged at the same time (each one is an open file)
+DEFAULT_MAX_MERGE_RUNS = 64
+
+
+class SortRun:
+    """
+    Sorted items spilled to a temporary file. The items are pickled one after the other so they can be read back
+    one at a time.
+    """
+
+    def __init__(self, items):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        for item in items:
+            pickle.dump(item, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.size += 1
+        self.file.flush()
+
+    def __iter__(self):
+        self.file.seek(0)
+        load = pickle.load
+        for _ in range(self.size):
+            yield load(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+class ExternalSorter:
+    """
+    Sorts items by `key` keeping at most about `memory` bytes of them in memory. `add` receives each item with an
+    estimate of its size. Once the items in memory go over the budget, they're sorted and spilled to a temporary file
+    (a run). Iterating returns all of the items in order by merging the runs (and the items still in memory) with a
+    k-way heap merge. The sort is stable.
+    """
+
+    def __init__(self, key, memory=DEFAULT_SORT_MEMORY, reverse=False, max_merge_runs=DEFAULT_MAX_MERGE_RUNS):
+        if max_merge_runs < 2:
+            raise ValueError('max_merge_runs must be at least 2')
+        self.key = key
+        self.memory = memory
+        self.reverse = reverse
+        self.max_merge_runs = max_merge_runs
+        self.items = []
+        self.items_size = 0
+        self.runs = []
+
+    def add(self, item, size):
+        self.items.append(item)
+        self.items_size += size
+        if self.items_size >= self.memory:
+            self.spill()
+
+    def spill(self):
+        self.items.sort(key=self.key, reverse=self.reverse)
+        self.runs.append(SortRun(self.items))
+        logger.debug('Spilled run %d with %d items', len(self.runs), len(self.items))
+        self.items = []
+        self.items_size = 0
+
+    def merge(self, iterables):
+        return heapq.merge(*iterables, key=self.key, reverse=self.reverse)
+
+    def __iter__(self):
+        self.items.sort(key=self.key, reverse=self.reverse)
+
+        # Too many runs would mean too many open files, so we merge the oldest ones into bigger runs first. The merged
+        # run replaces them at the front, which keeps the sort stable.
+        while len(self.runs) + 1 > self.max_merge_runs:
+            runs = self.runs[:self.max_merge_runs]
+            merged = SortRun(self.merge(runs))
+            for run in runs:
+                run.close()
+            self.runs[:self.max_merge_runs] = [merged]
+
+        yield from self.merge(self.runs + [self.items])
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.items = []
@@ -0,0 +1,117 @@
+"""
+Module to read a file once and feed it to several consumers
+"""
+
+import logging
+import queue
+import threading
+
+from .context import DEFAULT_CHUNK_SIZE, get_chunk_reader
+
+
+logger = logging.getLogger(__name__)
+
+# Number of chunks that a consumer can fall behind before reading the file blocks
+DEFAULT_MAX_PENDING_CHUNKS = 16
+
+
+class TeeFile:
+    """
+    File-like object that returns the chunks of text read from the original file by `tee_file`. It has the same name,
+    encoding and errors as the original file and, like a text file, `newlines` has the kinds of new lines translated so
+    far, so the positions are the same as when the original file is read directly.
+    """
+
+    def __init__(self, name, max_pending_chunks=DEFAULT_MAX_PENDING_CHUNKS, encoding=None, errors=None, decoder=None):
+        self.name = name
+        self.encoding = encoding
+        self.errors = errors
+        self.decoder = decoder
+        self.chunks = queue.Queue(maxsize=max_pending_chunks)
+        self.done = False
+        self.eof = False
+
+    @property
+    def newlines(self):
+        return getattr(self.decoder, 'newlines', None)
+
+    def read(self, size=-1):
+        if self.eof:
+            return ''
+        chunk = self.chunks.get()
+        if not chunk:
+            self.eof = True
+        return chunk
+
+    def close(self):
+        """
+        Called by the consumer once it doesn't need more chunks. Reading the file stops once all of the consumers are
+        done.
+        """
+        self.done = True
+        # Unblock `tee_file` if it's waiting for space in the queue
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                break
+
+
+def tee_file(file, consumers, chunk_size=DEFAULT_CHUNK_SIZE, max_pending_chunks=DEFAULT_MAX_PENDING_CHUNKS):
+    """
+    Reads (and decodes) `file` once and calls each consumer, in its own thread, with a TeeFile that returns the same
+    text. The queues between the reader and the consumers are bounded so memory doesn't depend on the file size. If a
+    consumer raises an exception, it is raised here once all of the consumers are done.
+
+    If the file can't be decoded, the consumers get the end of the file there and the UnicodeDecodeError is raised once
+    they're done.
+    """
+
+    read_chunk = get_chunk_reader(file, chunk_size)
+    tee_files = [
+        TeeFile(
+            file.name, max_pending_chunks=max_pending_chunks, encoding=getattr(file, 'encoding', None),
+            errors=getattr(file, 'errors', None), decoder=getattr(read_chunk, 'decoder', None),
+        )
+        for _ in consumers
+    ]
+    errors = []
+
+    def run(consumer, consumer_file):
+        try:
+            consumer(consumer_file)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            consumer_file.close()
+
+    threads = [
+        threading.Thread(target=run, args=(consumer, consumer_file), daemon=True)
+        for consumer, consumer_file in zip(consumers, tee_files)
+    ]
+    for thread in threads:
+        thread.start()
+
+    decode_error = None
+    while True:
+        pending = [consumer_file for consumer_file in tee_files if not consumer_file.done]
+        if not pending:
+            break
+
+        try:
+            chunk = read_chunk()
+        except UnicodeDecodeError as e:
+            decode_error = e
+            chunk = ''
+        for consumer_file in pending:
+            consumer_file.chunks.put(chunk)
+        if not chunk:
+            break
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    if decode_error is not None:
+        raise decode_error
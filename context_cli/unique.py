@@ -0,0 +1,91 @@
+"""
+Module containing the sets used to drop repeated contexts
+"""
+
+import hashlib
+import logging
+import math
+
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+DEFAULT_BLOOM_CAPACITY = 1000000
+
+
+def get_context_digest(context, ignore_regexps=()):
+    """
+    Returns a digest of the lines of the context. The parts of the text that match any of the `ignore_regexps` (e.g.
+    timestamps) are removed first so contexts that only differ in those parts have the same digest.
+    """
+    lines = context.lines
+    for regexp in ignore_regexps:
+        # Like the rest of the regexes, they're matched against each line
+        lines = [regexp.sub('', line) for line in lines]
+    text = '\n'.join(lines)
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=DIGEST_SIZE).digest()
+
+
+class DigestSet:
+    """
+    Exact set of digests. Only the digests are kept so memory grows with the number of different contexts but not
+    with their size.
+    """
+
+    def __init__(self):
+        self.digests = set()
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def add(self, digest):
+        """
+        Adds the digest and returns True if it wasn't in the set.
+        """
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        return True
+
+
+class BloomFilter:
+    """
+    Fixed-size set of digests. It never forgets a digest but, once it has `capacity` digests, about `error_rate` of the
+    digests that were never added are reported as already added. Its size only depends on `capacity` and `error_rate`.
+    """
+
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=0.001):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def get_positions(self, digest):
+        # Double hashing: the two halves of the digest are enough to build `num_hashes` independent positions
+        half = len(digest) // 2
+        first = int.from_bytes(digest[:half], 'little')
+        second = int.from_bytes(digest[half:], 'little') | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(digest))
+
+    def add(self, digest):
+        """
+        Adds the digest and returns True if it (probably) wasn't in the filter. False is returned for digests that
+        were added before and, sometimes, for new ones.
+        """
+        bits = self.bits
+        added = False
+        for position in self.get_positions(digest):
+            index = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                added = True
+        return added
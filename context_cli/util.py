@@ -2,6 +2,11 @@ import logging
 import json
 import re
 
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError: # pragma: no cover
+    import sre_parse
+
 logger = logging.getLogger(__name__)
 
 
@@ -95,3 +100,84 @@ def build_regexp_if_needed(maybe_regexp):
         return maybe_regexp
     return re.compile(maybe_regexp)
 
+
+_REPEAT_OPCODES = {
+    sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', sre_parse.MAX_REPEAT),
+}
+
+
+def _flush_literal(current, literals):
+    if current:
+        literals.append(''.join(current))
+        current.clear()
+
+
+def _collect_required_literals(items, literals, current):
+    """
+    Walks the parsed regex `items`. `current` holds the characters of the literal that is being built and `literals`
+    the literals that are complete.
+    """
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+        elif op is sre_parse.AT:
+            # Anchors (^, $, \b...) are zero-width so the characters around them are still contiguous.
+            continue
+        elif op is sre_parse.SUBPATTERN:
+            add_flags, sub_items = av[1], av[-1]
+            if add_flags & re.IGNORECASE:
+                _flush_literal(current, literals)
+            else:
+                _collect_required_literals(sub_items, literals, current)
+        elif op in _REPEAT_OPCODES:
+            min_repeat, max_repeat, sub_items = av
+            if min_repeat == max_repeat == 1:
+                _collect_required_literals(sub_items, literals, current)
+                continue
+
+            _flush_literal(current, literals)
+            if min_repeat >= 1:
+                sub_current = []
+                _collect_required_literals(sub_items, literals, sub_current)
+                _flush_literal(sub_current, literals)
+        else:
+            # Character classes, alternations, lookarounds, backreferences... Anything that's not a literal ends the
+            # current one.
+            _flush_literal(current, literals)
+
+
+def get_required_literals(regexp):
+    """
+    Returns the literals that every match of `regexp` contains. Lines that don't contain all of them can't match the
+    regexp. Case insensitive regexps don't have required literals.
+
+    Example:
+        regexp: 'ERROR\\s+\\d+ (in|at) user_id=(\\d+)'
+        returns: ['ERROR', ' ', ' user_id=']
+    """
+    regexp = build_regexp_if_needed(regexp)
+    if not isinstance(regexp.pattern, str) or regexp.flags & re.IGNORECASE:
+        return []
+
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception: # pragma: no cover
+        # The parser is a private module. If it ever changes, we just don't prefilter.
+        logger.debug('Unable to parse %s', regexp.pattern, exc_info=True)
+        return []
+
+    literals = []
+    current = []
+    _collect_required_literals(parsed, literals, current)
+    _flush_literal(current, literals)
+    return literals
+
+
+def get_required_literal(regexp):
+    """
+    Returns the longest literal that every match of `regexp` contains or None if there is none.
+    """
+    literals = get_required_literals(regexp)
+    if not literals:
+        return None
+    return max(literals, key=len)
@@ -0,0 +1,344 @@
+"""
+Module containing the NumPy engine of the context factories (--engine numpy)
+
+The file is read in large blocks of bytes. The new lines of a whole block are found with a single vectorized
+comparison and the delimiter lines are found by comparing the bytes at the start (or the end) of every line at once,
+so the context boundaries come out as lists of line indexes without checking the lines one by one. The lines in
+between are decoded in bulk and sliced into the contexts.
+
+NumPy is optional. Without it, or when the delimiters or the file can't be handled in bulk, the factories fall back to
+the pure-Python path, which returns the same contexts.
+"""
+
+import bisect
+import codecs
+import logging
+
+from .context import SingleDelimiterContextFactory, StartAndEndDelimiterContextFactory
+from .matcher import ContainsTextMatcher, ExactTextMatcher, PrefixTextMatcher, SuffixTextMatcher
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Encodings where the bytes of \n and \r are never part of another character and text compares the same as its bytes
+SUPPORTED_ENCODINGS = {'utf-8', 'ascii', 'iso8859-1'}
+
+NEW_LINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+
+def is_supported_matcher(matcher):
+    """
+    Returns True if the lines that match `matcher` can be found in bulk: exact, prefix and suffix texts are compared
+    with the bytes of every line at once, and the matchers with a literal only check the lines where it's found.
+    """
+
+    if type(matcher) in (ExactTextMatcher, PrefixTextMatcher, SuffixTextMatcher):
+        text = matcher.text
+    elif matcher.literal is not None:
+        text = matcher.literal
+    else:
+        return False
+    # The replacement character could stand for bytes that couldn't be decoded
+    return '\r' not in text and '\n' not in text and '\ufffd' not in text
+
+
+def get_encoding(file):
+    """
+    Returns the name of the file's encoding if its blocks can be split into lines in bulk, None otherwise.
+    """
+
+    if getattr(getattr(file, 'buffer', None), 'read1', None) is None:
+        return None
+    encoding = getattr(file, 'encoding', None)
+    if not isinstance(encoding, str):
+        return None
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    return name if name in SUPPORTED_ENCODINGS else None
+
+
+def can_scan(file, matchers, track_positions=False):
+    """
+    Returns True if NumPy is installed and the contexts of `file` can be found in bulk with these `matchers`.
+    """
+
+    if np is None:
+        logger.debug('NumPy is not installed, using the Python engine')
+        return False
+    if track_positions or get_encoding(file) is None or not all(map(is_supported_matcher, matchers)):
+        logger.debug('Using the Python engine for %s', getattr(file, 'name', None))
+        return False
+    return True
+
+
+def split_lines(data, eof):
+    """
+    Returns `data` as a NumPy array, the start and end (without the new line) of every complete line in it and the
+    position where the incomplete last line starts. Like the text files, \\r\\n and lone \\r are new lines too. A
+    \\r at the end of `data` might be followed by a \\n, so it isn't a new line until the `eof`.
+    """
+
+    array = np.frombuffer(data, dtype=np.uint8)
+    is_new_line = array == NEW_LINE
+    is_carriage_return = array == CARRIAGE_RETURN
+    # A \r followed by a \n is part of that new line
+    lone_carriage_return = is_carriage_return.copy()
+    lone_carriage_return[:-1] &= ~is_new_line[1:]
+    if not eof and len(array):
+        lone_carriage_return[-1] = False
+
+    new_lines = np.flatnonzero(is_new_line | lone_carriage_return)
+    ends = new_lines.copy()
+    if len(new_lines):
+        # The \r of \r\n isn't part of the line
+        crlf = is_new_line[new_lines] & (new_lines > 0)
+        crlf[crlf] = is_carriage_return[new_lines[crlf] - 1]
+        ends[crlf] -= 1
+
+    starts = np.empty_like(new_lines)
+    starts[:1] = 0
+    starts[1:] = new_lines[:-1] + 1
+    rest = int(new_lines[-1]) + 1 if len(new_lines) else 0
+    return array, starts, ends, rest
+
+
+def decode_lines(data, encoding, errors):
+    """
+    Decodes the complete lines at the start of `data` (it ends with a new line) and splits them.
+    """
+
+    text = data.decode(encoding, errors)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text[:-1].split('\n')
+
+
+def find_prefix(array, starts, lengths, prefix, candidates):
+    """
+    Returns the `candidates` (indexes of lines) whose bytes start with `prefix`. Only the lines that are still
+    candidates are compared to each of the next bytes.
+    """
+
+    candidates = candidates[lengths[candidates] >= len(prefix)]
+    for i, byte in enumerate(prefix):
+        candidates = candidates[array[starts[candidates] + i] == byte]
+    return candidates
+
+
+def find_matching_lines(matcher, encoding, data, array, starts, ends, lines):
+    """
+    Returns the sorted list of the indexes of the `lines` that match `matcher` (see `is_supported_matcher`). `starts`
+    and `ends` are the positions of the lines in `data` (`array` is the same bytes as a NumPy array).
+    """
+
+    lengths = ends - starts
+    all_lines = np.arange(len(starts))
+    matcher_type = type(matcher)
+
+    if matcher_type is ExactTextMatcher:
+        text = matcher.text.encode(encoding)
+        return find_prefix(array, starts, lengths, text, all_lines[lengths == len(text)]).tolist()
+
+    if matcher_type is PrefixTextMatcher:
+        candidates = find_prefix(array, starts, lengths, matcher.text.encode(encoding), all_lines).tolist()
+        if matcher.regexp is None:
+            return candidates
+        return [index for index in candidates if matcher.matches(lines[index])]
+
+    if matcher_type is SuffixTextMatcher:
+        text = matcher.text.encode(encoding)
+        return find_prefix(array, ends - len(text), lengths, text, all_lines).tolist()
+
+    # The rest have a literal (without new lines) so only the lines where it's found are checked
+    literal = matcher.literal.encode(encoding)
+    candidates = []
+    hit = data.find(literal)
+    while hit != -1:
+        index = int(np.searchsorted(starts, hit, side='right')) - 1
+        if index < 0 or hit + len(literal) > ends[index]:
+            # It's in the incomplete last line
+            break
+        candidates.append(index)
+        if index + 1 == len(starts):
+            break
+        # The rest of the line doesn't matter
+        hit = data.find(literal, int(starts[index + 1]))
+
+    if matcher_type is ContainsTextMatcher:
+        return candidates
+    return [index for index in candidates if matcher.matches(lines[index])]
+
+
+class BlockScanner:
+    """
+    Reads the file in blocks of `block_size` bytes and returns, for each one, the list of its complete lines (the
+    last line of the file doesn't need a new line) and, for each of the `matchers`, the sorted list of the indexes of
+    the lines that match it.
+    """
+
+    def __init__(self, file, matchers, block_size=DEFAULT_BLOCK_SIZE):
+        self.file = file
+        self.matchers = matchers
+        self.block_size = block_size
+        self.encoding = get_encoding(file)
+        self.errors = file.errors or 'strict'
+
+    def __iter__(self):
+        read1 = self.file.buffer.read1
+        # The blocks of a line that hasn't ended yet are joined once it ends, instead of being copied with every block
+        pending = []
+        eof = False
+        while not eof:
+            block = read1(self.block_size)
+            eof = not block
+            pending.append(block)
+            if not eof and b'\n' not in block and b'\r' not in block:
+                continue
+            data = b''.join(pending)
+            pending = []
+            if not data:
+                break
+
+            array, starts, ends, complete = split_lines(data, eof)
+            if eof and complete < len(data):
+                # The last line doesn't end with a new line
+                starts = np.append(starts, complete)
+                ends = np.append(ends, len(data))
+                lines = decode_lines(data + b'\n', self.encoding, self.errors)
+                complete = len(data)
+            elif complete:
+                lines = decode_lines(data[:complete], self.encoding, self.errors)
+            else:
+                pending.append(data)
+                continue
+            pending.append(data[complete:])
+
+            yield lines, [
+                find_matching_lines(matcher, self.encoding, data, array, starts, ends, lines)
+                for matcher in self.matchers
+            ]
+
+
+def next_index(indexes, position):
+    """
+    Returns the first of the sorted `indexes` that is >= `position`, or None.
+    """
+
+    i = bisect.bisect_left(indexes, position)
+    return indexes[i] if i < len(indexes) else None
+
+
+class NumpySingleDelimiterContextFactory(SingleDelimiterContextFactory):
+    """
+    SingleDelimiterContextFactory that finds the delimiter lines with NumPy (see BlockScanner).
+    """
+
+    def __init__(self, file, delimiter_matcher, exclude_delimiter=True, track_positions=False,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__(file, delimiter_matcher, exclude_delimiter=exclude_delimiter, track_positions=track_positions)
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        if can_scan(self.file, [self.delimiter_matcher], self.track_positions):
+            return self.iter_blocks()
+        return super().__iter__()
+
+    def iter_blocks(self):
+        """
+        Same as `iter_lines`, but the lines between the delimiters are added to the contexts in slices.
+        """
+
+        context_lines = []
+        first = True
+        for lines, (delimiters,) in BlockScanner(self.file, [self.delimiter_matcher], block_size=self.block_size):
+            position = 0
+            for index in delimiters:
+                context_lines += lines[position:index]
+                position = index + 1
+                line = lines[index]
+
+                if first and index == 0:
+                    # The first line of the file is a delimiter
+                    if not self.exclude_delimiter:
+                        context_lines.append(line)
+                    continue
+
+                if not self.exclude_delimiter:
+                    context_lines.append(line)
+                if context_lines:
+                    yield self.create_context(context_lines)
+                    context_lines = []
+                else:
+                    context_lines.append(line)
+
+            context_lines += lines[position:]
+            first = False
+
+        if context_lines:
+            yield self.create_context(context_lines)
+
+
+class NumpyStartAndEndDelimiterContextFactory(StartAndEndDelimiterContextFactory):
+    """
+    StartAndEndDelimiterContextFactory that finds the start and end delimiter lines with NumPy (see BlockScanner).
+    Nested contexts use the Python engine.
+    """
+
+    def __init__(self, file, start_delimiter_matcher, end_delimiter_matcher, block_size=DEFAULT_BLOCK_SIZE, **kwargs):
+        super().__init__(file, start_delimiter_matcher, end_delimiter_matcher, **kwargs)
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        matchers = [self.start_delimiter_matcher, self.end_delimiter_matcher]
+        if not self.nested and can_scan(self.file, matchers, self.track_positions):
+            return self.iter_blocks()
+        return super().__iter__()
+
+    def iter_blocks(self):
+        """
+        Same as `iter_flat`, but it jumps from delimiter to delimiter and the lines in between are added to the contexts
+        in slices.
+        """
+
+        matchers = [self.start_delimiter_matcher, self.end_delimiter_matcher]
+        context_lines = None
+        for lines, (starts, ends) in BlockScanner(self.file, matchers, block_size=self.block_size):
+            position = 0
+            while position < len(lines):
+                if context_lines is None:
+                    start = next_index(starts, position)
+                    if start is None:
+                        break
+                    context_lines = [] if self.exclude_start_delimiter else [lines[start]]
+                    position = start + 1
+                    continue
+
+                end = next_index(ends, position)
+                if end is None:
+                    context_lines += lines[position:]
+                    break
+
+                context_lines += lines[position:end]
+                position = end + 1
+                if not self.exclude_end_delimiter:
+                    context_lines.append(lines[end])
+                elif not self.ignore_end_delimiter:
+                    # This end delimiter might be used as a start delimiter
+                    position = end
+
+                yield self.create_context(context_lines)
+                context_lines = None
+
+        if context_lines is not None:
+            yield self.create_context(context_lines)
@@ -0,0 +1,232 @@
+"""
+Module containing the walker that finds the files in directories for -r/--recursive
+"""
+
+import logging
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# Like ThreadPoolExecutor's default. Scanning directories mostly waits on the filesystem.
+DEFAULT_WALK_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+IGNORE_FILE_NAMES = ('.gitignore', '.ctxignore')
+
+PathRule = namedtuple('PathRule', ['regexp', 'negated', 'directory_only'])
+
+
+def translate_glob(pattern):
+    """
+    Translates a .gitignore glob to a regex: `*` and `?` don't match `/`, `**` matches across directories and `[...]`
+    are character classes.
+    """
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+
+    return ''.join(parts)
+
+
+def compile_ignore_pattern(pattern):
+    """
+    Compiles a line of a .gitignore file. Returns None for blank lines and comments.
+
+    Patterns with a `/` (other than a trailing one) are relative to the directory of the .gitignore. The rest match
+    the name of a file or directory at any depth. A trailing `/` only matches directories and a leading `!` negates the
+    pattern.
+    """
+
+    pattern = pattern.rstrip('\n').rstrip('\r')
+    # Trailing spaces are ignored unless they're escaped
+    while pattern.endswith(' ') and not pattern.endswith('\\ '):
+        pattern = pattern[:-1]
+    if not pattern or pattern.startswith('#'):
+        return None
+
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\#') or pattern.startswith('\\!'):
+        pattern = pattern[1:]
+
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+
+    anchored = '/' in pattern
+    regex = translate_glob(pattern.lstrip('/'))
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+
+    return PathRule(re.compile(regex + r'\Z', re.DOTALL), negated, directory_only)
+
+
+class PathRules:
+    """
+    .gitignore-style rules, e.g. the ones that apply to a directory: the ones of its parents followed by its own. The
+    last rule that matches a path decides whether the path matches (it doesn't if the rule is negated), so deeper rules
+    override the ones above them. Each rule only applies to the paths under its `base` directory.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def extend(self, base, patterns):
+        """
+        Returns new rules with the `patterns` relative to `base` added after these ones.
+        """
+        rules = [(base, rule) for rule in map(compile_ignore_pattern, patterns) if rule is not None]
+        if not rules:
+            return self
+        return PathRules(self.rules + tuple(rules))
+
+    def matches(self, path, is_dir=False):
+        for base, rule in reversed(self.rules):
+            if rule.directory_only and not is_dir:
+                continue
+            relative_path = get_relative_path(base, path)
+            if relative_path is not None and rule.regexp.match(relative_path):
+                return not rule.negated
+        return False
+
+
+def get_relative_path(base, path):
+    """
+    Returns `path` relative to `base` with `/` separators, or None if it's not under `base`.
+    """
+    prefix = base if base.endswith(os.sep) else base + os.sep
+    if not path.startswith(prefix):
+        return None
+    relative_path = path[len(prefix):]
+    if os.sep != '/':
+        relative_path = relative_path.replace(os.sep, '/')
+    return relative_path
+
+
+class FileWalker:
+    """
+    Finds the files in a directory and its subdirectories. Files are yielded as soon as their directory is scanned, so
+    reading them can start before the walk is over.
+
+    The directories are scanned with `os.scandir` in a thread pool. When a directory is yielded, all of its
+    subdirectories are submitted to the pool, so they're scanned in parallel while its files are read. The files are
+    yielded in a depth-first order with the entries of each directory sorted by name, so the order doesn't depend on
+    which scan finishes first.
+
+    Like `grep -r`, symbolic links found in the directories are not followed.
+
+    Files are skipped if they match any of the `excludes` globs or, when there are `includes` globs, if they match none
+    of them. Directories that match `excludes` are not walked. Both are .gitignore-style globs relative to the
+    directory that's walked. The patterns in the files named `ignore_file_names` found in the directories are applied
+    to the files and directories under them.
+
+    The directories and entries that can't be read are logged and skipped. `walk` passes their paths to `on_error`.
+    """
+
+    def __init__(self, includes=(), excludes=(), ignore_file_names=IGNORE_FILE_NAMES, workers=DEFAULT_WALK_WORKERS):
+        self.includes = includes
+        self.excludes = excludes
+        self.ignore_file_names = ignore_file_names
+        self.workers = workers
+
+    def walk(self, path, on_error=None):
+        path = os.path.normpath(path)
+        rules = PathRules().extend(path, self.excludes)
+        includes = PathRules().extend(path, self.includes)
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        stack = [executor.submit(self.scan_dir, path, rules, includes)]
+        try:
+            while stack:
+                file_paths, subdirs, error_paths = stack.pop().result()
+                if on_error is not None:
+                    for error_path in error_paths:
+                        on_error(error_path)
+                # Reversed so the first one is popped first
+                stack.extend(executor.submit(self.scan_dir, *subdir) for subdir in reversed(subdirs))
+                yield from file_paths
+        finally:
+            for future in stack:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def read_ignore_rules(self, path, rules):
+        for name in self.ignore_file_names:
+            try:
+                with open(os.path.join(path, name), errors='replace') as file:
+                    rules = rules.extend(path, file)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning('Cannot read %s: %s', os.path.join(path, name), e)
+        return rules
+
+    def scan_dir(self, path, rules, includes):
+        """
+        Returns the files in `path` that are not ignored, a list of (subdirectory, rules, includes) to scan next and the
+        paths that couldn't be read.
+        """
+
+        rules = self.read_ignore_rules(path, rules)
+
+        try:
+            with os.scandir(path) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.error('Cannot read directory %s: %s', path, e)
+            return [], [], [path]
+
+        file_paths = []
+        subdirs = []
+        error_paths = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not rules.matches(entry.path, is_dir=True):
+                        subdirs.append((entry.path, rules, includes))
+                elif entry.is_file(follow_symlinks=False):
+                    if rules.matches(entry.path):
+                        continue
+                    if includes and not includes.matches(entry.path):
+                        continue
+                    file_paths.append(entry.path)
+            except OSError as e:
+                logger.error('Cannot read %s: %s', entry.path, e)
+                error_paths.append(entry.path)
+
+        return file_paths, subdirs, error_paths
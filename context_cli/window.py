@@ -0,0 +1,109 @@
+"""
+Module containing the windows of contexts written around the contexts that make it through the pipeline
+"""
+
+import logging
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class ContextWindow:
+    """
+    Adds the `before` contexts that come before and the `after` contexts that come after each context that makes it
+    through a pipeline (like grep's -B and -A but for contexts). Windows that overlap are merged so no context is
+    written twice.
+
+    The window is the context generator of the pipeline and `filter` receives the pipeline:
+
+        window = ContextWindow(context_factory, before=2, after=1)
+        for context in window.filter(build_pipeline(window, args)):
+            ...
+
+    Filters yield a context as soon as they read it, so when the pipeline yields a context, it comes from the last
+    context read from the window. The contexts around it are written as they came out of `context_generator`. Only the
+    last `before` contexts are kept (in a ring buffer), so memory doesn't depend on the size of the file.
+
+    `matches` is the number of contexts that came out of the pipeline so far, the contexts around them don't count.
+    """
+
+    def __init__(self, context_generator, before=0, after=0):
+        self.context_generator = context_generator
+        self.after = after
+        self.before_contexts = deque(maxlen=before)
+        self.after_contexts = deque()
+        self.after_left = 0
+        self.current = None
+        self.current_written = False
+        self.contexts = None
+        self.matches = 0
+
+    def __iter__(self):
+        self.contexts = iter(self.context_generator)
+        for context in self.contexts:
+            self.retire_current()
+            self.current = context
+            self.current_written = False
+            yield context
+        self.retire_current()
+
+    def retire_current(self):
+        """
+        Called once the pipeline is done with the current context.
+        """
+        context = self.current
+        self.current = None
+        if context is None:
+            return
+
+        if self.current_written:
+            self.after_left = self.after
+            self.before_contexts.clear()
+        elif not context.lines:
+            # Empty contexts are never written so they don't take a place in the windows
+            pass
+        elif self.after_left:
+            self.after_left -= 1
+            self.after_contexts.append(context)
+        else:
+            self.before_contexts.append(context)
+
+    def filter(self, pipeline, limit=None):
+        """
+        Yields the contexts of `pipeline` with the contexts around them. After `limit` of them (like --max-count), the
+        pipeline isn't read anymore, only the contexts after the last one are.
+        """
+        if limit == 0:
+            return
+
+        for context in pipeline:
+            yield from self.pop_after_contexts()
+            while self.before_contexts:
+                yield self.before_contexts.popleft()
+            self.current_written = True
+            self.matches += 1
+            yield context
+            if self.matches == limit:
+                yield from self.read_last_after_contexts()
+                return
+        yield from self.pop_after_contexts()
+
+    def read_last_after_contexts(self):
+        """
+        Reads the contexts after the current one straight from `context_generator`, without going through the pipeline.
+        """
+        self.retire_current()
+        after_left = self.after_left
+        if not after_left:
+            return
+        for context in self.contexts:
+            if context.lines:
+                yield context
+                after_left -= 1
+                if not after_left:
+                    return
+
+    def pop_after_contexts(self):
+        while self.after_contexts:
+            yield self.after_contexts.popleft()
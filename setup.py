@@ -31,6 +31,9 @@ setuptools.setup(
     },
     test_suite='tests',
     tests_require = test_require,
+    extras_require={
+        'numpy': ['numpy'],
+    },
     setup_requires=setup_requires,
     classifiers=[
         "Programming Language :: Python :: 3.6",
@@ -0,0 +1,88 @@
+import io
+import os
+
+import pytest
+
+from mock import mock
+
+from context_cli.binary import SNIFF_SIZE, check_binary_file, count_decode_errors, is_binary, peek_file
+
+
+def open_bytes(data, encoding='utf-8'):
+    return io.TextIOWrapper(io.BufferedReader(io.BytesIO(data)), encoding=encoding)
+
+
+def test_peek_file():
+    file = open_bytes(b'a' * (SNIFF_SIZE * 2))
+
+    assert peek_file(file) == b'a' * SNIFF_SIZE
+    assert peek_file(file, size=3) == b'aaa'
+    # Nothing was consumed
+    assert file.read() == 'a' * (SNIFF_SIZE * 2)
+
+
+def test_peek_file_without_buffer():
+    assert peek_file(io.StringIO('a')) is None
+    assert peek_file(mock.MagicMock()) is None
+
+
+def test_count_decode_errors():
+    assert count_decode_errors('héllo'.encode()) == 0
+    assert count_decode_errors(b'a\xffb\xfec') == 2
+    assert count_decode_errors(b'a\xffb\xfec', limit=1) == 1
+    # Cut in the middle of a character, only an error at the end of the file
+    assert count_decode_errors('é'.encode()[:1]) == 0
+    assert count_decode_errors(b'a' + '✓'.encode()[:2], final=True) == 1
+
+
+@pytest.mark.parametrize('data,encoding,expected', [
+    (b'', 'utf-8', False),
+    (b'hello\nworld\n', 'utf-8', False),
+    ('héllo wörld\n'.encode(), 'utf-8', False),
+    (b'ELF\x02\x01\x01\x00\x00', 'utf-8', True),
+    # Latin-1 text read as UTF-8 only has a few errors
+    ('café olé and some more text\n'.encode('latin-1'), 'utf-8', False),
+    (os.urandom(4096).replace(b'\0', b'\1'), 'utf-8', True),
+    ('hello'.encode('utf-16-le'), 'utf-16-le', False),
+])
+def test_is_binary(data, encoding, expected):
+    assert is_binary(data, encoding) == expected
+
+
+def test_check_binary_file_text():
+    file = open_bytes(b'hello\n')
+
+    assert check_binary_file(file)
+    assert file.errors == 'strict'
+
+
+@pytest.mark.parametrize('binary_files,expected', [('skip', False), ('text', True)])
+def test_check_binary_file_binary(binary_files, expected):
+    file = open_bytes(b'a\x00\xffb\n')
+
+    assert check_binary_file(file, binary_files) == expected
+    if expected:
+        assert file.errors == 'replace'
+        assert file.read() == 'a\x00�b\n'
+
+
+def test_check_binary_file_replaces_decode_errors_in_text():
+    file = open_bytes('café and more text\n'.encode('latin-1'))
+
+    assert check_binary_file(file)
+    assert file.read() == 'caf� and more text\n'
+
+
+def test_check_binary_file_text_replaces_errors_after_the_start():
+    file = open_bytes(b'a\n' * SNIFF_SIZE + b'\xff\n')
+
+    assert check_binary_file(file, 'text')
+    assert file.read().endswith('a\n\ufffd\n')
+
+
+@pytest.mark.parametrize('binary_files', ['skip', 'text'])
+def test_check_binary_file_character_cut_at_the_end(binary_files):
+    file = open_bytes(b'BEGIN\nok\nEND\n\xe2\x9c')
+
+    assert check_binary_file(file, binary_files)
+    assert file.read() == 'BEGIN\nok\nEND\n\ufffd'
@@ -1,9 +1,15 @@
+import io
+import random
+import re
+
 import pytest
+from mock import patch
 
 from context_cli.context import (
-    Context, FileIterator, SingleDelimiterContextFactory, StartAndEndDelimiterContextFactory,
+    MORE_LINES, Context, FileIterator, PositionTrackingFileIterator, SingleDelimiterContextFactory,
+    StartAndEndDelimiterContextFactory,
 )
-from context_cli.matcher import ContainsTextMatcher
+from context_cli.matcher import ContainsTextMatcher, RegexMatcher, plan_regex_matcher
 
 
 class FileMock:
@@ -18,6 +24,10 @@ class FileMock:
             return self.lines[curr]
         return ''
 
+    def read(self, size=-1):
+        # Returns a single line at a time so that lines are spread across chunks
+        return self.readline()
+
 
 def get_file_mock(context_lines):
     lines_with_new_line = [line + '\n' for line in context_lines]
@@ -382,3 +392,365 @@ def test_start_and_end_delimiter_context_factory_incomplete():
 
     for expected_lines, context in zip(expected_contexts_lines, contexts):
         assert context.lines == expected_lines
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+def test_file_iterator_read_until(chunk_size):
+    iterator = FileIterator(io.StringIO('a\nb\nxx---\nc\n---'), chunk_size=chunk_size)
+
+    assert iterator.read_until('---') == (['a', 'b'], 'xx---')
+    assert iterator.read_until('---', keep_lines=False) == ([], '---')
+    assert iterator.read_until('---') == ([], None)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+def test_file_iterator_read_until_matches(chunk_size):
+    iterator = FileIterator(io.StringIO('a\nxx---\nb\n---\nc'), chunk_size=chunk_size)
+
+    assert iterator.read_until('---', matches=lambda line: line == '---') == (['a', 'xx---', 'b'], '---')
+    assert iterator.read_until('---', matches=lambda line: line == '---') == (['c'], None)
+
+
+def test_file_iterator_read_until_after_next_and_unread():
+    iterator = FileIterator(io.StringIO('a\nb\n---\nc\n'))
+
+    assert next(iterator) == 'a'
+    iterator.unread('z')
+    assert iterator.read_until('---') == (['z', 'b'], '---')
+    assert list(iterator) == ['c']
+
+
+def test_file_iterator_decodes_binary_buffer():
+    file = io.TextIOWrapper(io.BytesIO('línea 1\r\nlínea 2\n'.encode('utf-8')), encoding='utf-8')
+    iterator = FileIterator(file, chunk_size=3)
+
+    assert list(iterator) == ['línea 1', 'línea 2']
+
+
+@pytest.mark.parametrize('read', ['iterate', 'read_until'])
+def test_file_iterator_joins_long_lines_once(read):
+    iterator = FileIterator(io.StringIO('a\n' + 'x' * 100 + '---' + 'y' * 100 + '\nb'), chunk_size=3)
+    joins = []
+    fill_buffer = iterator.fill_buffer
+
+    def counting_fill_buffer():
+        joins.append(len(iterator.buffer) - iterator.position)
+        return fill_buffer()
+
+    iterator.fill_buffer = counting_fill_buffer
+    if read == 'iterate':
+        assert list(iterator) == ['a', 'x' * 100 + '---' + 'y' * 100, 'b']
+    else:
+        assert iterator.read_until('---') == (['a'], 'x' * 100 + '---' + 'y' * 100)
+        assert list(iterator) == ['b']
+    # The pending text is never more than a chunk since the chunks of the long line are joined once
+    assert max(joins) <= 3
+
+
+def test_single_delimiter_context_factory_empty_file():
+    factory = SingleDelimiterContextFactory(io.StringIO(''), delimiter_matcher=ContainsTextMatcher(text='---'))
+    assert list(factory) == []
+
+
+NESTED_LINES = [
+    'outside',
+    'BEGIN',
+    'a',
+    'BEGIN',
+    'b',
+    'BEGIN',
+    'c',
+    'END',
+    'END',
+    'd',
+    'END',
+    'outside',
+    'BEGIN',
+    'e',
+    'END',
+]
+
+
+def get_nested_factory(lines, **kwargs):
+    return StartAndEndDelimiterContextFactory(
+        get_file_mock(lines),
+        start_delimiter_matcher=ContainsTextMatcher(text='BEGIN'),
+        end_delimiter_matcher=ContainsTextMatcher(text='END'),
+        nested=True,
+        **kwargs
+    )
+
+
+def test_start_and_end_delimiter_context_factory_nested():
+    contexts = list(get_nested_factory(NESTED_LINES))
+
+    assert [context.lines for context in contexts] == [
+        ['BEGIN', 'c', 'END'],
+        ['BEGIN', 'b', 'BEGIN', 'c', 'END', 'END'],
+        ['BEGIN', 'a', 'BEGIN', 'b', 'BEGIN', 'c', 'END', 'END', 'd', 'END'],
+        ['BEGIN', 'e', 'END'],
+    ]
+
+
+def test_start_and_end_delimiter_context_factory_nested_exclude_delimiters():
+    contexts = list(get_nested_factory(NESTED_LINES, exclude_start_delimiter=True, exclude_end_delimiter=True))
+
+    assert [context.lines for context in contexts] == [
+        ['c'],
+        ['b', 'BEGIN', 'c', 'END'],
+        ['a', 'BEGIN', 'b', 'BEGIN', 'c', 'END', 'END', 'd'],
+        ['e'],
+    ]
+
+
+def test_start_and_end_delimiter_context_factory_nested_outermost_only():
+    contexts = list(get_nested_factory(NESTED_LINES, max_depth=1))
+
+    assert [context.lines for context in contexts] == [
+        ['BEGIN', 'a', 'BEGIN', 'b', 'BEGIN', 'c', 'END', 'END', 'd', 'END'],
+        ['BEGIN', 'e', 'END'],
+    ]
+
+
+def test_start_and_end_delimiter_context_factory_nested_depth_range():
+    contexts = list(get_nested_factory(NESTED_LINES, min_depth=2, max_depth=2))
+
+    assert [context.lines for context in contexts] == [
+        ['BEGIN', 'b', 'BEGIN', 'c', 'END', 'END'],
+    ]
+
+
+def test_start_and_end_delimiter_context_factory_nested_incomplete():
+    contexts = list(get_nested_factory(['BEGIN', 'a', 'BEGIN', 'b']))
+
+    assert [context.lines for context in contexts] == [
+        ['BEGIN', 'b'],
+        ['BEGIN', 'a', 'BEGIN', 'b'],
+    ]
+
+
+def test_start_and_end_delimiter_context_factory_nested_same_delimiters():
+    lines = ['```', 'a', '```', 'b', '```', 'c', '```']
+    factory = StartAndEndDelimiterContextFactory(
+        get_file_mock(lines),
+        start_delimiter_matcher=ContainsTextMatcher(text='```'),
+        end_delimiter_matcher=ContainsTextMatcher(text='```'),
+        nested=True,
+    )
+
+    assert [context.lines for context in factory] == [['```', 'a', '```'], ['```', 'c', '```']]
+
+
+def test_start_and_end_delimiter_context_factory_nested_end_is_start():
+    start_delimiter = 'start_delimiter'
+    end_delimiter = 'end_delimiter start_delimiter'
+    lines = [start_delimiter, 'a', end_delimiter, 'b', end_delimiter]
+    factory = StartAndEndDelimiterContextFactory(
+        get_file_mock(lines),
+        start_delimiter_matcher=ContainsTextMatcher(text=start_delimiter),
+        end_delimiter_matcher=ContainsTextMatcher(text=end_delimiter),
+        exclude_start_delimiter=True,
+        exclude_end_delimiter=True,
+        ignore_end_delimiter=False,
+        nested=True,
+    )
+
+    # Same as the flat factory
+    assert [context.lines for context in factory] == [['a'], ['b'], []]
+
+
+def test_context_line_numbers():
+    assert Context(lines=['a', 'b']).line_numbers is None
+    assert list(Context(lines=['a', 'b'], line_number=5, byte_offset=20).line_numbers) == [5, 6]
+    assert Context(lines=['a', 'b'], line_number=5, byte_offset=20, line_numbers=[5, 9]).line_numbers == [5, 9]
+
+
+def test_position_tracking_file_iterator():
+    file = io.TextIOWrapper(io.BytesIO('a\nñu\n---\nc\n'.encode('utf-8')), encoding='utf-8')
+    iterator = PositionTrackingFileIterator(file, chunk_size=2)
+
+    assert iterator.tell() == (1, 0)
+    assert next(iterator) == 'a'
+    assert iterator.tell() == (2, 2)
+    assert next(iterator) == 'ñu'
+    assert iterator.tell() == (3, 6)
+    iterator.unread('ñu')
+    assert iterator.tell() == (2, 2)
+    assert iterator.read_until('---', keep_lines=False) == ([], '---')
+    assert iterator.tell() == (4, 10)
+    assert list(iterator) == ['c']
+    assert iterator.tell() == (5, 12)
+
+
+def test_position_tracking_file_iterator_get_size():
+    iterator = PositionTrackingFileIterator(io.TextIOWrapper(io.BytesIO(b''), encoding='utf-8'))
+
+    assert iterator.get_size('abc') == 3
+    assert iterator.get_size('ñandú') == 7
+    assert iterator.get_offsets(['a', 'ñu', ''], 10) == [3, 5, 9]
+
+
+def test_position_tracking_file_iterator_crlf():
+    file = io.TextIOWrapper(io.BytesIO(b'a\r\nb\r\n---\r\nc'), encoding='utf-8')
+    iterator = PositionTrackingFileIterator(file)
+
+    assert iterator.read_until('---') == (['a', 'b'], '---')
+    assert iterator.tell() == (4, 11)
+
+
+def test_position_tracking_file_iterator_skipped_lines_are_not_kept():
+    data = 'x\r\nñ\r\n'.encode('utf-8') * 1000 + b'BEGIN\r\na\r\nEND\r\n'
+    file = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    factory = StartAndEndDelimiterContextFactory(
+        file, start_delimiter_matcher=ContainsTextMatcher('BEGIN'), end_delimiter_matcher=ContainsTextMatcher('END'),
+        track_positions=True,
+    )
+    factory.file_iterator = PositionTrackingFileIterator(file, chunk_size=64)
+
+    with patch.object(factory.file_iterator, 'get_size', wraps=factory.file_iterator.get_size) as get_size:
+        contexts = list(factory)
+
+    assert [context.lines for context in contexts] == [['BEGIN', 'a', 'END']]
+    assert contexts[0].line_number == 2001
+    assert contexts[0].byte_offsets == [data.index(b'BEGIN'), data.index(b'a\r\nEND'), data.index(b'END')]
+    # The lines before the start delimiter are counted in the buffer, they're never split into lines
+    assert get_size.call_count < 10
+
+
+class LineByLineMatcher(RegexMatcher):
+    """
+    RegexMatcher without a literal so the factories check every line.
+    """
+
+    def __init__(self, regexp):
+        super().__init__(regexp)
+        self.literal = None
+
+
+# Each pair creates a matcher with a literal (buffer search) and an equivalent matcher without one (line by line).
+MATCHER_CREATORS = [
+    (ContainsTextMatcher, lambda text: LineByLineMatcher(re.escape(text))),
+    (lambda text: plan_regex_matcher('^' + re.escape(text)), lambda text: LineByLineMatcher('^' + re.escape(text))),
+    (lambda text: RegexMatcher(re.escape(text) + '.*'), lambda text: LineByLineMatcher(re.escape(text) + '.*')),
+]
+
+RANDOM_WORDS = ['hello', 'ñandú', '€', 'a', '', '---', 'x---x', 'BEGIN', 'END', 'BEGIN END']
+
+
+def get_random_data(seed):
+    rng = random.Random(seed)
+    lines = [' '.join(rng.choice(RANDOM_WORDS) for _ in range(rng.randint(0, 3))) for _ in range(rng.randint(0, 40))]
+    newline = rng.choice(['\n', '\r\n'])
+    text = newline.join(lines)
+    if rng.random() < 0.5:
+        text += newline
+    return text.encode('utf-8')
+
+
+EQUIVALENCE_DATA = [get_random_data(seed) for seed in range(4)] + [
+    b'',
+    b'a',
+    # Delimiters at the end of the file, with and without a new line
+    b'a\n---',
+    b'a\nEND\n---\n',
+    # Delimiters at the start of the file and one after the other
+    b'---\n---\nBEGIN\nBEGIN\na\nEND\nEND\nEND\n',
+    b'BEGIN\r\n\xc3\xb1\r\nEND\r\n---\r\nb\r\n',
+    # Lines and delimiters that span many chunks
+    b'BEGIN\n' + b'x' * 100 + b'---x\n' + b'y' * 100 + b'END\n',
+]
+
+SINGLE_DELIMITER_OPTIONS = [{'exclude_delimiter': True}, {'exclude_delimiter': False}]
+START_AND_END_DELIMITER_OPTIONS = [
+    {'exclude_start_delimiter': exclude_start, 'exclude_end_delimiter': exclude_end,
+     'ignore_end_delimiter': ignore_end, 'nested': nested}
+    for exclude_start, exclude_end, ignore_end in [
+        (False, False, True), (True, True, True), (True, True, False), (False, True, False),
+    ]
+    for nested in (False, True)
+]
+
+
+def create_factory(data, options, matcher_creator, chunk_size=64, track_positions=False):
+    file = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    if 'exclude_delimiter' in options:
+        factory = SingleDelimiterContextFactory(
+            file, delimiter_matcher=matcher_creator('---'), track_positions=track_positions, **options,
+        )
+    else:
+        factory = StartAndEndDelimiterContextFactory(
+            file, start_delimiter_matcher=matcher_creator('BEGIN'), end_delimiter_matcher=matcher_creator('END'),
+            track_positions=track_positions, **options,
+        )
+    iterator_class = PositionTrackingFileIterator if track_positions else FileIterator
+    factory.file_iterator = iterator_class(file, chunk_size=chunk_size)
+    return factory
+
+
+def assert_positions(contexts, data):
+    lines = data.decode('utf-8').splitlines()
+    for context in contexts:
+        if not context.lines:
+            continue
+        start = context.line_number - 1
+        assert lines[start:start + len(context.lines)] == context.lines
+        assert context.byte_offset == context.byte_offsets[0]
+        for byte_offset, line in zip(context.byte_offsets, context.lines):
+            assert data[byte_offset:].startswith(line.encode('utf-8'))
+            assert byte_offset == 0 or data[byte_offset - 1:byte_offset] == b'\n'
+
+
+def join_parts(parts, max_lines):
+    contexts = []
+    context_lines = []
+    for lines, is_last in parts:
+        # A part can go over `max_lines` by the lines of a chunk
+        assert len(lines) <= max_lines + 64 or is_last
+        context_lines += lines
+        if is_last:
+            contexts.append(context_lines)
+            context_lines = []
+    assert not context_lines
+    return contexts
+
+
+@pytest.mark.parametrize('data', EQUIVALENCE_DATA)
+@pytest.mark.parametrize('chunk_size,max_lines', [(1, 1), (7, 2), (64, 1000)])
+@pytest.mark.parametrize('options', SINGLE_DELIMITER_OPTIONS + START_AND_END_DELIMITER_OPTIONS)
+def test_context_factories_same_as_line_by_line(data, chunk_size, max_lines, options):
+    """
+    Searching the chunks for literals, tracking the positions and reading the contexts in parts all give the same
+    contexts as checking the lines one by one.
+    """
+    for literal_creator, line_by_line_creator in MATCHER_CREATORS:
+        expected = [context.lines for context in create_factory(data, options, line_by_line_creator)]
+
+        for matcher_creator in (literal_creator, line_by_line_creator):
+            factory = create_factory(data, options, matcher_creator, chunk_size)
+            assert [context.lines for context in factory] == expected
+
+            tracked = list(create_factory(data, options, matcher_creator, chunk_size, track_positions=True))
+            assert [context.lines for context in tracked] == expected
+            assert_positions(tracked, data)
+
+            factory = create_factory(data, options, matcher_creator, chunk_size)
+            assert join_parts(factory.iter_parts(max_lines), max_lines) == expected
+
+
+def test_single_delimiter_context_factory_parts_are_bounded():
+    file = io.StringIO('a\n' * 10 + '===\n' + 'b\n' * 3)
+    factory = SingleDelimiterContextFactory(file, delimiter_matcher=ContainsTextMatcher('==='))
+    factory.file_iterator = FileIterator(file, chunk_size=4)
+
+    assert list(factory.iter_parts(max_lines=4)) == [
+        (['a'] * 4, False), (['a'] * 4, False), (['a'] * 2, True), (['b'] * 3, True),
+    ]
+
+
+def test_file_iterator_read_until_max_lines():
+    iterator = FileIterator(io.StringIO('a\nb\nc\nd\nEND\ne\n'), chunk_size=4)
+
+    assert iterator.read_until('END', max_lines=2) == (['a', 'b'], MORE_LINES)
+    assert iterator.read_until('END', max_lines=2) == (['c', 'd'], MORE_LINES)
+    assert iterator.read_until('END', max_lines=2) == ([], 'END')
+    assert iterator.read_until('END', max_lines=2) == (['e'], None)
@@ -1,12 +1,33 @@
+import argparse
+import io
+import json
+import logging
+import os
+
+import pytest
 from mock import patch, mock, ANY
 from pathlib import Path
 
+from context_cli.context import Context, PositionTrackingFileIterator
 from context_cli.core import (
     start_and_end_delimiter_context_factory_creator, single_delimiter_context_factory_creator,
-    get_context_factory_from_args, build_pipeline, construct_arg_parser,
-    parse_args, main
+    get_context_factory_from_args, build_pipeline, get_output_from_args, get_max_count_per_file, non_negative_int,
+    positive_int, fraction, byte_size, get_unique_set_from_args, get_sampler_from_args, get_window_sizes,
+    write_pipeline, get_file_walker_from_args, iter_files, get_paths,
+    open_file, read_file_list, query, get_line_memos_from_args, can_stream, get_line_filters, stream_file,
+    construct_arg_parser, parse_args, get_file_limit, main, ERROR_EXIT_STATUS
+)
+from context_cli.matcher import ContainsTextMatcher, MemoizedMatcher, plan_regex_matcher
+from context_cli.memo import LineMemo
+from context_cli.output import (
+    CountOutput, FilesWithMatchesOutput, FramedOutput, GroupByOutput, JsonLinesOutput, SampleOutput, SortedOutput,
+    SplitOutput, TextOutput, TopOutput,
 )
-from context_cli.util import TypeArgDoesNotExistException
+from context_cli.prefetch import PrefetchedRawFile
+from context_cli.sample import BernoulliSampler
+from context_cli.unique import BloomFilter, DigestSet
+from context_cli.util import CtxRc, TypeArgDoesNotExistException
+from context_cli.walk import FileWalker
 
 HOME_PATH = '/my/home'
 
@@ -40,6 +61,43 @@ def test_start_and_end_delimiter_context_factory_creator(mock_init_method):
         exclude_start_delimiter=exclude_start,
         exclude_end_delimiter=exclude_end,
         ignore_end_delimiter=ignore_end_delimiter,
+        nested=False,
+        min_depth=1,
+        max_depth=None,
+        track_positions=False,
+    )
+
+
+@patch('context_cli.context.StartAndEndDelimiterContextFactory.__init__', return_value=None)
+def test_start_and_end_delimiter_context_factory_creator_nested(mock_init_method):
+    start_delimiter_matcher = mock.MagicMock()
+    end_delimiter_matcher = mock.MagicMock()
+    file = mock.MagicMock()
+
+    factory = start_and_end_delimiter_context_factory_creator(
+        start_delimiter_matcher=start_delimiter_matcher,
+        end_delimiter_matcher=end_delimiter_matcher,
+        exclude_start=False,
+        exclude_end=False,
+        ignore_end_delimiter=True,
+        nested=True,
+        min_depth=2,
+        max_depth=3,
+        track_positions=True,
+    )
+    factory(file)
+
+    mock_init_method.assert_called_once_with(
+        file,
+        start_delimiter_matcher=start_delimiter_matcher,
+        end_delimiter_matcher=end_delimiter_matcher,
+        exclude_start_delimiter=False,
+        exclude_end_delimiter=False,
+        ignore_end_delimiter=True,
+        nested=True,
+        min_depth=2,
+        max_depth=3,
+        track_positions=True,
     )
 
 
@@ -63,14 +121,20 @@ def test_single_delimiter_context_factory_creator(mock_init_method):
         file,
         delimiter_matcher=delimiter_matcher,
         exclude_delimiter=exclude_delimiter,
+        track_positions=False,
     )
 
 
 def test_get_context_factory_from_args_all_matchers_defined():
     args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
     args.start_delimiter_matcher = mock.MagicMock()
     args.end_delimiter_matcher = mock.MagicMock()
     args.delimiter_matcher = mock.MagicMock()
+    args.nested = False
+    args.min_depth = None
+    args.max_depth = None
     ap = mock.MagicMock()
     ap.error = mock.MagicMock()
 
@@ -81,9 +145,14 @@ def test_get_context_factory_from_args_all_matchers_defined():
 
 def test_get_context_factory_from_args_no_matchers_defined():
     args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
     args.start_delimiter_matcher = None
     args.end_delimiter_matcher = None
     args.delimiter_matcher = None
+    args.nested = False
+    args.min_depth = None
+    args.max_depth = None
     ap = mock.MagicMock()
     ap.error = mock.MagicMock()
 
@@ -95,11 +164,19 @@ def test_get_context_factory_from_args_no_matchers_defined():
 @patch('context_cli.core.start_and_end_delimiter_context_factory_creator', return_value=mock.MagicMock())
 def test_get_context_factory_from_args_start_and_end_delimiter_matchers(factory_creator_mock):
     args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
     args.start_delimiter_matcher = mock.MagicMock()
     args.end_delimiter_matcher = mock.MagicMock()
     args.exclude_start_delimiter = mock.MagicMock()
     args.exclude_end_delimiter = mock.MagicMock()
     args.ignore_end_delimiter = mock.MagicMock()
+    args.nested = False
+    args.min_depth = None
+    args.max_depth = None
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'text'
     ap = mock.MagicMock()
 
     context_factory_factory = get_context_factory_from_args(ap, args)
@@ -111,15 +188,136 @@ def test_get_context_factory_from_args_start_and_end_delimiter_matchers(factory_
         exclude_start=args.exclude_start_delimiter,
         exclude_end=args.exclude_end_delimiter,
         ignore_end_delimiter=args.ignore_end_delimiter,
+        nested=False,
+        min_depth=1,
+        max_depth=None,
+        track_positions=False,
+        engine='python',
     )
 
 
+@patch('context_cli.core.start_and_end_delimiter_context_factory_creator', return_value=mock.MagicMock())
+def test_get_context_factory_from_args_nested(factory_creator_mock):
+    args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
+    args.delimiter_matcher = None
+    args.nested = True
+    args.min_depth = None
+    args.max_depth = 2
+    args.line_number = False
+    args.byte_offset = True
+    args.format = 'text'
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    ap.error.assert_not_called()
+    factory_creator_mock.assert_called_once_with(
+        start_delimiter_matcher=args.start_delimiter_matcher,
+        end_delimiter_matcher=args.end_delimiter_matcher,
+        exclude_start=args.exclude_start_delimiter,
+        exclude_end=args.exclude_end_delimiter,
+        ignore_end_delimiter=args.ignore_end_delimiter,
+        nested=True,
+        min_depth=1,
+        max_depth=2,
+        track_positions=True,
+        engine='python',
+    )
+
+
+@patch('context_cli.core.start_and_end_delimiter_context_factory_creator', return_value=mock.MagicMock())
+def test_get_context_factory_from_args_json_lines_tracks_positions(factory_creator_mock):
+    args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
+    args.delimiter_matcher = None
+    args.nested = True
+    args.min_depth = None
+    args.max_depth = 2
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'jsonl'
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    ap.error.assert_not_called()
+    factory_creator_mock.assert_called_once_with(
+        start_delimiter_matcher=args.start_delimiter_matcher,
+        end_delimiter_matcher=args.end_delimiter_matcher,
+        exclude_start=args.exclude_start_delimiter,
+        exclude_end=args.exclude_end_delimiter,
+        ignore_end_delimiter=args.ignore_end_delimiter,
+        nested=True,
+        min_depth=1,
+        max_depth=2,
+        track_positions=True,
+        engine='python',
+    )
+
+
+def test_get_context_factory_from_args_nested_with_single_delimiter():
+    args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
+    args.start_delimiter_matcher = None
+    args.end_delimiter_matcher = None
+    args.nested = True
+    args.min_depth = None
+    args.max_depth = None
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    ap.error.assert_called_once()
+
+
+def test_get_context_factory_from_args_depth_without_nested():
+    args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
+    args.delimiter_matcher = None
+    args.nested = False
+    args.min_depth = 2
+    args.max_depth = None
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    ap.error.assert_called_once()
+
+
+def test_get_context_factory_from_args_min_depth_greater_than_max_depth():
+    args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
+    args.delimiter_matcher = None
+    args.nested = True
+    args.min_depth = 3
+    args.max_depth = 2
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    ap.error.assert_called_once_with('--min-depth cannot be greater than --max-depth')
+
+
 @patch('context_cli.core.single_delimiter_context_factory_creator', return_value=mock.MagicMock())
 def test_get_context_factory_from_args_delimiter_matchers(factory_creator_mock):
     args = mock.MagicMock()
+    args.memo_size = 0
+    args.engine = 'python'
     args.delimiter_matcher = mock.MagicMock()
     args.start_delimiter_matcher = None
     args.end_delimiter_matcher = None
+    args.nested = False
+    args.min_depth = None
+    args.max_depth = None
+    args.line_number = True
+    args.byte_offset = False
+    args.format = 'text'
     ap = mock.MagicMock()
 
     context_factory_factory = get_context_factory_from_args(ap, args)
@@ -128,9 +326,49 @@ def test_get_context_factory_from_args_delimiter_matchers(factory_creator_mock):
     factory_creator_mock.assert_called_once_with(
         delimiter_matcher=args.delimiter_matcher,
         exclude_delimiter=True,
+        track_positions=True,
+        engine='python',
     )
 
 
+@patch('context_cli.core.start_and_end_delimiter_context_factory_creator', return_value=mock.MagicMock())
+def test_get_context_factory_from_args_memo_size(factory_creator_mock):
+    args = mock.MagicMock()
+    args.memo_size = 100
+    args.delimiter_matcher = None
+    args.start_delimiter_matcher = plan_regex_matcher('^\\d{4}-\\d{2}')
+    args.end_delimiter_matcher = ContainsTextMatcher('END')
+    args.nested = False
+    args.min_depth = None
+    args.max_depth = None
+    args.format = 'text'
+    ap = mock.MagicMock()
+
+    get_context_factory_from_args(ap, args)
+
+    kwargs = factory_creator_mock.call_args.kwargs
+    assert type(kwargs['start_delimiter_matcher']) is MemoizedMatcher
+    assert kwargs['start_delimiter_matcher'].matcher is args.start_delimiter_matcher
+    assert kwargs['start_delimiter_matcher'].memo.size == 100
+    # Text matchers are not memoized
+    assert kwargs['end_delimiter_matcher'] is args.end_delimiter_matcher
+
+
+def test_get_line_memos_from_args():
+    args = construct_arg_parser().parse_args([
+        '-d', '===', '-L', 'a+', '-L!', 'b+', '-C', 'a+', '-M!', 'a+', '-c', 'a+',
+        '-q', 'contains regex "c+" or not matches regex "a+" or contains "d+"',
+    ])
+
+    assert get_line_memos_from_args(args) == {}
+
+    args.memo_size = 100
+    line_memos = get_line_memos_from_args(args)
+    # The filters that check the lines the same way share a memo
+    assert list(line_memos) == [('fullmatch', 'a+'), ('search', 'a+'), ('search', 'b+'), ('search', 'c+')]
+    assert all(type(memo) is LineMemo and memo.size == 100 for memo in line_memos.values())
+
+
 @patch('context_cli.core.NotEmptyContextFilter')
 def test_build_pipeline_no_filters(not_empty_filter_mock):
     context_factory = mock.MagicMock()
@@ -151,6 +389,207 @@ def test_build_pipeline_no_filters(not_empty_filter_mock):
     not_empty_filter_mock.assert_called_once_with(context_generator=context_factory)
 
 
+@patch('context_cli.core.UniqueContextFilter')
+@patch('context_cli.core.NotEmptyContextFilter')
+def test_build_pipeline_unique(not_empty_filter_mock, unique_filter_mock):
+    context_factory = mock.MagicMock()
+    args = mock.MagicMock()
+    args.unique_ignore = ['\\d+']
+    unique_set = DigestSet()
+
+    pipeline = build_pipeline(context_factory, args, unique_set=unique_set)
+    assert unique_filter_mock.return_value is pipeline
+    unique_filter_mock.assert_called_once_with(
+        context_generator=not_empty_filter_mock.return_value, seen=unique_set, ignore_regexps=args.unique_ignore,
+    )
+
+
+@patch('context_cli.core.QueryContextFilter')
+@patch('context_cli.core.NotEmptyContextFilter')
+def test_build_pipeline_query(not_empty_filter_mock, query_filter_mock):
+    context_factory = mock.MagicMock()
+    args = mock.MagicMock()
+    args.query = [mock.MagicMock()]
+    line_memos = {('search', 'a+'): LineMemo(10)}
+
+    build_pipeline(context_factory, args, line_memos=line_memos)
+    args.query[0].compile.assert_called_once_with(line_memos)
+    query_filter_mock.assert_called_once_with(context_generator=context_factory, query=args.query[0].compile.return_value)
+    not_empty_filter_mock.assert_called_once_with(context_generator=query_filter_mock.return_value)
+
+
+def test_query():
+    assert query('contains "a"').compile()(Context(lines=['xay']))
+    with pytest.raises(argparse.ArgumentTypeError):
+        query('contains "a" and')
+
+
+@patch('context_cli.core.SampleContextFilter')
+@patch('context_cli.core.MatchesTextContextFilter')
+@patch('context_cli.core.NotEmptyContextFilter')
+def test_build_pipeline_sampler_goes_first(not_empty_filter_mock, matches_text_filter_mock, sample_filter_mock):
+    context_factory = mock.MagicMock()
+    args = mock.MagicMock()
+    args.matches_text = ['matches this']
+    sampler = mock.MagicMock()
+
+    pipeline = build_pipeline(context_factory, args, sampler=sampler)
+    assert not_empty_filter_mock.return_value is pipeline
+    sample_filter_mock.assert_called_once_with(context_generator=context_factory, sampler=sampler)
+    matches_text_filter_mock.assert_called_once_with(
+        context_generator=sample_filter_mock.return_value, text=args.matches_text[0],
+    )
+
+
+@patch('context_cli.core.SampleContextFilter')
+@patch('context_cli.core.UniqueContextFilter')
+@patch('context_cli.core.NotEmptyContextFilter')
+def test_build_pipeline_sampler_after_unique(not_empty_filter_mock, unique_filter_mock, sample_filter_mock):
+    context_factory = mock.MagicMock()
+    args = mock.MagicMock()
+    sampler = mock.MagicMock()
+
+    pipeline = build_pipeline(context_factory, args, unique_set=DigestSet(), sampler=sampler)
+    assert sample_filter_mock.return_value is pipeline
+    sample_filter_mock.assert_called_once_with(context_generator=unique_filter_mock.return_value, sampler=sampler)
+
+
+def test_get_sampler_from_args():
+    args = mock.MagicMock()
+    args.sample = None
+    args.sample_rate = None
+    args.seed = None
+    ap = mock.MagicMock()
+
+    assert get_sampler_from_args(ap, args) is None
+
+    args.sample_rate = 0.5
+    args.seed = 10
+    sampler = get_sampler_from_args(ap, args)
+    assert isinstance(sampler, BernoulliSampler)
+    assert sampler.rate == 0.5
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('sample,sample_rate,seed', [
+    (10, 0.5, None),
+    (None, None, 10),
+])
+def test_get_sampler_from_args_errors(sample, sample_rate, seed):
+    args = mock.MagicMock()
+    args.sample = sample
+    args.sample_rate = sample_rate
+    args.seed = seed
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_sampler_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
+@pytest.mark.parametrize('before,after,around,expected', [
+    (None, None, None, (0, 0)),
+    (2, None, None, (2, 0)),
+    (None, 3, None, (0, 3)),
+    (None, None, 4, (4, 4)),
+    (1, None, 4, (1, 4)),
+    (0, 2, 4, (0, 2)),
+])
+def test_get_window_sizes(before, after, around, expected):
+    args = mock.MagicMock()
+    args.contexts_before = before
+    args.contexts_after = after
+    args.contexts_around = around
+
+    assert get_window_sizes(args) == expected
+
+
+@patch('context_cli.core.build_pipeline')
+def test_write_pipeline_no_windows(build_pipeline_fn):
+    context_factory = mock.MagicMock()
+    args = mock.MagicMock()
+    args.contexts_before = None
+    args.contexts_after = 0
+    args.contexts_around = None
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'text'
+
+    build_pipeline_fn.return_value = iter([Context(lines=['a']), Context(lines=['b']), Context(lines=['c'])])
+    output = mock.MagicMock()
+
+    assert write_pipeline(context_factory, args, output, limit=2, sampler=None) == 2
+    build_pipeline_fn.assert_called_once_with(context_factory, args, sampler=None)
+    assert [call.args[0].lines for call in output.write.call_args_list] == [['a'], ['b']]
+
+
+@pytest.mark.parametrize('limit,expected_lines,expected_written', [
+    (None, [['b'], ['c'], ['d'], ['e'], ['f']], 2),
+    (1, [['b'], ['c'], ['d']], 1),
+    (0, [], 0),
+])
+def test_write_pipeline(limit, expected_lines, expected_written):
+    context_factory = [Context(lines=[line]) for line in ['a', 'b', 'c', 'd', 'e', 'f']]
+    args = mock.MagicMock()
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = 1
+    args.matches_text = []
+    args.not_matches_text = []
+    args.contains_text = []
+    args.not_contains_text = []
+    args.matches_regex = ['[ce]']
+    args.not_matches_regex = []
+    args.contains_regex = []
+    args.not_contains_regex = []
+    args.line_contains_text = []
+    args.not_line_contains_text = []
+    args.line_contains_regex = []
+    args.not_line_contains_regex = []
+
+    output = mock.MagicMock()
+
+    # Only the matching contexts count for the limit, not the ones around them
+    assert write_pipeline(context_factory, args, output, limit=limit) == expected_written
+    assert [call.args[0].lines for call in output.write.call_args_list] == expected_lines
+
+
+def test_get_unique_set_from_args():
+    args = mock.MagicMock()
+    args.unique = False
+    args.unique_error_rate = None
+    args.unique_ignore = []
+    ap = mock.MagicMock()
+
+    assert get_unique_set_from_args(ap, args) is None
+
+    args.unique = True
+    assert isinstance(get_unique_set_from_args(ap, args), DigestSet)
+
+    args.unique_error_rate = 0.01
+    args.unique_capacity = 1000
+    unique_set = get_unique_set_from_args(ap, args)
+    assert isinstance(unique_set, BloomFilter)
+    assert unique_set.num_hashes == 7
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('unique_error_rate,unique_ignore', [
+    (0.01, []),
+    (None, ['regex']),
+])
+def test_get_unique_set_from_args_without_unique(unique_error_rate, unique_ignore):
+    args = mock.MagicMock()
+    args.unique = False
+    args.unique_error_rate = unique_error_rate
+    args.unique_ignore = unique_ignore
+    ap = mock.MagicMock()
+
+    get_unique_set_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
 @patch('context_cli.core.MatchesTextContextFilter')
 @patch('context_cli.core.NotEmptyContextFilter')
 def test_build_pipeline_matches_text_filter(not_empty_filter_mock, matches_text_filter_mock):
@@ -212,7 +651,9 @@ def test_build_pipeline_matches_regex_filter(not_empty_filter_mock, matches_rege
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    matches_regex_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.matches_regex[0])
+    matches_regex_filter_mock.assert_called_once_with(
+        context_generator=context_factory, regexp=args.matches_regex[0], memo=None,
+    )
     not_empty_filter_mock.assert_called_once_with(context_generator=matches_regex_filter_mock.return_value)
 
 
@@ -225,7 +666,9 @@ def test_build_pipeline_not_matches_regex_filter(not_empty_filter_mock, not_matc
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    not_matches_regex_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.not_matches_regex[0])
+    not_matches_regex_filter_mock.assert_called_once_with(
+        context_generator=context_factory, regexp=args.not_matches_regex[0], memo=None,
+    )
     not_empty_filter_mock.assert_called_once_with(context_generator=not_matches_regex_filter_mock.return_value)
 
 
@@ -238,7 +681,9 @@ def test_build_pipeline_contains_regex_filter(not_empty_filter_mock, contains_re
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    contains_regex_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.contains_regex[0])
+    contains_regex_filter_mock.assert_called_once_with(
+        context_generator=context_factory, regexp=args.contains_regex[0], memo=None,
+    )
     not_empty_filter_mock.assert_called_once_with(context_generator=contains_regex_filter_mock.return_value)
 
 
@@ -251,7 +696,9 @@ def test_build_pipeline_not_contains_regex_filter(not_empty_filter_mock, not_con
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    not_contains_regex_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.not_contains_regex[0])
+    not_contains_regex_filter_mock.assert_called_once_with(
+        context_generator=context_factory, regexp=args.not_contains_regex[0], memo=None,
+    )
     not_empty_filter_mock.assert_called_once_with(context_generator=not_contains_regex_filter_mock.return_value)
 
 
@@ -290,7 +737,8 @@ def test_build_pipeline_contains_regex_line_filter(not_empty_filter_mock, contai
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    contains_regex_line_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.line_contains_regex[0])
+    contains_regex_line_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.line_contains_regex[0],
+                                                            memo=None)
     not_empty_filter_mock.assert_called_once_with(context_generator=contains_regex_line_filter_mock.return_value)
 
 
@@ -303,10 +751,398 @@ def test_build_pipeline_not_contains_regex_line_filter(not_empty_filter_mock, no
 
     pipeline = build_pipeline(context_factory, args)
     assert not_empty_filter_mock.return_value is pipeline
-    not_contains_regex_line_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.not_line_contains_regex[0])
+    not_contains_regex_line_filter_mock.assert_called_once_with(context_generator=context_factory, regexp=args.not_line_contains_regex[0],
+                                                                memo=None)
     not_empty_filter_mock.assert_called_once_with(context_generator=not_contains_regex_line_filter_mock.return_value)
 
 
+def test_get_output_from_args_text():
+    args = mock.MagicMock()
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.output_delimiter = '---'
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, TextOutput)
+    assert output.output_delimiter == '---'
+    ap.error.assert_not_called()
+
+
+def test_get_output_from_args_count():
+    args = mock.MagicMock()
+    args.count = True
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    ap = mock.MagicMock()
+
+    assert isinstance(get_output_from_args(ap, args), CountOutput)
+
+
+def test_get_output_from_args_files_with_matches():
+    args = mock.MagicMock()
+    args.count = False
+    args.files_with_matches = True
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    ap = mock.MagicMock()
+
+    assert isinstance(get_output_from_args(ap, args), FilesWithMatchesOutput)
+
+
+def test_get_output_from_args_count_and_files_with_matches():
+    args = mock.MagicMock()
+    args.count = True
+    args.files_with_matches = True
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    ap = mock.MagicMock()
+
+    get_output_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
+def test_get_output_from_args_split_by(tmp_path):
+    args = mock.MagicMock()
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = r'tenant=(\w+)'
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.out_dir = str(tmp_path)
+    args.output_delimiter = '---'
+    args.max_open_files = 4
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, SplitOutput)
+    assert output.output_delimiter == '---'
+    assert output.pool.max_open_files == 4
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('count,files_with_matches,out_dir', [
+    (True, False, 'out'),
+    (False, True, 'out'),
+    (False, False, None),
+])
+def test_get_output_from_args_split_by_errors(count, files_with_matches, out_dir):
+    args = mock.MagicMock()
+    args.count = count
+    args.files_with_matches = files_with_matches
+    args.split_by = 'regex'
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.out_dir = out_dir
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_output_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
+def test_get_output_from_args_group_by():
+    args = mock.MagicMock()
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = r'status=(\d+)'
+    args.group_value = r'took=(\d+)'
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, GroupByOutput)
+    assert output.value_regexp.pattern == r'took=(\d+)'
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('count,split_by,group_by,group_value', [
+    (True, None, 'regex', None),
+    (False, 'regex', 'regex', None),
+    (False, None, None, 'regex'),
+])
+def test_get_output_from_args_group_by_errors(count, split_by, group_by, group_value):
+    args = mock.MagicMock()
+    args.count = count
+    args.files_with_matches = False
+    args.split_by = split_by
+    args.group_by = group_by
+    args.group_value = group_value
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.format = 'text'
+    args.out_dir = 'out'
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_output_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
+def get_sort_args(**kwargs):
+    args = mock.MagicMock()
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.sort_memory = 1024
+    args.format = 'text'
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.output_delimiter = ''
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def test_get_output_from_args_sort_by():
+    args = get_sort_args(sort_by=r'took=(\d+)', sort_numeric=True, sort_reverse=True)
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, SortedOutput)
+    assert isinstance(output.output, TextOutput)
+    assert output.numeric
+    assert output.sorter.reverse
+    assert output.sorter.memory == 1024
+    ap.error.assert_not_called()
+
+
+def test_get_output_from_args_sort_by_and_split_by(tmp_path):
+    args = get_sort_args(sort_by=r'(\d+)', split_by=r'(\w+)', out_dir=str(tmp_path), max_open_files=4)
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, SortedOutput)
+    assert isinstance(output.output, SplitOutput)
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('output_format,output_class', [('jsonl', JsonLinesOutput), ('binary', FramedOutput)])
+def test_get_output_from_args_format(output_format, output_class):
+    args = get_sort_args(format=output_format, sort_by=r'(\d+)')
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, SortedOutput)
+    assert isinstance(output.output, output_class)
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('option', ['count', 'files_with_matches', 'group_by', 'split_by'])
+def test_get_output_from_args_format_with_output_mode(option):
+    args = get_sort_args(**{'format': 'jsonl', option: r'(\w+)' if option.endswith('_by') else True})
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_output_from_args(ap, args)
+    ap.error.assert_called_once_with(f'--format jsonl cannot be used with --{option.replace("_", "-")}')
+
+
+@pytest.mark.parametrize('option,largest', [('top', True), ('bottom', False)])
+def test_get_output_from_args_top(option, largest):
+    args = get_sort_args(**{option: 5, 'by': r'took=(\d+)'})
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, TopOutput)
+    assert isinstance(output.output, TextOutput)
+    assert output.k == 5
+    assert output.largest == largest
+    ap.error.assert_not_called()
+
+
+def test_get_output_from_args_sample_then_sort():
+    args = get_sort_args(sample=10, seed=1, sort_by=r'(\d+)')
+    ap = mock.MagicMock()
+
+    output = get_output_from_args(ap, args)
+    assert isinstance(output, SampleOutput)
+    assert output.sampler.k == 10
+    assert isinstance(output.output, SortedOutput)
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'sort_by': 'regex', 'count': True},
+    {'sort_by': 'regex', 'files_with_matches': True},
+    {'sort_by': 'regex', 'group_by': 'regex'},
+    {'sort_numeric': True},
+    {'sort_reverse': True},
+    {'top': 5, 'by': 'regex', 'count': True},
+    {'bottom': 5, 'by': 'regex', 'group_by': 'regex'},
+    {'top': 5, 'by': 'regex', 'sort_by': 'regex'},
+    {'top': 5, 'bottom': 5, 'by': 'regex'},
+    {'top': 5},
+    {'by': 'regex'},
+    {'sample': 5, 'count': True},
+])
+def test_get_output_from_args_sort_by_errors(kwargs):
+    args = get_sort_args(**kwargs)
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_output_from_args(ap, args)
+    ap.error.assert_called_once()
+
+
+def test_get_max_count_per_file_no_limits():
+    args = mock.MagicMock()
+    args.max_count = None
+    output = mock.MagicMock()
+    output.max_count_per_file = None
+
+    assert get_max_count_per_file(args, output) is None
+
+
+def test_get_max_count_per_file_uses_smallest_limit():
+    args = mock.MagicMock()
+    args.max_count = 10
+    output = mock.MagicMock()
+    output.max_count_per_file = 1
+
+    assert get_max_count_per_file(args, output) == 1
+
+    output.max_count_per_file = None
+    assert get_max_count_per_file(args, output) == 10
+
+
+def test_positive_int():
+    assert positive_int('1') == 1
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        positive_int('0')
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('1024', 1024),
+    ('64K', 64 * 1024),
+    ('512m', 512 * 1024 ** 2),
+    ('1.5G', 3 * 1024 ** 3 // 2),
+])
+def test_byte_size(value, expected):
+    assert byte_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['0', '-1K', 'K', '', 'abc', '10T'])
+def test_byte_size_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        byte_size(value)
+
+
+@pytest.mark.parametrize('value', ['0', '1', '-0.5', '1.5', 'abc'])
+def test_fraction_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        fraction(value)
+
+
+def test_fraction():
+    assert fraction('0.01') == 0.01
+    assert fraction('1e-6') == 1e-6
+
+
+def test_non_negative_int():
+    assert non_negative_int('0') == 0
+    assert non_negative_int('10') == 10
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        non_negative_int('-1')
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        non_negative_int('ten')
+
+
 def test_construct_arg_parser():
     ap = construct_arg_parser()
     assert ap is not None
@@ -330,13 +1166,9 @@ def test_parse_args_write_and_files(ctxrc_cls, path_cls):
     args = mock.MagicMock()
     ap = mock.MagicMock()
     ap.parse_args.return_value = args
-    args.type = 'some_type'
+    args.type = ['some_type']
     args.write = True
-    file = mock.MagicMock()
-    file.name = 'not <stdin>'
-    args.files = [
-        file
-    ]
+    args.files = ['file']
 
     parse_args(ap, ['ctx', 'argv'])
     ap.error.assert_called_once()
@@ -351,13 +1183,11 @@ def test_parse_args_write_and_no_files(ctxrc_cls, path_cls):
     args = mock.MagicMock()
     ap = mock.MagicMock()
     ap.parse_args.return_value = args
-    args.type = 'some_type'
+    args.type = ['some_type']
     args.write = True
-    file = mock.MagicMock()
-    file.name = '<stdin>'
-    args.files = [
-        file
-    ]
+    args.files = []
+    args.files_from = None
+    args.memo_size = 0
 
     parse_args(ap, ['ctx', 'argv'])
     ctxrc.add_type.assert_called_once_with('some_type', ['argv'])
@@ -378,7 +1208,18 @@ def test_parse_args_arg_does_not_exist(ctxrc_cls, path_cls):
     args.write = False
     ap = mock.MagicMock()
     ap.parse_args.return_value = args
-    args.type = type_arg
+    args.type = [type_arg]
+    args.out_dir = None
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
 
     parse_args(ap, ['ctx', 'argv'])
 
@@ -403,7 +1244,18 @@ def test_parse_args_arg_exists(ctxrc_cls, path_cls):
     ]
     ap = mock.MagicMock()
     ap.parse_args.return_value = args
-    args.type = type_arg
+    args.type = [type_arg]
+    args.out_dir = None
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
 
     new_args = parse_args(ap, argv)
     ap.parse_args.assert_called_with(type_argv + argv[1:])
@@ -425,7 +1277,42 @@ def test_main(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_a
     file1 = mock.MagicMock()
     file2 = mock.MagicMock()
     args.files = [file1, file2]
+    args.files_from = None
+    args.memo_size = 0
     args.output_delimiter = 'output_delimiter'
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.unique = False
+    args.unique_error_rate = None
+    args.unique_ignore = []
+    args.sample_rate = None
+    args.seed = None
+    args.max_count = None
+    args.max_total = None
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'text'
+    args.recursive = False
+    args.include = []
+    args.exclude = []
+    args.no_ignore = False
+    args.prefetch = 0
+    args.prefetch_memory = 1024
+    args.read_ahead = False
+    args.type_args = None
     parse_args_fn.return_value = args
     context_factory_factory = mock.MagicMock()
     get_context_factory_from_args_fn.return_value = context_factory_factory
@@ -437,10 +1324,11 @@ def test_main(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_a
     pipeline = [context1, context2]
     build_pipeline_fn.return_value = pipeline
 
-    return_value = main(argv)
+    with patch('context_cli.core.open_file', side_effect=lambda file, prefetch_size, budget=None: file):
+        return_value = main(argv)
     assert 0 == return_value
     parse_args_fn.assert_called_once_with(ap, argv)
-    get_context_factory_from_args_fn.assert_called_once_with(ap, args)
+    get_context_factory_from_args_fn.assert_called_once_with(ap, args, memos={})
     context_factory_factory.assert_any_call(file1)
     context_factory_factory.assert_any_call(file2)
     sys.stdout.write.assert_any_call(args.output_delimiter)
@@ -449,3 +1337,715 @@ def test_main(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_a
     sys.stdout.write.assert_any_call("context2\n")
 
 
+
+
+@patch('context_cli.core.sys')
+@patch('context_cli.core.build_pipeline')
+@patch('context_cli.core.get_context_factory_from_args')
+@patch('context_cli.core.parse_args')
+@patch('context_cli.core.construct_arg_parser')
+def test_main_files_with_matches_stops_at_first_context(construct_arg_parser_fn, parse_args_fn,
+                                                        get_context_factory_from_args_fn, build_pipeline_fn, sys):
+    args = mock.MagicMock()
+    file1 = mock.MagicMock()
+    file1.name = 'file1.txt'
+    file2 = mock.MagicMock()
+    file2.name = 'file2.txt'
+    args.files = [file1, file2]
+    args.files_from = None
+    args.memo_size = 0
+    args.count = False
+    args.files_with_matches = True
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.unique = False
+    args.unique_error_rate = None
+    args.unique_ignore = []
+    args.sample_rate = None
+    args.seed = None
+    args.max_count = None
+    args.max_total = None
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'text'
+    args.recursive = False
+    args.include = []
+    args.exclude = []
+    args.no_ignore = False
+    args.prefetch = 0
+    args.prefetch_memory = 1024
+    args.read_ahead = False
+    args.type_args = None
+    parse_args_fn.return_value = args
+
+    consumed = []
+
+    def pipeline_for(file):
+        def pipeline():
+            for i in range(3):
+                consumed.append((file, i))
+                yield mock.MagicMock()
+        return pipeline()
+
+    get_context_factory_from_args_fn.return_value = lambda file: file
+    build_pipeline_fn.side_effect = lambda file, args, unique_set, sampler, line_memos: pipeline_for(file) if file is file1 else iter([])
+
+    with patch('context_cli.core.open_file', side_effect=lambda file, prefetch_size, budget=None: file):
+        assert 0 == main(['ctx'])
+    assert consumed == [(file1, 0)]
+    sys.stdout.write.assert_any_call('file1.txt')
+    assert mock.call('file2.txt') not in sys.stdout.write.call_args_list
+
+
+def run_main_with_limits(build_pipeline_fn, get_context_factory_from_args_fn, parse_args_fn, max_count, max_total):
+    args = mock.MagicMock()
+    files = [mock.MagicMock(), mock.MagicMock()]
+    args.files = files
+    args.files_from = None
+    args.memo_size = 0
+    args.count = False
+    args.files_with_matches = False
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+    args.unique = False
+    args.unique_error_rate = None
+    args.unique_ignore = []
+    args.sample_rate = None
+    args.seed = None
+    args.max_count = max_count
+    args.max_total = max_total
+    args.contexts_before = None
+    args.contexts_after = None
+    args.contexts_around = None
+    args.line_number = False
+    args.byte_offset = False
+    args.format = 'text'
+    args.recursive = False
+    args.include = []
+    args.exclude = []
+    args.no_ignore = False
+    args.prefetch = 0
+    args.prefetch_memory = 1024
+    args.read_ahead = False
+    args.type_args = None
+    args.output_delimiter = ''
+    parse_args_fn.return_value = args
+
+    consumed = []
+
+    def pipeline_for(file):
+        for i in range(5):
+            consumed.append((file, i))
+            context = mock.MagicMock()
+            context.__str__.return_value = f'context{i}'
+            yield context
+
+    get_context_factory_from_args_fn.return_value = lambda file: file
+    build_pipeline_fn.side_effect = lambda file, args, unique_set, sampler, line_memos: pipeline_for(file)
+
+    with patch('context_cli.core.open_file', side_effect=lambda file, prefetch_size, budget=None: file):
+        assert 0 == main(['ctx'])
+    for file in files:
+        file.close.assert_called_once()
+    return files, consumed
+
+
+@patch('context_cli.core.sys')
+@patch('context_cli.core.build_pipeline')
+@patch('context_cli.core.get_context_factory_from_args')
+@patch('context_cli.core.parse_args')
+@patch('context_cli.core.construct_arg_parser')
+def test_main_max_count(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_args_fn, build_pipeline_fn,
+                        sys):
+    files, consumed = run_main_with_limits(
+        build_pipeline_fn, get_context_factory_from_args_fn, parse_args_fn, max_count=2, max_total=None,
+    )
+
+    assert consumed == [(files[0], 0), (files[0], 1), (files[1], 0), (files[1], 1)]
+
+
+@patch('context_cli.core.sys')
+@patch('context_cli.core.build_pipeline')
+@patch('context_cli.core.get_context_factory_from_args')
+@patch('context_cli.core.parse_args')
+@patch('context_cli.core.construct_arg_parser')
+def test_main_max_total(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_args_fn, build_pipeline_fn,
+                        sys):
+    files, consumed = run_main_with_limits(
+        build_pipeline_fn, get_context_factory_from_args_fn, parse_args_fn, max_count=None, max_total=3,
+    )
+
+    # The second file is never read
+    assert consumed == [(files[0], 0), (files[0], 1), (files[0], 2)]
+    build_pipeline_fn.assert_called_once()
+
+
+@patch('context_cli.core.sys')
+@patch('context_cli.core.build_pipeline')
+@patch('context_cli.core.get_context_factory_from_args')
+@patch('context_cli.core.parse_args')
+@patch('context_cli.core.construct_arg_parser')
+def test_main_max_count_and_max_total(construct_arg_parser_fn, parse_args_fn, get_context_factory_from_args_fn,
+                                      build_pipeline_fn, sys):
+    files, consumed = run_main_with_limits(
+        build_pipeline_fn, get_context_factory_from_args_fn, parse_args_fn, max_count=2, max_total=3,
+    )
+
+    assert consumed == [(files[0], 0), (files[0], 1), (files[1], 0)]
+
+
+def test_get_file_limit():
+    assert get_file_limit(None, None, 10) is None
+    assert get_file_limit(5, None, 10) == 5
+    assert get_file_limit(None, 15, 10) == 5
+    assert get_file_limit(3, 15, 10) == 3
+    assert get_file_limit(None, 15, 20) == 0
+
+
+@patch('context_cli.core.Path')
+@patch('context_cli.core.CtxRc')
+def test_parse_args_write_multiple_types(ctxrc_cls, path_cls):
+    ctxrc = mock.MagicMock()
+    ctxrc_cls.from_path.return_value = ctxrc
+    path_cls.home.return_value = Path(HOME_PATH)
+    args = mock.MagicMock()
+    ap = mock.MagicMock()
+    ap.parse_args.return_value = args
+    args.type = ['type1', 'type2']
+    args.write = True
+
+    parse_args(ap, ['ctx', 'argv'])
+    ap.error.assert_called_once()
+    ctxrc.add_type.assert_not_called()
+
+
+@patch('context_cli.core.Path')
+@patch('context_cli.core.CtxRc')
+def test_parse_args_multiple_types_without_out_dir(ctxrc_cls, path_cls):
+    ctxrc_cls.from_path.return_value = mock.MagicMock()
+    path_cls.home.return_value = Path(HOME_PATH)
+    args = mock.MagicMock()
+    ap = mock.MagicMock()
+    ap.parse_args.return_value = args
+    args.type = ['type1', 'type2']
+    args.write = False
+    args.out_dir = None
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+
+    parse_args(ap, ['ctx', 'argv'])
+    ap.error.assert_called_once()
+
+
+def test_parse_args_out_dir_without_type():
+    args = mock.MagicMock()
+    ap = mock.MagicMock()
+    ap.parse_args.return_value = args
+    args.type = None
+    args.out_dir = 'some/dir'
+    args.split_by = None
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+
+    parse_args(ap, ['ctx', 'argv'])
+    ap.error.assert_called_once()
+
+
+def test_parse_args_out_dir_with_split_by_without_type():
+    args = mock.MagicMock()
+    ap = mock.MagicMock()
+    ap.parse_args.return_value = args
+    args.type = None
+    args.out_dir = 'some/dir'
+    args.split_by = 'regex'
+    args.group_by = None
+    args.group_value = None
+    args.sort_by = None
+    args.sort_numeric = False
+    args.sort_reverse = False
+    args.top = None
+    args.bottom = None
+    args.by = None
+    args.sample = None
+
+    assert parse_args(ap, ['ctx', 'argv']) is args
+    ap.error.assert_not_called()
+
+
+def write_ctxrc(home, types):
+    ctxrc = CtxRc(None)
+    for type, type_argv in types.items():
+        # Same argv that `ctx -t type -w ...` saves
+        ctxrc.add_type(type, ['-t', type, '-w'] + type_argv)
+    ctxrc.save(home / '.ctxrc')
+
+
+def test_main_multiple_types(tmp_path):
+    home = tmp_path / 'home'
+    home.mkdir()
+    write_ctxrc(home, {
+        'dashes': ['-d', '==='],
+        'hello': ['-d', '===', '-c', 'hello'],
+        'count': ['-d', '===', '--count'],
+    })
+
+    input_path = tmp_path / 'input.txt'
+    input_path.write_text('hello\n===\nworld\n===\nhello world\n')
+    out_dir = tmp_path / 'out'
+
+    with patch.object(Path, 'home', return_value=home):
+        assert 0 == main(['ctx', '-t', 'dashes', '-t', 'hello', '-t', 'count', '--out-dir', str(out_dir), str(input_path)])
+
+    assert (out_dir / 'dashes').read_text() == 'hello\nworld\nhello world\n'
+    assert (out_dir / 'hello').read_text() == 'hello\nhello world\n'
+    assert (out_dir / 'count').read_text() == '3\n'
+
+    with patch.object(Path, 'home', return_value=home):
+        assert ERROR_EXIT_STATUS == main(
+            ['ctx', '-t', 'dashes', '-t', 'hello', '--out-dir', str(out_dir), str(tmp_path / 'missing.txt')],
+        )
+
+
+def test_main_logs_memo_stats(tmp_path, caplog):
+    input_path = tmp_path / 'input.txt'
+    input_path.write_text('ERROR a\nok\n===\nERROR a\n===\nok\n')
+    caplog.set_level(logging.DEBUG, logger='context_cli.core')
+
+    assert 0 == main(['ctx', '-d', '===', '-C', 'ERROR', '-q', 'contains regex "ERROR"', '--memo-size', '10',
+                      str(input_path)])
+    assert "Memo of search 'ERROR': LineMemo(enabled, 3 hits, 2 misses, 60.0% hit rate)" in caplog.text
+
+
+def test_main_multiple_types_decode_error(tmp_path, caplog):
+    home = tmp_path / 'home'
+    home.mkdir()
+    write_ctxrc(home, {'hello': ['-d', '===', '-c', 'hello'], 'count': ['-d', '===', '--count']})
+
+    # The invalid byte is after the part of the file that is checked before reading it
+    bad_path = tmp_path / 'bad.txt'
+    bad_path.write_bytes(b'hello\n===\n' + b'x' * 10000 + b'\n===\nhello \xff\n')
+    good_path = tmp_path / 'good.txt'
+    good_path.write_text('hello good\n')
+    out_dir = tmp_path / 'out'
+
+    with patch.object(Path, 'home', return_value=home):
+        assert ERROR_EXIT_STATUS == main(
+            ['ctx', '-t', 'hello', '-t', 'count', '--out-dir', str(out_dir), str(bad_path), str(good_path)],
+        )
+
+    assert 'Cannot decode' in caplog.text
+    # The rest of the files are still read
+    assert (out_dir / 'hello').read_text() == 'hello\nhello good\n'
+    assert (out_dir / 'count').read_text() == f'{bad_path}:2\n{good_path}:1\ntotal:3\n'
+
+
+def test_main_multiple_types_same_positions(tmp_path, capsys):
+    home = tmp_path / 'home'
+    home.mkdir()
+    write_ctxrc(home, {'positions': ['-d', '===', '--byte-offset', '-n'], 'other': ['-d', '===']})
+    input_path = tmp_path / 'input.txt'
+    input_path.write_bytes('a\r\nñandú\r\n===\r\nb\r\n€\r\n'.encode('utf-8'))
+    out_dir = tmp_path / 'out'
+
+    assert 0 == main(['ctx', '-d', '===', '--byte-offset', '-n', str(input_path)])
+    expected = capsys.readouterr().out
+    with patch.object(Path, 'home', return_value=home):
+        assert 0 == main(['ctx', '-t', 'positions', '-t', 'other', '--out-dir', str(out_dir), str(input_path)])
+
+    assert (out_dir / 'positions').read_text() == expected
+
+
+def get_walker_args(**kwargs):
+    args = mock.MagicMock()
+    args.files = []
+    args.recursive = False
+    args.include = []
+    args.exclude = []
+    args.no_ignore = False
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def test_get_file_walker_from_args():
+    ap = mock.MagicMock()
+
+    assert get_file_walker_from_args(ap, get_walker_args()) is None
+    file_walker = get_file_walker_from_args(ap, get_walker_args(recursive=True, include=['*.log'], no_ignore=True))
+    assert file_walker.includes == ['*.log']
+    assert file_walker.ignore_file_names == ()
+    ap.error.assert_not_called()
+
+
+@pytest.mark.parametrize('kwargs', [{'include': ['*.log']}, {'exclude': ['*.log']}, {'no_ignore': True}])
+def test_get_file_walker_from_args_requires_recursive(kwargs):
+    ap = mock.MagicMock()
+    ap.error.side_effect = SystemExit
+
+    with pytest.raises(SystemExit):
+        get_file_walker_from_args(ap, get_walker_args(**kwargs))
+
+
+def test_iter_files(tmp_path, caplog):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'b.log').write_text('b\n')
+    (tmp_path / 'a.log').write_text('a\n')
+    paths = [str(tmp_path / 'a.log'), str(tmp_path / 'missing.log'), str(tmp_path / 'dir')]
+
+    names = []
+    errors = []
+    for file in iter_files(iter(paths), FileWalker(), errors=errors):
+        names.append(file.name)
+        file.close()
+
+    assert names == [str(tmp_path / 'a.log'), str(tmp_path / 'dir' / 'b.log')]
+    assert errors == [str(tmp_path / 'missing.log')]
+    assert 'Cannot open' in caplog.text
+
+
+def test_iter_files_opens_files_lazily(tmp_path):
+    (tmp_path / 'a.log').write_text('a\n')
+    (tmp_path / 'b.log').write_text('b\n')
+
+    with patch('context_cli.core.open_file', side_effect=open_file) as open_file_fn:
+        files = iter_files([str(tmp_path / 'a.log'), str(tmp_path / 'b.log')], None)
+        next(files).close()
+        assert open_file_fn.call_count == 1
+        next(files).close()
+        assert open_file_fn.call_count == 2
+
+
+def test_iter_files_prefetch(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    paths = []
+    for i in range(5):
+        (tmp_path / 'dir' / f'{i}.log').write_text(f'{i}\n' * 1000)
+        paths.append(str(tmp_path / 'dir' / f'{i}.log'))
+
+    contents = []
+    for file in iter_files(paths + [str(tmp_path / 'missing.log'), str(tmp_path / 'dir')], FileWalker(), prefetch=2,
+                           prefetch_memory=1024):
+        contents.append(file.read())
+        file.close()
+
+    expected = [f'{i}\n' * 1000 for i in range(5)]
+    assert contents == expected + expected
+
+
+def test_iter_files_prefetch_memory(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    paths = [str(tmp_path / 'dir')]
+    for i in range(6):
+        (tmp_path / 'dir' / f'{i}.log').write_text(f'{i}\n' * 1000)
+        (tmp_path / f'{i}.log').write_text(f'{i}\n' * 1000)
+        paths.append(str(tmp_path / f'{i}.log'))
+
+    prefetched_files = []
+    held = []
+
+    class RecordingPrefetchedRawFile(PrefetchedRawFile):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            prefetched_files.append(self)
+            held.append(sum(len(file.data) for file in prefetched_files))
+
+    contents = []
+    with patch('context_cli.prefetch.PrefetchedRawFile', RecordingPrefetchedRawFile):
+        for file in iter_files(paths, FileWalker(), prefetch=2, prefetch_memory=3000):
+            contents.append(file.read())
+            file.close()
+
+    expected = [f'{i}\n' * 1000 for i in range(6)]
+    assert contents == expected + expected
+    # The paths after the directory are opened ahead while its files are read, but they all share the same memory
+    assert max(held) <= 3000
+    assert sum(len(file.data) for file in prefetched_files) == 0
+
+
+def test_iter_files_directory_without_recursive(tmp_path, caplog):
+    errors = []
+    assert list(iter_files([str(tmp_path)], None, errors=errors)) == []
+    assert errors == [str(tmp_path)]
+    assert 'is a directory' in caplog.text
+
+
+@patch('context_cli.core.sys')
+def test_open_file_stdin(sys):
+    assert open_file('-') is sys.stdin
+
+
+@pytest.mark.parametrize('content', [b'a.log\nb c.log\n\nd.log', b'a.log\r\nb c.log\r\nd.log\r\n',
+                                     b'a.log\0b c.log\0d.log\0'])
+def test_read_file_list(tmp_path, content):
+    path = tmp_path / 'files.txt'
+    path.write_bytes(content)
+
+    assert list(read_file_list(str(path))) == ['a.log', 'b c.log', 'd.log']
+    # Paths split across chunks
+    assert list(read_file_list(str(path), chunk_size=3)) == ['a.log', 'b c.log', 'd.log']
+
+
+@patch('context_cli.core.sys')
+def test_read_file_list_stdin(sys):
+    sys.stdin.buffer = io.BytesIO(b'a.log\nb.log\n')
+
+    assert list(read_file_list('-')) == ['a.log', 'b.log']
+
+
+@patch('context_cli.core.read_file_list', return_value=iter(['c.log']))
+def test_get_paths(read_file_list_fn):
+    args = mock.MagicMock()
+    args.files = []
+    args.files_from = None
+    args.memo_size = 0
+    assert list(get_paths(args)) == ['-']
+
+    args.files = ['a.log', 'b.log']
+    assert list(get_paths(args)) == ['a.log', 'b.log']
+
+    args.files_from = 'files.txt'
+    assert list(get_paths(args)) == ['a.log', 'b.log', 'c.log']
+    read_file_list_fn.assert_called_once_with('files.txt')
+
+
+def test_main_recursive(tmp_path, capsys):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'one.log').write_text('hello\n===\nworld\n')
+    (tmp_path / 'a' / 'two.txt').write_text('hello there\n')
+    (tmp_path / 'b.log').write_text('hello again\n')
+
+    assert 0 == main(['ctx', '-d', '===', '-c', 'hello', '-r', '--include', '*.log', str(tmp_path)])
+
+    assert capsys.readouterr().out == 'hello again\nhello\n'
+
+
+def test_main_recursive_unreadable_directory(tmp_path, capsys):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'one.log').write_text('hello\n')
+    (tmp_path / 'b.log').write_text('hello again\n')
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if path == str(tmp_path / 'a'):
+            raise PermissionError(13, 'Permission denied')
+        return scandir(path)
+
+    with patch('os.scandir', side_effect=failing_scandir):
+        assert ERROR_EXIT_STATUS == main(['ctx', '-d', '===', '-r', str(tmp_path)])
+    assert capsys.readouterr().out == 'hello again\n'
+
+
+def test_main_missing_file(tmp_path, capsys, caplog):
+    (tmp_path / 'a.log').write_text('hello\n')
+    paths = [str(tmp_path / 'missing.log'), str(tmp_path / 'a.log')]
+
+    # The rest of the files are still read
+    assert ERROR_EXIT_STATUS == main(['ctx', '-d', '===', '-c', 'hello'] + paths)
+    assert capsys.readouterr().out == 'hello\n'
+    assert 'Cannot open' in caplog.text
+
+    assert ERROR_EXIT_STATUS == main(['ctx', '-d', '===', '--count'] + paths)
+    assert ERROR_EXIT_STATUS == main(['ctx', '-d', '===', str(tmp_path)])
+    assert 0 == main(['ctx', '-d', '===', '-r', str(tmp_path)])
+
+
+def test_main_skips_binary_files(tmp_path, capsys):
+    (tmp_path / 'a.bin').write_bytes(b'hello\x00\x01\n')
+    (tmp_path / 'b.log').write_text('hello\n')
+
+    assert 0 == main(['ctx', '-d', '===', '-c', 'hello', str(tmp_path / 'a.bin'), str(tmp_path / 'b.log')])
+    assert capsys.readouterr().out == 'hello\n'
+
+    assert 0 == main(['ctx', '-d', '===', '-c', 'hello', '--binary-files', 'text', str(tmp_path / 'a.bin')])
+    assert capsys.readouterr().out == 'hello\x00\x01\n'
+
+
+def test_main_decode_error_after_the_start_of_the_file(tmp_path, capsys, caplog):
+    # The error is past the part of the file that is checked before reading it
+    (tmp_path / 'a.log').write_bytes(b'hello\n===\n' + b'x' * 10000 + b'\n===\nhello \xff\n')
+    (tmp_path / 'b.log').write_text('hello b\n')
+
+    # The rest of the files are still read but, like a file that can't be opened, it sets the exit status
+    paths = [str(tmp_path / 'a.log'), str(tmp_path / 'b.log')]
+    assert ERROR_EXIT_STATUS == main(['ctx', '-d', '===', '-c', 'hello'] + paths)
+
+    assert capsys.readouterr().out == 'hello\nhello b\n'
+    assert 'Cannot decode' in caplog.text
+
+
+def test_main_query(tmp_path, capsys):
+    path = tmp_path / 'a.log'
+    path.write_text('timeout\n===\nretry 3\nOK\n===\nretry 4\n===\nnothing\n')
+
+    query_text = '(contains "timeout" or contains regex "retry \\d") and not matches "OK"'
+    assert 0 == main(['ctx', '-d', '===', '--query', query_text, str(path)])
+
+    assert capsys.readouterr().out == 'timeout\nretry 4\n'
+
+
+@pytest.mark.parametrize('options,expected', [
+    (['--contexts-before', '1', '--max-count', '1'], 'b\nMATCH\n'),
+    (['--contexts-after', '1', '--max-count', '1'], 'MATCH\nc\n'),
+    # The contexts around the matches don't count for the limits
+    (['--contexts-around', '1', '--max-total', '2'], 'b\nMATCH\nc\nMATCH\nd\n'),
+])
+def test_main_contexts_around_with_limits(tmp_path, capsys, options, expected):
+    path = tmp_path / 'a.log'
+    path.write_text('a\n\nb\n\nMATCH\n\nc\n\nMATCH\n\nd\n\nMATCH\n')
+
+    assert 0 == main(['ctx', '-D', '^$', '-c', 'MATCH'] + options + [str(path), str(path)])
+    assert capsys.readouterr().out == expected * (2 if '--max-count' in options else 1)
+
+
+@pytest.mark.parametrize('option', ['--count', '--files-with-matches'])
+def test_main_contexts_around_with_count(tmp_path, capsys, option):
+    path = tmp_path / 'a.log'
+    path.write_text('a\n\nMATCH\n\nc\n')
+
+    with pytest.raises(SystemExit):
+        main(['ctx', '-D', '^$', '-c', 'MATCH', option, '--contexts-after', '1', str(path)])
+    assert 'cannot be used with ' + option in capsys.readouterr().err
+
+
+def test_main_json_lines_start_and_end_delimiters(tmp_path, capsys):
+    path = tmp_path / 'a.log'
+    data = 'skipped ñ\r\n'.encode('utf-8') * 5000 + b'BEGIN\r\na\r\nEND\r\nafter\r\n'
+    path.write_bytes(data)
+
+    with patch.object(PositionTrackingFileIterator, 'get_size', autospec=True,
+                      side_effect=PositionTrackingFileIterator.get_size) as get_size:
+        assert 0 == main(['ctx', '-s', 'BEGIN', '-e', 'END', '--format', 'jsonl', str(path)])
+
+    record = json.loads(capsys.readouterr().out)
+    assert record['line_numbers'] == [5001, 5002, 5003]
+    assert record['byte_offsets'] == [data.index(b'BEGIN'), data.index(b'a\r\n'), data.index(b'END')]
+    # The lines before the start delimiter are only counted, not split one by one
+    assert get_size.call_count < 20
+
+
+def test_main_memo_size(tmp_path, capsys):
+    path = tmp_path / 'a.log'
+    path.write_text('2024-01-01 start\nGET /health 200\nERROR 1\n2024-01-02 start\nGET /health 200\nok\n' * 3)
+
+    argv = ['ctx', '-D', '^\\d{4}-\\d{2}-\\d{2}', '-L!', 'health', '--output-delimiter=---', str(path)]
+    assert 0 == main(argv)
+    expected = capsys.readouterr().out
+    assert expected.count('ERROR 1') == 3
+
+    assert 0 == main(argv[:1] + ['--memo-size', '2'] + argv[1:])
+    assert capsys.readouterr().out == expected
+
+
+@pytest.mark.parametrize('argv,expected', [
+    (['-l', 'a'], True),
+    (['-L!', 'a', '--max-count', '2', '--output-delimiter=---'], True),
+    ([], False),
+    (['-l', 'a', '-c', 'b'], False),
+    (['-l', 'a', '-q', 'contains "b"'], False),
+    (['-l', 'a', '--unique'], False),
+    (['-l', 'a', '--sample-rate', '0.5'], False),
+    (['-l', 'a', '--contexts-after', '1'], False),
+    (['-l', 'a', '-n'], False),
+    (['-l', 'a', '--format', 'jsonl'], False),
+    (['-l', 'a', '--sort-by', 'a'], False),
+    (['-l', 'a', '--count'], False),
+])
+def test_can_stream(argv, expected):
+    ap = construct_arg_parser()
+    args = ap.parse_args(['-d', '==='] + argv)
+    output = get_output_from_args(ap, args)
+
+    assert can_stream(
+        args, output, unique_set=get_unique_set_from_args(ap, args), sampler=get_sampler_from_args(ap, args),
+    ) == expected
+
+
+def test_can_stream_with_numpy_engine(caplog):
+    caplog.set_level(logging.DEBUG, logger='context_cli.core')
+    ap = construct_arg_parser()
+    args = ap.parse_args(['-d', '===', '-l', 'a', '--engine', 'numpy'])
+
+    assert can_stream(args, get_output_from_args(ap, args))
+    assert 'Using the Python engine to stream the contexts' in caplog.text
+
+
+def test_get_line_filters():
+    args = construct_arg_parser().parse_args(['-d', '===', '-L!', 'c+', '-l', 'a', '-L', 'b+', '-l!', 'd'])
+    line_memos = {('search', 'b+'): LineMemo(10)}
+
+    line_filters = get_line_filters(args, line_memos)
+
+    assert [type(line_filter).__name__ for line_filter in line_filters] == [
+        'ContainsTextLineFilter', 'NotContainsTextLineFilter', 'ContainsRegexLineFilter', 'NotContainsRegexLineFilter',
+    ]
+    assert line_filters[2].memo is line_memos['search', 'b+']
+    assert line_filters[3].memo is None
+
+
+def test_stream_file():
+    context_factory = mock.MagicMock()
+    context_factory.iter_parts.return_value = iter([
+        (['a1', 'b'], False), (['a2'], True), (['b'], True), (['a3'], True), (['a4'], True),
+    ])
+    args = construct_arg_parser().parse_args(['-d', '===', '-l', 'a'])
+    stream = io.StringIO()
+
+    written = stream_file(context_factory, get_line_filters(args), TextOutput(stream, output_delimiter='---'), limit=2)
+
+    assert written == 2
+    assert stream.getvalue() == 'a1\na2\n---\na3\n'
+
+
+@pytest.mark.parametrize('argv', [
+    ['-d', '===', '-l', 'a'],
+    ['-d', '===', '-l!', 'a', '--output-delimiter=---', '--max-count', '3'],
+    ['-D', '^=+$', '-L', 'a|^$', '--max-total', '4'],
+    ['-s', 'BEGIN', '-e', 'END', '-X', '-l!', 'b'],
+    ['-s', 'BEGIN', '-e', 'END', '--nested', '-L', '[ab]'],
+])
+def test_main_streaming_same_as_pipeline(tmp_path, capsys, argv):
+    path = tmp_path / 'a.log'
+    path.write_text('a\n===\nb\nBEGIN\na b\n\n===\n===\nb\nEND\na\n===\nBEGIN\n' + 'a\nb\n' * 3000 + 'END\n===\na\n')
+
+    # A context filter that every context with lines passes makes it use the pipeline
+    assert 0 == main(['ctx'] + argv + ['-C', '', str(path)])
+    expected = capsys.readouterr().out
+
+    with patch('context_cli.core.stream_file', wraps=stream_file) as stream_file_mock:
+        assert 0 == main(['ctx'] + argv + [str(path)])
+    assert capsys.readouterr().out == expected
+    stream_file_mock.assert_called_once()
@@ -1,15 +1,68 @@
 import pytest
 import re
+from mock import mock
 
 from context_cli.context import Context
+from context_cli.memo import LineMemo
+from context_cli.unique import BloomFilter, DigestSet
 
 # Context filters
 from context_cli.filter import (
     ContainsRegexContextFilter, ContainsTextContextFilter, MatchesTextContextFilter, MatchesRegexContextFilter,
     NotContainsRegexContextFilter, NotContainsTextContextFilter, NotMatchesRegexContextFilter,
-    NotMatchesTextContextFilter, NotEmptyContextFilter,
+    NotMatchesTextContextFilter, NotEmptyContextFilter, SampleContextFilter, UniqueContextFilter,
 )
 
+def test_unique_context_filter():
+    contexts = [Context(lines=['a', 'b']), Context(lines=['a']), Context(lines=['a', 'b']), Context(lines=['ab'])]
+    context_filter = UniqueContextFilter(context_generator=get_generator_from_list(contexts), seen=DigestSet())
+
+    assert [context.lines for context in context_filter] == [['a', 'b'], ['a'], ['ab']]
+
+
+def test_unique_context_filter_shares_seen_set():
+    seen = DigestSet()
+    first = UniqueContextFilter(context_generator=get_generator_from_list([Context(lines=['a'])]), seen=seen)
+    second = UniqueContextFilter(
+        context_generator=get_generator_from_list([Context(lines=['a']), Context(lines=['b'])]), seen=seen,
+    )
+
+    assert [context.lines for context in first] == [['a']]
+    assert [context.lines for context in second] == [['b']]
+
+
+def test_unique_context_filter_ignore_regexps():
+    contexts = [
+        Context(lines=['2020-01-01 12:00:00 crash', '  at foo()']),
+        Context(lines=['2020-01-02 13:00:00 crash', '  at foo()']),
+        Context(lines=['2020-01-02 13:00:00 crash', '  at bar()']),
+    ]
+    context_filter = UniqueContextFilter(
+        context_generator=get_generator_from_list(contexts), seen=DigestSet(),
+        ignore_regexps=[r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'],
+    )
+
+    assert list(context_filter) == [contexts[0], contexts[2]]
+
+
+def test_unique_context_filter_bloom_filter():
+    contexts = [Context(lines=[f'line {i % 100}']) for i in range(1000)]
+    context_filter = UniqueContextFilter(
+        context_generator=get_generator_from_list(contexts), seen=BloomFilter(capacity=1000, error_rate=0.0001),
+    )
+
+    assert [context.lines for context in context_filter] == [[f'line {i}'] for i in range(100)]
+
+
+def test_sample_context_filter():
+    sampler = mock.MagicMock()
+    sampler.accept.side_effect = [True, False, False, True]
+    contexts = [Context(lines=[str(i)]) for i in range(4)]
+    context_filter = SampleContextFilter(context_generator=get_generator_from_list(contexts), sampler=sampler)
+
+    assert list(context_filter) == [contexts[0], contexts[3]]
+
+
 # Line filters
 from context_cli.filter import (
     ContainsRegexLineFilter, ContainsTextLineFilter, NotContainsRegexLineFilter, NotContainsTextLineFilter,
@@ -276,3 +329,121 @@ def test_not_contains_regex_line_filter(context_matches_generator):
     context = contexts[0]
     for line in context.lines:
         assert regex.search(line) is None
+
+
+PREFILTER_REGEXPS = [
+    'ERROR\\s+\\d+',
+    'user_id=(\\d+)',
+    '^Line [0-9]: .+$',
+    'Line [0-9]: (Hello|Bye) world!',
+    'w(or)+ld',
+    '(?i)line',
+    '[0-9]+',
+]
+
+PREFILTER_LINES = [
+    'ERROR 42 something broke',
+    'ERROR: no code',
+    'error 42 lowercase',
+    'user_id=123 logged in',
+    'user_id= nobody',
+    'Line 1: Hello world!',
+    'Line 2: Bye world!',
+    'Line x: nope',
+    'worororld',
+    '',
+]
+
+
+@pytest.mark.parametrize('regexp', PREFILTER_REGEXPS)
+def test_regex_filters_prefilter_matches_regex(regexp):
+    compiled = re.compile(regexp)
+    contexts = [Context(lines=[line]) for line in PREFILTER_LINES]
+
+    def run(filter_cls):
+        return list(filter_cls(context_generator=get_generator_from_list(contexts), regexp=regexp))
+
+    assert run(ContainsRegexContextFilter) == [c for c in contexts if compiled.search(c.lines[0])]
+    assert run(NotContainsRegexContextFilter) == [c for c in contexts if not compiled.search(c.lines[0])]
+    assert run(MatchesRegexContextFilter) == [c for c in contexts if compiled.fullmatch(c.lines[0])]
+
+    line_filter = ContainsRegexLineFilter(
+        context_generator=get_generator_from_list([Context(lines=PREFILTER_LINES)]), regexp=regexp,
+    )
+    assert list(line_filter)[0].lines == [line for line in PREFILTER_LINES if compiled.search(line)]
+
+    not_line_filter = NotContainsRegexLineFilter(
+        context_generator=get_generator_from_list([Context(lines=PREFILTER_LINES)]), regexp=regexp,
+    )
+    assert list(not_line_filter)[0].lines == [line for line in PREFILTER_LINES if not compiled.search(line)]
+
+
+def test_contains_regex_context_filter_skips_regex_without_literal():
+    regexp = mock.MagicMock(wraps=re.compile('ERROR\\s+\\d+'))
+    regexp.pattern = 'ERROR\\s+\\d+'
+    regexp.flags = re.UNICODE
+    context_filter = ContainsRegexContextFilter(
+        context_generator=get_generator_from_list([Context(lines=['nothing here', 'ERROR 1'])]), regexp=regexp,
+    )
+
+    assert len(list(context_filter)) == 1
+    regexp.search.assert_called_once_with('ERROR 1')
+
+
+
+def test_line_filter_keeps_positions():
+    context = Context(lines=['a', 'b', 'ab', 'c'], line_number=10, byte_offset=100, byte_offsets=[100, 102, 104, 107])
+    context_filter = ContainsTextLineFilter(text='a', context_generator=get_generator_from_list([context]))
+
+    filtered_context = next(iter(context_filter))
+    assert filtered_context.lines == ['a', 'ab']
+    assert filtered_context.line_numbers == [10, 12]
+    assert filtered_context.byte_offsets == [100, 104]
+    assert filtered_context.line_number == 10
+    assert filtered_context.byte_offset == 100
+
+
+def test_negated_line_filter_keeps_positions():
+    context = Context(lines=['a', 'b', 'ab', 'c'], line_number=1, byte_offset=0)
+    context_filter = NotContainsTextLineFilter(text='a', context_generator=get_generator_from_list([context]))
+
+    assert next(iter(context_filter)).line_numbers == [2, 4]
+
+
+def test_regex_line_filters_with_memo():
+    lines = ['ERROR 1', 'ok', 'ERROR 1', 'ERROR 2', 'ok', 'ERROR 1']
+    memo = LineMemo(size=10)
+
+    line_filter = ContainsRegexLineFilter(
+        context_generator=get_generator_from_list([Context(lines=lines)]), regexp='ERROR [12]', memo=memo,
+    )
+    assert list(line_filter)[0].lines == ['ERROR 1', 'ERROR 1', 'ERROR 2', 'ERROR 1']
+
+    # The negated filter can share the memo of the same regex
+    not_line_filter = NotContainsRegexLineFilter(
+        context_generator=get_generator_from_list([Context(lines=lines)]), regexp='ERROR [12]', memo=memo,
+    )
+    assert list(not_line_filter)[0].lines == ['ok', 'ok']
+
+    assert memo.misses == 3
+    assert memo.hits == 9
+
+
+def test_regex_context_filters_with_memo():
+    contexts = [Context(lines=['ok', 'ERROR 1']), Context(lines=['ok']), Context(lines=['ERROR 1', 'ok'])]
+    memo = LineMemo(size=10)
+
+    context_filter = ContainsRegexContextFilter(
+        context_generator=get_generator_from_list(contexts), regexp='ERROR [12]', memo=memo,
+    )
+    assert [context.lines for context in context_filter] == [['ok', 'ERROR 1'], ['ERROR 1', 'ok']]
+    # `any` stops at the first match, so the last 'ok' isn't looked up
+    assert memo.misses == 2
+    assert memo.hits == 2
+
+    fullmatch_memo = LineMemo(size=10)
+    context_filter = NotMatchesRegexContextFilter(
+        context_generator=get_generator_from_list(contexts), regexp='ERROR [12]', memo=fullmatch_memo,
+    )
+    assert [context.lines for context in context_filter] == [['ok']]
+    assert fullmatch_memo.misses == 2
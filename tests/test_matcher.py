@@ -1,6 +1,14 @@
+import re
+
 import pytest
 
-from context_cli.matcher import ContainsTextMatcher, RegexMatcher
+from mock import mock
+
+from context_cli.matcher import (
+    AnchoredRegexMatcher, ContainsTextMatcher, ExactTextMatcher, MemoizedMatcher, PrefixTextMatcher, RegexMatcher,
+    SuffixTextMatcher, memoize_matcher, plan_regex_matcher,
+)
+from context_cli.memo import LineMemo
 
 # Any line containing an email
 PARTIAL_REGEX = '[a-zA-Z0-9_.-]+@[a-zA-Z0-9]+(\\.[a-zA-Z]+)+'
@@ -65,3 +73,89 @@ def test_text_matcher_matches_full_line(text_matcher):
 def test_text_matcher_not_matches_line(text_matcher):
     line = 'should not match'
     assert text_matcher.matches(line) is False
+
+
+PLANNED_REGEXPS = {
+    '^```$': ExactTextMatcher,
+    '^$': ExactTextMatcher,
+    '^(BEGIN)$': ExactTextMatcher,
+    '^BEGIN': PrefixTextMatcher,
+    '\\ABEGIN': PrefixTextMatcher,
+    '^ERROR \\d+': PrefixTextMatcher,
+    '^ERROR \\d+$': PrefixTextMatcher,
+    'END$': SuffixTextMatcher,
+    'END\\Z': SuffixTextMatcher,
+    '-----': ContainsTextMatcher,
+    '(-----)': ContainsTextMatcher,
+    '^\\d{4}-\\d{2}-\\d{2}': AnchoredRegexMatcher,
+    '(?i)^begin': AnchoredRegexMatcher,
+    '(?i)begin': RegexMatcher,
+    '(?m)^BEGIN$': ExactTextMatcher,
+    '^BEGIN|END': RegexMatcher,
+    '^(?i:BEGIN)': AnchoredRegexMatcher,
+    '\\d+ END': RegexMatcher,
+    '': ContainsTextMatcher,
+    '^': PrefixTextMatcher,
+    '$': SuffixTextMatcher,
+}
+
+PLANNER_LINES = [
+    '', ' ', '```', '``` ', ' ```', 'BEGIN', 'BEGIN transaction', 'begin', 'xBEGIN', 'END', 'the END', 'END of it',
+    'ERROR 42', 'ERROR 42 happened', 'ERROR x', '-----', 'a ----- b', '----', '2024-01-02 10:00', '2024-1-02',
+    '12 END', 'BEGIN END',
+]
+
+
+@pytest.mark.parametrize('regexp', sorted(PLANNED_REGEXPS))
+def test_plan_regex_matcher_strategy(regexp):
+    assert type(plan_regex_matcher(regexp)) is PLANNED_REGEXPS[regexp]
+
+
+@pytest.mark.parametrize('regexp', sorted(PLANNED_REGEXPS))
+def test_plan_regex_matcher_equivalent_to_search(regexp):
+    compiled = re.compile(regexp)
+    matcher = plan_regex_matcher(regexp)
+
+    for line in PLANNER_LINES:
+        assert matcher.matches(line) is (compiled.search(line) is not None), line
+        if matcher.literal is not None and matcher.matches(line):
+            assert matcher.literal in line
+
+
+def test_plan_regex_matcher_compiled_regexp():
+    assert type(plan_regex_matcher(re.compile('^BEGIN$'))) is ExactTextMatcher
+    assert type(plan_regex_matcher(re.compile('^BEGIN$', re.IGNORECASE))) is AnchoredRegexMatcher
+
+
+def test_regex_matcher_literal():
+    assert RegexMatcher('ERROR\\s+\\d+').literal == 'ERROR'
+    assert RegexMatcher('\\d+').literal is None
+
+
+def test_text_matcher_literal():
+    assert ContainsTextMatcher('---').literal == '---'
+    assert ContainsTextMatcher('').literal is None
+    assert ContainsTextMatcher('a\nb').literal is None
+
+
+def test_memoized_matcher():
+    matcher = RegexMatcher('ERROR\\s+\\d+')
+    matcher.regexp = mock.MagicMock(wraps=matcher.regexp)
+    memoized_matcher = MemoizedMatcher(matcher, LineMemo(size=10))
+
+    assert memoized_matcher.literal == 'ERROR'
+    assert [memoized_matcher.matches(line) for line in ['ERROR 1', 'ERROR x', 'ERROR 1', 'ERROR x']] == [
+        True, False, True, False,
+    ]
+    assert matcher.regexp.search.call_count == 2
+
+
+def test_memoize_matcher():
+    assert type(memoize_matcher(plan_regex_matcher('^\\d{4}-'), 10)) is MemoizedMatcher
+    assert type(memoize_matcher(plan_regex_matcher('^ERROR \\d+'), 10)) is MemoizedMatcher
+
+    # Text matchers are cheaper than the memo
+    text_matcher = plan_regex_matcher('^BEGIN')
+    assert memoize_matcher(text_matcher, 10) is text_matcher
+    text_matcher = ContainsTextMatcher('---')
+    assert memoize_matcher(text_matcher, 10) is text_matcher
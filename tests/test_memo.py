@@ -0,0 +1,58 @@
+import pytest
+
+from mock import mock
+
+from context_cli.memo import LineMemo
+
+
+def test_line_memo_only_calls_the_function_once_per_line():
+    function = mock.MagicMock(side_effect=lambda line: line.startswith('a'))
+    memo = LineMemo(size=10)
+
+    assert [memo.get(line, function) for line in ['a', 'b', 'a', 'a', 'b']] == [True, False, True, True, False]
+    assert function.call_count == 2
+    assert memo.hits == 3
+    assert memo.misses == 2
+    assert memo.hit_rate == 0.6
+
+
+def test_line_memo_evicts_the_least_recently_used_line():
+    function = mock.MagicMock(side_effect=len)
+    memo = LineMemo(size=2)
+
+    for line in ['a', 'bb', 'a', 'ccc', 'a', 'bb']:
+        memo.get(line, function)
+
+    # 'bb' was evicted when 'ccc' was added since 'a' had been used after it
+    assert [call.args[0] for call in function.call_args_list] == ['a', 'bb', 'ccc', 'bb']
+    assert list(memo.results) == ['a', 'bb']
+
+
+def test_line_memo_turns_itself_off_when_lines_dont_repeat():
+    function = mock.MagicMock(return_value=True)
+    memo = LineMemo(size=100, min_hit_rate=0.5, warmup=10)
+
+    for i in range(10):
+        memo.get(str(i), function)
+
+    assert not memo.enabled
+    assert not memo.results
+    memo.get('0', function)
+    assert function.call_count == 11
+    assert memo.misses == 10
+
+
+def test_line_memo_stays_on_when_lines_repeat():
+    memo = LineMemo(size=100, min_hit_rate=0.5, warmup=10)
+
+    for i in range(100):
+        memo.get(str(i % 3), len)
+
+    assert memo.enabled
+    assert memo.hits == 97
+    assert repr(memo) == 'LineMemo(enabled, 97 hits, 3 misses, 97.0% hit rate)'
+
+
+def test_line_memo_size():
+    with pytest.raises(ValueError):
+        LineMemo(size=0)
@@ -0,0 +1,530 @@
+import io
+import json
+import random
+import re
+import struct
+
+import pytest
+
+from mock import mock
+
+from context_cli.context import Context
+from context_cli.output import (
+    CountOutput, FileHandlePool, FilesWithMatchesOutput, FramedOutput, GroupByOutput, JsonLinesOutput, OutputFile,
+    SortedOutput, SplitOutput, TextOutput, SampleOutput, TopOutput, format_context, get_context_key, get_context_size,
+    get_split_file_name, parse_number,
+)
+
+
+def get_file_mock(name):
+    file = mock.MagicMock()
+    file.name = name
+    return file
+
+
+def test_text_output_no_output_delimiter():
+    stream = io.StringIO()
+    output = TextOutput(stream)
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(Context(lines=['a', 'b']))
+    output.write(Context(lines=['c']))
+    output.close()
+
+    assert stream.getvalue() == 'a\nb\nc\n'
+
+
+def test_text_output_output_delimiter():
+    stream = io.StringIO()
+    output = TextOutput(stream, output_delimiter='---')
+
+    output.write(Context(lines=['a', 'b']))
+    output.write(Context(lines=['c']))
+
+    assert stream.getvalue() == 'a\nb\n---\nc\n'
+
+
+@pytest.mark.parametrize('parts', [
+    [['a', 'b'], ['c']],
+    [['a']],
+    [['']],
+    [['a'], ['']],
+    [['', ''], ['']],
+    [['a', ''], ['b']],
+])
+def test_text_output_write_lines_same_as_write(parts):
+    contexts = [parts, [['x']], parts]
+
+    expected = io.StringIO()
+    output = TextOutput(expected, output_delimiter='---')
+    for context_parts in contexts:
+        output.write(Context(lines=[line for lines in context_parts for line in lines]))
+
+    actual = io.StringIO()
+    output = TextOutput(actual, output_delimiter='---')
+    for context_parts in contexts:
+        output.start_context()
+        for lines in context_parts:
+            output.write_lines(lines)
+        output.end_context()
+
+    assert actual.getvalue() == expected.getvalue()
+
+
+def test_count_output_single_file():
+    stream = io.StringIO()
+    output = CountOutput(stream)
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(Context(lines=['a']))
+    output.write(Context(lines=['b']))
+    output.close()
+
+    assert stream.getvalue() == '2\n'
+
+
+def test_count_output_multiple_files():
+    stream = io.StringIO()
+    output = CountOutput(stream)
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(Context(lines=['a']))
+    output.start_file(get_file_mock('file2.txt'))
+    output.start_file(get_file_mock('file3.txt'))
+    output.write(Context(lines=['b']))
+    output.write(Context(lines=['c']))
+    output.close()
+
+    assert stream.getvalue() == 'file1.txt:1\nfile2.txt:0\nfile3.txt:2\ntotal:3\n'
+
+
+def test_count_output_does_not_build_text():
+    context = mock.MagicMock()
+    output = CountOutput(io.StringIO())
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(context)
+
+    context.__str__.assert_not_called()
+
+
+def test_files_with_matches_output():
+    stream = io.StringIO()
+    output = FilesWithMatchesOutput(stream)
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.start_file(get_file_mock('file2.txt'))
+    output.write(Context(lines=['a']))
+    output.close()
+
+    assert FilesWithMatchesOutput.max_count_per_file == 1
+    assert stream.getvalue() == 'file2.txt\n'
+
+
+def test_file_handle_pool_closes_least_recently_used(tmp_path):
+    pool = FileHandlePool(max_open_files=2)
+
+    file_a = pool.get(tmp_path / 'a')
+    file_b = pool.get(tmp_path / 'b')
+    assert pool.get(tmp_path / 'a') is file_a
+    pool.get(tmp_path / 'c')
+
+    assert file_b.closed
+    assert not file_a.closed
+    assert len(pool.files) == 2
+
+    pool.close()
+    assert file_a.closed
+    assert not pool.files
+
+
+def test_file_handle_pool_appends_when_reopening(tmp_path):
+    (tmp_path / 'a').write_text('old\n')
+    pool = FileHandlePool(max_open_files=1)
+
+    pool.get(tmp_path / 'a').write('first\n')
+    pool.get(tmp_path / 'b').write('other\n')
+    pool.get(tmp_path / 'a').write('second\n')
+    pool.close()
+
+    assert (tmp_path / 'a').read_text() == 'first\nsecond\n'
+    assert (tmp_path / 'b').read_text() == 'other\n'
+
+
+def test_get_split_file_name():
+    assert get_split_file_name('acme') == 'acme'
+    assert get_split_file_name('web-01.prod') == 'web-01.prod'
+    assert get_split_file_name('../etc/passwd') == '.._etc_passwd'
+    assert get_split_file_name('a b') == 'a_b'
+    assert get_split_file_name('..') == '_..'
+    assert get_split_file_name('.') == '_.'
+    assert get_split_file_name('') == '_'
+
+
+def test_split_output(tmp_path):
+    output = SplitOutput(tmp_path / 'out', r'tenant=(\w+)', output_delimiter='---', max_open_files=1)
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(Context(lines=['start', 'tenant=acme 1']))
+    output.write(Context(lines=['tenant=other 2']))
+    output.write(Context(lines=['no tenant']))
+    output.write(Context(lines=['tenant=acme 3', 'tenant=other']))
+    output.close()
+
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == ['acme', 'other']
+    assert (tmp_path / 'out' / 'acme').read_text() == 'start\ntenant=acme 1\n---\ntenant=acme 3\ntenant=other\n'
+    assert (tmp_path / 'out' / 'other').read_text() == 'tenant=other 2\n'
+
+
+def test_split_output_without_groups_uses_whole_match(tmp_path):
+    output = SplitOutput(tmp_path, r'ERROR|WARN')
+
+    output.write(Context(lines=['WARN a']))
+    output.write(Context(lines=['ERROR b']))
+    output.close()
+
+    assert (tmp_path / 'WARN').read_text() == 'WARN a\n'
+    assert (tmp_path / 'ERROR').read_text() == 'ERROR b\n'
+
+
+def test_split_output_skips_groups_that_did_not_participate(tmp_path):
+    output = SplitOutput(tmp_path, r'(a)?b')
+
+    output.write(Context(lines=['b', 'ab']))
+    output.close()
+
+    assert (tmp_path / 'a').read_text() == 'b\nab\n'
+
+
+def test_get_context_key():
+    regexp = re.compile(r'user=(\w+)')
+
+    assert get_context_key(regexp, Context(lines=['a', 'user=bob x', 'user=alice'])) == 'bob'
+    assert get_context_key(regexp, Context(lines=['a', 'b'])) is None
+    assert get_context_key(re.compile(r'\d+'), Context(lines=['a', 'b 42'])) == '42'
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('42', 42),
+    ('-3', -3),
+    ('1.5', 1.5),
+    ('1e3', 1000.0),
+    ('abc', None),
+    ('', None),
+])
+def test_parse_number(text, expected):
+    assert parse_number(text) == expected
+
+
+def test_group_by_output_counts():
+    stream = io.StringIO()
+    output = GroupByOutput(stream, r'status=(\d+)')
+
+    output.start_file(get_file_mock('file1.txt'))
+    output.write(Context(lines=['GET / status=200']))
+    output.write(Context(lines=['GET /a status=500']))
+    output.start_file(get_file_mock('file2.txt'))
+    output.write(Context(lines=['GET /b status=200']))
+    output.write(Context(lines=['no status']))
+    output.write(Context(lines=['GET /c', 'status=404']))
+    output.close()
+
+    assert stream.getvalue() == 'count\tkey\n2\t200\n1\t404\n1\t500\n'
+
+
+def test_group_by_output_values():
+    stream = io.StringIO()
+    output = GroupByOutput(stream, r'status=(\d+)', value_regexp=r'took=([\d.]+)ms')
+
+    output.write(Context(lines=['status=200', 'took=10ms']))
+    output.write(Context(lines=['status=200 took=30ms']))
+    output.write(Context(lines=['status=200 took=5ms']))
+    output.write(Context(lines=['status=200 took=?ms']))
+    output.write(Context(lines=['status=500 took=1.5ms']))
+    output.write(Context(lines=['status=404']))
+    output.close()
+
+    assert stream.getvalue() == (
+        'count\tsum\tmin\tmax\tkey\n'
+        '4\t45\t5\t30\t200\n'
+        '1\t-\t-\t-\t404\n'
+        '1\t1.5\t1.5\t1.5\t500\n'
+    )
+
+
+def test_group_by_output_does_not_build_text():
+    context = mock.MagicMock()
+    context.lines = ['status=200']
+    output = GroupByOutput(io.StringIO(), r'status=(\d+)')
+
+    output.write(context)
+
+    context.__str__.assert_not_called()
+
+
+def test_get_context_size():
+    assert get_context_size(Context(lines=['abc', ''])) > get_context_size(Context(lines=['abc']))
+    assert get_context_size(Context(lines=['abcd'])) > get_context_size(Context(lines=['abc']))
+
+
+def get_sorted_lines(regexp, contexts, **kwargs):
+    stream = io.StringIO()
+    output = SortedOutput(TextOutput(stream, output_delimiter='---'), regexp, **kwargs)
+    for lines in contexts:
+        output.write(Context(lines=lines))
+    output.close()
+    return stream.getvalue()
+
+
+SORT_CONTEXTS = [
+    ['took=20', 'a'],
+    ['no key'],
+    ['b', 'took=3'],
+    ['took=100 c'],
+    ['took=3 d'],
+]
+
+
+def test_sorted_output():
+    assert get_sorted_lines(r'took=(\d+)', SORT_CONTEXTS) == (
+        'no key\n---\ntook=100 c\n---\ntook=20\na\n---\nb\ntook=3\n---\ntook=3 d\n'
+    )
+
+
+def test_sorted_output_numeric():
+    assert get_sorted_lines(r'took=(\d+)', SORT_CONTEXTS, numeric=True) == (
+        'no key\n---\nb\ntook=3\n---\ntook=3 d\n---\ntook=20\na\n---\ntook=100 c\n'
+    )
+
+
+def test_sorted_output_numeric_reverse():
+    assert get_sorted_lines(r'took=(\d+)', SORT_CONTEXTS, numeric=True, reverse=True) == (
+        'took=100 c\n---\ntook=20\na\n---\nb\ntook=3\n---\ntook=3 d\n---\nno key\n'
+    )
+
+
+def test_sorted_output_spills_to_disk():
+    contexts = [[f'id={i * 7919 % 1000:04d}', 'x' * 100] for i in range(1000)]
+
+    # Budget for about 10 contexts at a time
+    assert get_sorted_lines(r'id=(\d+)', contexts, memory=3000) == get_sorted_lines(r'id=(\d+)', contexts)
+
+
+def test_sorted_output_closes_output():
+    output = mock.MagicMock()
+    sorted_output = SortedOutput(output, r'(\d+)')
+    contexts = [Context(lines=['2']), Context(lines=['1'])]
+    for context in contexts:
+        sorted_output.write(context)
+
+    output.write.assert_not_called()
+    sorted_output.close()
+
+    assert output.write.call_args_list == [mock.call(contexts[1]), mock.call(contexts[0])]
+    output.close.assert_called_once()
+
+
+def get_top_lines(contexts, k, largest=True):
+    stream = io.StringIO()
+    output = TopOutput(TextOutput(stream), r'took=([\d.]+)', k, largest=largest)
+    for lines in contexts:
+        output.write(Context(lines=lines))
+    output.close()
+    return stream.getvalue().splitlines()
+
+
+TOP_CONTEXTS = [
+    ['a took=5'],
+    ['b took=50'],
+    ['c no number'],
+    ['d took=7.5'],
+    ['e took=50'],
+    ['f took=1'],
+    ['g took=?'],
+]
+
+
+def test_top_output():
+    assert get_top_lines(TOP_CONTEXTS, 3) == ['b took=50', 'e took=50', 'd took=7.5']
+    assert get_top_lines(TOP_CONTEXTS, 1) == ['b took=50']
+    assert get_top_lines(TOP_CONTEXTS, 10) == ['b took=50', 'e took=50', 'd took=7.5', 'a took=5', 'f took=1']
+
+
+def test_top_output_smallest():
+    assert get_top_lines(TOP_CONTEXTS, 2, largest=False) == ['f took=1', 'a took=5']
+    assert get_top_lines(TOP_CONTEXTS, 4, largest=False) == ['f took=1', 'a took=5', 'd took=7.5', 'b took=50']
+
+
+@pytest.mark.parametrize('k', [1, 5, 20])
+@pytest.mark.parametrize('largest', [True, False])
+def test_top_output_same_as_sorting(k, largest):
+    rng = random.Random(k)
+    contexts = [[f'{i} took={rng.randrange(30)}'] for i in range(300)]
+
+    def value(lines):
+        return int(lines[0].split('=')[1])
+
+    # Not reverse=True, the first of the contexts with the same number go first
+    expected = sorted(contexts, key=lambda lines: -value(lines) if largest else value(lines))
+    assert get_top_lines(contexts, k, largest=largest) == [lines[0] for lines in expected[:k]]
+
+
+def test_top_output_keeps_k_contexts():
+    output = TopOutput(mock.MagicMock(), r'(\d+)', 3)
+    for i in range(100):
+        output.write(Context(lines=[str(i)]))
+
+    assert len(output.heap) == 3
+
+
+def test_sample_output():
+    output = mock.MagicMock()
+    sample_output = SampleOutput(output, 3, random.Random(7))
+    contexts = [Context(lines=[str(i)]) for i in range(100)]
+    for context in contexts:
+        sample_output.write(context)
+
+    output.write.assert_not_called()
+    sample_output.close()
+
+    written = [call.args[0] for call in output.write.call_args_list]
+    assert len(written) == 3
+    assert written == sorted(written, key=contexts.index)
+    output.close.assert_called_once()
+
+
+def test_format_context():
+    context = Context(lines=['a', 'b'], line_number=10, byte_offset=1024, line_numbers=[10, 12],
+                      byte_offsets=[1024, 1030])
+
+    assert format_context(context) == 'a\nb'
+    assert format_context(context, line_numbers=True) == '10:a\n12:b'
+    assert format_context(context, byte_offset=True) == '1024:a\n1030:b'
+    assert format_context(context, line_numbers=True, byte_offset=True) == '1024:10:a\n1030:12:b'
+
+
+def test_format_context_without_line_byte_offsets():
+    context = Context(lines=['a', 'b'], line_number=10, byte_offset=1024)
+
+    assert format_context(context, byte_offset=True) == '1024:a\n1024:b'
+
+
+def test_format_context_without_positions():
+    assert format_context(Context(lines=['a', 'b']), line_numbers=True, byte_offset=True) == 'a\nb'
+
+
+def test_text_output_line_numbers():
+    stream = io.StringIO()
+    output = TextOutput(stream, output_delimiter='---', line_numbers=True)
+
+    output.write(Context(lines=['a', 'b'], line_number=1, byte_offset=0))
+    output.write(Context(lines=['c'], line_number=4, byte_offset=6))
+
+    assert stream.getvalue() == '1:a\n2:b\n---\n4:c\n'
+
+
+def test_split_output_byte_offset(tmp_path):
+    output = SplitOutput(tmp_path, r'(\w+)', byte_offset=True)
+
+    output.write(Context(lines=['a', 'b'], line_number=1, byte_offset=0))
+    output.write(Context(lines=['a'], line_number=4, byte_offset=6))
+    output.close()
+
+    assert (tmp_path / 'a').read_text() == '0:a\n0:b\n6:a\n'
+
+
+def test_sorted_output_keeps_file_names():
+    output = mock.MagicMock()
+    sorted_output = SortedOutput(output, r'(\d+)')
+    contexts = [Context(lines=['3']), Context(lines=['1']), Context(lines=['2'])]
+    sorted_output.start_file(get_file_mock('a.log'))
+    sorted_output.write(contexts[0])
+    sorted_output.write(contexts[1])
+    sorted_output.start_file(get_file_mock('b.log'))
+    sorted_output.write(contexts[2])
+    sorted_output.close()
+
+    assert output.method_calls == [
+        mock.call.start_file(OutputFile('a.log')),
+        mock.call.write(contexts[1]),
+        mock.call.start_file(OutputFile('b.log')),
+        mock.call.write(contexts[2]),
+        mock.call.start_file(OutputFile('a.log')),
+        mock.call.write(contexts[0]),
+        mock.call.close(),
+    ]
+
+
+def test_json_lines_output():
+    stream = io.StringIO()
+    output = JsonLinesOutput(stream)
+
+    output.start_file(get_file_mock('app.log'))
+    output.write(Context(lines=['a', 'b'], line_number=1, byte_offset=0, byte_offsets=[0, 2]))
+    output.write(
+        Context(lines=['c', '\u00e9'], line_number=4, byte_offset=6, line_numbers=[4, 6], byte_offsets=[6, 10]),
+    )
+    output.start_file(get_file_mock('other.log'))
+    output.write(Context(lines=['d']))
+    output.close()
+
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == [
+        {'file': 'app.log', 'line_number': 1, 'byte_offset': 0, 'line_numbers': [1, 2], 'byte_offsets': [0, 2],
+         'lines': ['a', 'b']},
+        {'file': 'app.log', 'line_number': 4, 'byte_offset': 6, 'line_numbers': [4, 6], 'byte_offsets': [6, 10],
+         'lines': ['c', '\u00e9']},
+        {'file': 'other.log', 'line_number': None, 'byte_offset': None, 'line_numbers': None, 'byte_offsets': None,
+         'lines': ['d']},
+    ]
+
+
+def test_json_lines_output_writes_in_batches():
+    stream = mock.MagicMock()
+    output = JsonLinesOutput(stream, batch_size=2)
+
+    output.write(Context(lines=['a']))
+    stream.write.assert_not_called()
+    output.write(Context(lines=['b']))
+    assert stream.write.call_count == 2
+    output.write(Context(lines=['c']))
+    assert stream.write.call_count == 2
+    stream.flush.assert_not_called()
+
+    output.close()
+    assert stream.write.call_count == 4
+    stream.flush.assert_called_once()
+
+
+def read_frames(data):
+    frames = []
+    while data:
+        size, = struct.unpack('>I', data[:4])
+        frames.append(data[4:4 + size].decode('utf-8'))
+        data = data[4 + size:]
+    return frames
+
+
+def test_framed_output():
+    stream = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    output = FramedOutput(stream)
+
+    output.write(Context(lines=['a', 'b']))
+    output.write(Context(lines=['\u00e9']))
+    output.write(Context(lines=['']))
+    output.close()
+
+    assert read_frames(stream.buffer.getvalue()) == ['a\nb', '\u00e9', '']
+
+
+def test_framed_output_writes_in_batches():
+    stream = io.BytesIO()
+    output = FramedOutput(stream, buffer_size=10)
+
+    output.write(Context(lines=['abc']))
+    assert stream.getvalue() == b''
+    output.write(Context(lines=['def']))
+    assert read_frames(stream.getvalue()) == ['abc', 'def']
+    output.write(Context(lines=['g']))
+    output.close()
+
+    assert read_frames(stream.getvalue()) == ['abc', 'def', 'g']
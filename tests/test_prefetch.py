@@ -0,0 +1,211 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mock import mock
+
+from context_cli.context import FileIterator
+from context_cli.prefetch import (
+    PrefetchBudget, PrefetchedRawFile, ReadAheadRawFile, map_ahead, open_prefetched, read_ahead,
+)
+
+
+def test_prefetched_raw_file():
+    raw = io.BytesIO(b'cdef')
+    raw.name = 'file.log'
+    file = io.BufferedReader(PrefetchedRawFile(raw, b'ab'))
+
+    assert file.name == 'file.log'
+    assert file.read() == b'abcdef'
+    file.close()
+    assert raw.closed
+
+
+def test_prefetched_raw_file_eof_closes_raw():
+    raw = mock.MagicMock()
+    file = PrefetchedRawFile(raw, b'ab', eof=True)
+
+    raw.close.assert_called_once()
+    assert io.BufferedReader(file).read() == b'ab'
+    raw.readinto.assert_not_called()
+
+
+@pytest.mark.parametrize('size', [1, 5, 100])
+def test_open_prefetched(tmp_path, size):
+    path = tmp_path / 'file.log'
+    path.write_bytes('héllo\r\nworld\r\n'.encode())
+
+    with open_prefetched(str(path), size) as file:
+        assert file.name == str(path)
+        assert file.buffer.peek(3)[:3] == b'h\xc3\xa9'
+        assert list(FileIterator(file)) == ['héllo', 'world']
+
+
+def test_open_prefetched_reads_small_files_completely(tmp_path):
+    path = tmp_path / 'file.log'
+    path.write_text('hello\n')
+
+    file = open_prefetched(str(path), 100)
+    assert file.buffer.raw.raw.closed
+    assert file.read() == 'hello\n'
+    file.close()
+
+
+def test_prefetch_budget():
+    budget = PrefetchBudget(10)
+
+    assert budget.reserve(6) == 6
+    assert budget.reserve(6) == 4
+    assert budget.reserve(6) == 0
+    budget.release(6)
+    assert budget.reserve(2) == 2
+    assert budget.used == 6
+
+
+def test_open_prefetched_budget(tmp_path):
+    path = tmp_path / 'file.log'
+    path.write_text('hello\n' * 10)
+    budget = PrefetchBudget(10)
+
+    first = open_prefetched(str(path), 8, budget=budget)
+    second = open_prefetched(str(path), 8, budget=budget)
+    assert budget.used == 10
+    assert len(second.buffer.raw.data) == 2
+
+    # The bytes are given back once they're read or the file is closed
+    assert first.read() == 'hello\n' * 10
+    assert budget.used == 2
+    second.close()
+    assert budget.used == 0
+
+    # Files smaller than their share give back the rest right away
+    (tmp_path / 'small.log').write_text('a\n')
+    small = open_prefetched(str(tmp_path / 'small.log'), 8, budget=budget)
+    assert budget.used == 2
+    small.close()
+    assert budget.used == 0
+
+
+def test_open_prefetched_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        open_prefetched(str(tmp_path / 'missing.log'), 100)
+
+
+@pytest.mark.parametrize('n', [0, 1, 3])
+def test_map_ahead(n):
+    assert list(map_ahead(lambda item: item * 2, range(10), n)) == [item * 2 for item in range(10)]
+
+
+def test_map_ahead_executor():
+    executor = mock.MagicMock(wraps=ThreadPoolExecutor(max_workers=2))
+
+    assert list(map_ahead(lambda item: item * 2, range(5), 2, executor=executor)) == [0, 2, 4, 6, 8]
+    assert executor.submit.call_count == 5
+    # The executor belongs to the caller
+    executor.shutdown.assert_not_called()
+    executor.shutdown()
+
+
+def test_map_ahead_computes_next_results_in_the_background():
+    started = [threading.Event() for _ in range(3)]
+
+    def function(item):
+        started[item].set()
+        return item
+
+    results = map_ahead(function, range(3), 2)
+    assert next(results) == 0
+    # The next two were submitted before the first one was returned
+    assert started[1].wait(5)
+    assert started[2].wait(5)
+    assert list(results) == [1, 2]
+
+
+def test_map_ahead_raises_exceptions_in_order():
+    def function(item):
+        if item == 1:
+            raise ValueError(item)
+        return item
+
+    results = map_ahead(function, range(3), 2)
+    assert next(results) == 0
+    with pytest.raises(ValueError):
+        next(results)
+
+
+def test_map_ahead_discards_results_when_stopped():
+    discarded = []
+
+    results = map_ahead(lambda item: item, range(10), 3, discard=discarded.append)
+    assert next(results) == 0
+    results.close()
+
+    # The ones that were computed ahead were discarded, the rest were cancelled or never submitted
+    assert 1 <= len(discarded) <= 3
+    assert discarded == sorted(discarded)
+    assert 0 not in discarded
+
+
+def open_text(data, encoding='utf-8', errors='strict'):
+    return io.TextIOWrapper(io.BufferedReader(io.BytesIO(data)), encoding=encoding, errors=errors)
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 1024])
+def test_read_ahead(block_size):
+    data = 'héllo\r\nwörld\r\n' * 100
+    file = read_ahead(open_text(data.encode()), block_size=block_size, max_pending_blocks=2)
+
+    assert list(FileIterator(file)) == ['héllo', 'wörld'] * 100
+    file.close()
+
+
+def test_read_ahead_keeps_encoding_and_errors():
+    file = read_ahead(open_text('café\n'.encode('latin-1'), errors='replace'))
+
+    assert file.encoding == 'utf-8'
+    assert file.errors == 'replace'
+    assert file.read() == 'caf\ufffd\n'
+    file.close()
+
+
+def test_read_ahead_without_buffer():
+    file = io.StringIO('a')
+
+    assert read_ahead(file) is file
+
+
+def test_read_ahead_raw_file_is_bounded():
+    source = open_text(b'a' * 100)
+    raw = ReadAheadRawFile(source, block_size=10, max_pending_blocks=2)
+
+    # The thread stops once the queue is full (and it has one more block waiting to be queued)
+    raw.thread.join(0.2)
+    assert source.buffer.tell() <= 30
+
+    assert io.BufferedReader(raw).read() == b'a' * 100
+    raw.close()
+    assert source.closed
+
+
+def test_read_ahead_raw_file_close_while_reading():
+    source = open_text(b'a' * 1000)
+    raw = ReadAheadRawFile(source, block_size=10, max_pending_blocks=1)
+
+    assert raw.read(5) == b'aaaaa'
+    raw.close()
+    raw.thread.join(5)
+
+    assert not raw.thread.is_alive()
+    assert source.closed
+
+
+def test_read_ahead_raw_file_raises_read_errors():
+    source = mock.MagicMock()
+    source.buffer.read1.side_effect = OSError('broken')
+    raw = ReadAheadRawFile(source)
+
+    with pytest.raises(OSError):
+        raw.read(5)
+    raw.close()
@@ -0,0 +1,101 @@
+import pytest
+
+from mock import mock
+
+from context_cli.context import Context
+from context_cli.memo import LineMemo
+from context_cli.query import (
+    REGEX_COST, REGEX_WITH_LITERAL_COST, TEXT_COST, And, Not, Or, Predicate, QueryError, compile_query, parse_query,
+    tokenize,
+)
+
+
+def test_tokenize():
+    assert tokenize('(contains "a \\" b" OR matches regex \'\\d+\')') == [
+        ('paren', '(', 0),
+        ('word', 'contains', 1),
+        ('string', 'a " b', 10),
+        ('word', 'or', 19),
+        ('word', 'matches', 22),
+        ('word', 'regex', 30),
+        ('string', '\\d+', 36),
+        ('paren', ')', 41),
+    ]
+
+
+def test_parse_query_precedence():
+    node = parse_query('not contains "a" or contains "b" and contains "c"')
+
+    assert isinstance(node, Or)
+    assert isinstance(node.operands[0], Not)
+    assert isinstance(node.operands[1], And)
+
+
+def test_parse_query_flattens_and_orders_by_cost():
+    node = parse_query('contains regex "a.*b" and (contains regex "[0-9]+" and contains "c")')
+
+    assert isinstance(node, And)
+    assert [operand.cost for operand in node.operands] == [TEXT_COST, REGEX_WITH_LITERAL_COST, REGEX_COST]
+    assert [operand.value for operand in node.operands] == ['c', 'a.*b', '[0-9]+']
+
+
+def test_predicate_kinds():
+    assert Predicate('contains', 'text', 'a').compile()(Context(lines=['xay']))
+    assert not Predicate('matches', 'text', 'a').compile()(Context(lines=['xay']))
+    assert Predicate('matches', 'text', 'a').compile()(Context(lines=['b', 'a']))
+    assert Predicate('contains', 'regex', 'a+').compile()(Context(lines=['xaay']))
+    assert not Predicate('matches', 'regex', 'a+').compile()(Context(lines=['xaay']))
+
+
+QUERY = '(contains "timeout" or contains regex "retry \\d+") and not matches "OK"'
+
+
+@pytest.mark.parametrize('lines,expected', [
+    (['a timeout'], True),
+    (['retry 3'], True),
+    (['retry x'], False),
+    (['timeout', 'OK'], False),
+    (['timeout', 'not OK'], True),
+    ([], False),
+])
+def test_compile_query(lines, expected):
+    assert compile_query(QUERY)(Context(lines=lines)) == expected
+
+
+def test_compile_query_short_circuits():
+    node = parse_query('contains "a" and contains regex "b.*c"')
+    node.operands[1].filter = mock.MagicMock()
+
+    node.compile()(Context(lines=['x']))
+    node.operands[1].filter.is_context_valid.assert_not_called()
+
+
+@pytest.mark.parametrize('text,position', [
+    ('', 0),
+    ('contains', 8),
+    ('contains "a', 9),
+    ('(contains "a"', 13),
+    ('contains "a" contains "b"', 13),
+    ('contains regex "("', 15),
+    ('starts "a"', 0),
+    ('contains "a" and', 16),
+])
+def test_parse_query_errors(text, position):
+    with pytest.raises(QueryError) as e:
+        parse_query(text)
+    assert e.value.position == position
+
+
+def test_compile_query_with_memos():
+    node = parse_query('contains regex "a+" or matches regex "a+" or contains "b"')
+    memos = {('search', 'a+'): LineMemo(size=10)}
+    predicate = node.compile(memos)
+
+    assert predicate(Context(lines=['xa']))
+    assert predicate(Context(lines=['xa']))
+    assert not predicate(Context(lines=['x']))
+    # The cheaper text predicate is checked first, so the regex isn't looked up
+    assert predicate(Context(lines=['b']))
+    # Only `contains regex` has a memo
+    assert memos['search', 'a+'].hits == 1
+    assert memos['search', 'a+'].misses == 2
@@ -0,0 +1,73 @@
+import random
+from collections import Counter
+
+import pytest
+
+from context_cli.sample import BernoulliSampler, ReservoirSampler, random_skip
+
+
+def test_random_skip():
+    rng = random.Random(1)
+    skips = [random_skip(rng, 0.25) for _ in range(10000)]
+
+    assert min(skips) == 0
+    # The mean of the geometric distribution is (1 - p) / p
+    assert 2.8 < sum(skips) / len(skips) < 3.2
+
+
+def test_bernoulli_sampler_rate():
+    sampler = BernoulliSampler(0.1, random.Random(2))
+    accepted = sum(sampler.accept() for _ in range(100000))
+
+    assert 9500 < accepted < 10500
+
+
+def test_bernoulli_sampler_seed():
+    first = BernoulliSampler(0.5, random.Random(3))
+    second = BernoulliSampler(0.5, random.Random(3))
+
+    assert [first.accept() for _ in range(100)] == [second.accept() for _ in range(100)]
+
+
+@pytest.mark.parametrize('rate', [0, 1, -0.1, 2])
+def test_bernoulli_sampler_invalid_rate(rate):
+    with pytest.raises(ValueError):
+        BernoulliSampler(rate, random.Random())
+
+
+def test_reservoir_sampler_fewer_items_than_k():
+    sampler = ReservoirSampler(5, random.Random(4))
+    for i in range(3):
+        sampler.add(i)
+
+    assert sampler.items == [0, 1, 2]
+
+
+def test_reservoir_sampler_keeps_k_items_in_order():
+    sampler = ReservoirSampler(10, random.Random(5))
+    for i in range(10000):
+        sampler.add(i)
+
+    items = sampler.items
+    assert len(items) == 10
+    assert items == sorted(items)
+    assert len(set(items)) == 10
+
+
+def test_reservoir_sampler_is_uniform():
+    rng = random.Random(6)
+    counts = Counter()
+    for _ in range(2000):
+        sampler = ReservoirSampler(5, rng)
+        for i in range(50):
+            sampler.add(i)
+        counts.update(sampler.items)
+
+    # Each item is picked with probability 5 / 50, 200 times on average
+    assert len(counts) == 50
+    assert all(140 < count < 260 for count in counts.values())
+
+
+def test_reservoir_sampler_invalid_k():
+    with pytest.raises(ValueError):
+        ReservoirSampler(0, random.Random())
@@ -0,0 +1,61 @@
+import random
+from operator import itemgetter
+
+import pytest
+
+from context_cli.sort import ExternalSorter, SortRun
+
+
+def test_sort_run():
+    run = SortRun(iter([(1, 'a'), (2, ['b', 'c'])]))
+
+    assert list(run) == [(1, 'a'), (2, ['b', 'c'])]
+    # Runs can be read more than once
+    assert list(run) == [(1, 'a'), (2, ['b', 'c'])]
+    run.close()
+
+
+def test_external_sorter_in_memory():
+    sorter = ExternalSorter(key=itemgetter(0))
+    for item in [(3, 'a'), (1, 'b'), (2, 'c')]:
+        sorter.add(item, size=1)
+
+    assert list(sorter) == [(1, 'b'), (2, 'c'), (3, 'a')]
+    assert not sorter.runs
+    sorter.close()
+
+
+def test_external_sorter_spills_runs():
+    sorter = ExternalSorter(key=itemgetter(0), memory=10)
+    for i in range(25):
+        sorter.add((-i, i), size=1)
+
+    assert len(sorter.runs) == 2
+    assert list(sorter) == [(-i, i) for i in reversed(range(25))]
+    sorter.close()
+    assert not sorter.runs
+
+
+@pytest.mark.parametrize('memory,max_merge_runs', [
+    (1, 2),
+    (3, 3),
+    (7, 64),
+    (1000, 64),
+])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_external_sorter_is_stable_sort(memory, max_merge_runs, reverse):
+    rng = random.Random(memory * 31 + max_merge_runs)
+    items = [(rng.randrange(10), i) for i in range(200)]
+
+    sorter = ExternalSorter(key=itemgetter(0), memory=memory, reverse=reverse, max_merge_runs=max_merge_runs)
+    for item in items:
+        sorter.add(item, size=1)
+
+    assert list(sorter) == sorted(items, key=itemgetter(0), reverse=reverse)
+    assert len(sorter.runs) < max_merge_runs
+    sorter.close()
+
+
+def test_external_sorter_invalid_max_merge_runs():
+    with pytest.raises(ValueError):
+        ExternalSorter(key=itemgetter(0), max_merge_runs=1)
@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+from context_cli.context import FileIterator, PositionTrackingFileIterator
+from context_cli.tee import TeeFile, tee_file
+
+
+TEXT = ''.join(f'line {i}\n' for i in range(1000))
+
+
+def get_file(text=TEXT, name='file.txt'):
+    file = io.StringIO(text)
+    file.name = name
+    return file
+
+
+def test_tee_file_all_consumers_get_the_whole_file():
+    results = []
+
+    def consumer(file):
+        results.append((file.name, list(FileIterator(file))))
+
+    tee_file(get_file(), [consumer, consumer, consumer], chunk_size=100, max_pending_chunks=2)
+
+    assert len(results) == 3
+    for name, lines in results:
+        assert name == 'file.txt'
+        assert lines == TEXT.splitlines()
+
+
+def test_tee_file_consumer_stops_early():
+    results = []
+    reads = []
+
+    class CountingFile(io.StringIO):
+        def read(self, size=-1):
+            chunk = super().read(size)
+            reads.append(chunk)
+            return chunk
+
+    def first_line_consumer(file):
+        results.append(next(FileIterator(file)))
+
+    file = CountingFile(TEXT)
+    file.name = 'file.txt'
+    tee_file(file, [first_line_consumer], chunk_size=10, max_pending_chunks=1)
+
+    assert results == ['line 0']
+    # Reading stops once every consumer is done
+    assert len(reads) < 10
+
+
+def test_tee_file_slow_and_fast_consumers():
+    results = {}
+
+    def all_lines(file):
+        results['all'] = list(FileIterator(file))
+
+    def first_line(file):
+        results['first'] = next(FileIterator(file))
+
+    tee_file(get_file(), [all_lines, first_line], chunk_size=10, max_pending_chunks=1)
+
+    assert results['all'] == TEXT.splitlines()
+    assert results['first'] == 'line 0'
+
+
+def test_tee_file_raises_consumer_errors():
+    def failing_consumer(file):
+        raise ValueError('boom')
+
+    def consumer(file):
+        list(FileIterator(file))
+
+    with pytest.raises(ValueError):
+        tee_file(get_file(), [consumer, failing_consumer], chunk_size=10, max_pending_chunks=1)
+
+
+def test_tee_file_read_after_eof():
+    file = TeeFile('file.txt')
+    file.chunks.put('a\n')
+    file.chunks.put('')
+
+    assert file.read() == 'a\n'
+    assert file.read() == ''
+    assert file.read() == ''
+
+
+def get_text_file(data, encoding):
+    buffer = io.BytesIO(data)
+    buffer.name = 'file.txt'
+    return io.TextIOWrapper(buffer, encoding=encoding)
+
+
+def test_tee_file_keeps_the_encoding_and_new_lines():
+    data = 'a\r\nñandú\r\n€\r\nb\r\n'.encode('cp1252')
+
+    def get_positions(file):
+        iterator = PositionTrackingFileIterator(file, chunk_size=4)
+        positions = []
+        for _ in iterator:
+            positions.append(iterator.tell())
+        return positions
+
+    expected = get_positions(get_text_file(data, 'cp1252'))
+    results = []
+    tee_file(get_text_file(data, 'cp1252'), [lambda tee: results.append(get_positions(tee))] * 2, chunk_size=4)
+
+    assert expected == [(2, 3), (3, 10), (4, 13), (5, 16)]
+    assert results == [expected, expected]
+
+
+def test_tee_file_decode_error():
+    file = get_text_file(b'a\nb\n' * 100 + b'\xff\n', 'utf-8')
+    results = []
+
+    # The consumers get the text before the error and the end of the file
+    with pytest.raises(UnicodeDecodeError):
+        tee_file(file, [lambda tee: results.append(list(FileIterator(tee)))] * 2, chunk_size=10)
+    assert results == [['a', 'b'] * 100] * 2
@@ -0,0 +1,87 @@
+import pytest
+
+from context_cli.context import Context
+from context_cli.unique import DIGEST_SIZE, BloomFilter, DigestSet, get_context_digest
+from context_cli.util import build_regexp_if_needed
+
+
+def test_get_context_digest():
+    digest = get_context_digest(Context(lines=['a', 'b']))
+
+    assert len(digest) == DIGEST_SIZE
+    assert digest == get_context_digest(Context(lines=['a', 'b']))
+    assert digest != get_context_digest(Context(lines=['ab']))
+    assert digest != get_context_digest(Context(lines=['a', 'b', '']))
+
+
+def test_get_context_digest_ignore_regexps():
+    ignore_regexps = [build_regexp_if_needed(r'id=\d+')]
+
+    assert get_context_digest(Context(lines=['x id=1', 'y']), ignore_regexps) == \
+        get_context_digest(Context(lines=['x id=22', 'y']), ignore_regexps)
+    assert get_context_digest(Context(lines=['x id=1', 'y']), ignore_regexps) != \
+        get_context_digest(Context(lines=['z id=1', 'y']), ignore_regexps)
+
+
+def test_get_context_digest_ignore_regexps_match_each_line():
+    ignore_regexps = [build_regexp_if_needed(r'^\d+ ')]
+
+    assert get_context_digest(Context(lines=['1 a', '2 b']), ignore_regexps) == \
+        get_context_digest(Context(lines=['3 a', '4 b']), ignore_regexps)
+
+
+def test_get_context_digest_surrogates():
+    # Lines decoded with errors='surrogateescape' can contain lone surrogates
+    assert len(get_context_digest(Context(lines=['\udcff']))) == DIGEST_SIZE
+
+
+def test_digest_set():
+    digests = DigestSet()
+
+    assert digests.add(b'a')
+    assert digests.add(b'b')
+    assert not digests.add(b'a')
+    assert b'a' in digests
+    assert b'c' not in digests
+    assert len(digests.digests) == 2
+
+
+def get_digest(i):
+    return get_context_digest(Context(lines=[str(i)]))
+
+
+def test_bloom_filter_never_forgets():
+    bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+    digests = [get_digest(i) for i in range(1000)]
+
+    added = [bloom_filter.add(digest) for digest in digests]
+    assert sum(added) > 950
+    assert all(digest in bloom_filter for digest in digests)
+    assert not any(bloom_filter.add(digest) for digest in digests)
+
+
+def test_bloom_filter_error_rate():
+    bloom_filter = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        bloom_filter.add(get_digest(i))
+
+    false_positives = sum(get_digest(i) in bloom_filter for i in range(10000, 20000))
+    assert false_positives < 200
+
+
+def test_bloom_filter_size():
+    bloom_filter = BloomFilter(capacity=1000000, error_rate=0.01)
+
+    # ~9.6 bits and 7 hashes per item
+    assert 1150000 < len(bloom_filter.bits) < 1250000
+    assert bloom_filter.num_hashes == 7
+
+
+@pytest.mark.parametrize('capacity,error_rate', [
+    (0, 0.1),
+    (10, 0),
+    (10, 1),
+])
+def test_bloom_filter_invalid_arguments(capacity, error_rate):
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=capacity, error_rate=error_rate)
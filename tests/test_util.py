@@ -2,7 +2,9 @@ import re
 import pytest
 from mock import patch, mock
 
-from context_cli.util import CtxRc, build_regexp_if_needed, TypeArgDoesNotExistException
+from context_cli.util import (
+    CtxRc, build_regexp_if_needed, get_required_literal, get_required_literals, TypeArgDoesNotExistException,
+)
 
 REGEX = re.compile('aaa')
 JSON_STR = """
@@ -91,3 +93,34 @@ def test_ctxrc_save(open_mock):
     open_mock.assert_called_once_with('/some/path', 'w')
     write_fn.write.assert_called_once_with('{}')
 
+
+@pytest.mark.parametrize('regexp,expected_literals', [
+    ('ERROR\\s+\\d+', ['ERROR']),
+    ('user_id=(\\d+)', ['user_id=']),
+    ('^abc$', ['abc']),
+    ('\\bword\\b', ['word']),
+    ('a(bc)d', ['abcd']),
+    ('a(?:b){1}c', ['abc']),
+    ('x(ab)+y', ['x', 'ab', 'y']),
+    ('ab?c', ['a', 'c']),
+    ('a(?i:b)c', ['a', 'c']),
+    ('(?i)abc', []),
+    ('a|b', []),
+    ('[abc]+', []),
+    ('\\.', ['.']),
+])
+def test_get_required_literals(regexp, expected_literals):
+    assert get_required_literals(regexp) == expected_literals
+
+
+def test_get_required_literals_case_insensitive_compiled_regexp():
+    assert get_required_literals(re.compile('abc', re.IGNORECASE)) == []
+
+
+def test_get_required_literal_returns_longest():
+    assert get_required_literal('a+ [0-9] user_id=(\\d+)') == ' user_id='
+
+
+def test_get_required_literal_none():
+    assert get_required_literal('[0-9]+') is None
+
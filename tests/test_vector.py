@@ -0,0 +1,141 @@
+import io
+import random
+
+import pytest
+
+from context_cli import vector
+from context_cli.context import SingleDelimiterContextFactory, StartAndEndDelimiterContextFactory
+from context_cli.matcher import ContainsTextMatcher, MemoizedMatcher, RegexMatcher, plan_regex_matcher
+from context_cli.memo import LineMemo
+from context_cli.vector import (
+    BlockScanner, NumpySingleDelimiterContextFactory, NumpyStartAndEndDelimiterContextFactory, can_scan,
+    is_supported_matcher,
+)
+
+requires_numpy = pytest.mark.skipif(vector.np is None, reason='needs NumPy')
+
+WORDS = ['', '===', '```', 'BEGIN', 'BEGIN x', 'END', 'x END', 'ERROR 1', 'ERROR  22', 'ERROR x', 'héllo', 'a=== b',
+         'plain text']
+
+
+def open_text(data, encoding='utf-8', errors='strict'):
+    return io.TextIOWrapper(io.BufferedReader(io.BytesIO(data)), encoding=encoding, errors=errors)
+
+
+def make_text(seed, size=120):
+    rng = random.Random(seed)
+    new_lines = ['\n', '\r\n', '\r']
+    text = ''.join(rng.choice(WORDS) + rng.choice(new_lines if seed % 2 else ['\n']) for _ in range(size))
+    # Sometimes the last line doesn't end with a new line
+    return text if seed % 3 else text + rng.choice(WORDS)
+
+
+def get_lines(contexts):
+    return [context.lines for context in contexts]
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('block_size', [1, 7, 1024 * 1024])
+@pytest.mark.parametrize('pattern', [
+    '===', '^$', '^```$', '^BEGIN', '^ERROR \\d+', 'END$', 'ERROR\\s+\\d+', '^\\w+ END',
+])
+@pytest.mark.parametrize('exclude_delimiter', [True, False])
+def test_single_delimiter_same_as_python(seed, block_size, pattern, exclude_delimiter):
+    data = make_text(seed).encode('utf-8')
+    matcher = ContainsTextMatcher(pattern) if pattern == '===' else plan_regex_matcher(pattern)
+
+    expected = SingleDelimiterContextFactory(open_text(data), matcher, exclude_delimiter=exclude_delimiter)
+    actual = NumpySingleDelimiterContextFactory(
+        open_text(data), matcher, exclude_delimiter=exclude_delimiter, block_size=block_size,
+    )
+
+    assert get_lines(actual) == get_lines(expected)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('block_size', [1, 7, 1024 * 1024])
+@pytest.mark.parametrize('start,end', [
+    ('^BEGIN', '^END$'), ('^```$', '^```$'), ('===', 'END$'), ('^$', 'ERROR\\s+\\d+'),
+])
+@pytest.mark.parametrize('exclude_start,exclude_end,ignore_end', [
+    (False, False, True), (True, True, True), (False, True, False), (True, False, False),
+])
+def test_start_and_end_delimiter_same_as_python(seed, block_size, start, end, exclude_start, exclude_end, ignore_end):
+    data = make_text(seed).encode('utf-8')
+    kwargs = dict(
+        start_delimiter_matcher=plan_regex_matcher(start), end_delimiter_matcher=plan_regex_matcher(end),
+        exclude_start_delimiter=exclude_start, exclude_end_delimiter=exclude_end, ignore_end_delimiter=ignore_end,
+    )
+
+    expected = StartAndEndDelimiterContextFactory(open_text(data), **kwargs)
+    actual = NumpyStartAndEndDelimiterContextFactory(open_text(data), block_size=block_size, **kwargs)
+
+    assert get_lines(actual) == get_lines(expected)
+
+
+@pytest.mark.parametrize('encoding,errors', [('latin-1', 'strict'), ('utf-8', 'replace'), ('ascii', 'replace')])
+def test_encodings_same_as_python(encoding, errors):
+    data = 'café\n===\nnaïve\r\n===\nend'.encode('latin-1') + b'\xff\n'
+    matcher = ContainsTextMatcher('===')
+
+    expected = SingleDelimiterContextFactory(open_text(data, encoding, errors), matcher)
+    actual = NumpySingleDelimiterContextFactory(open_text(data, encoding, errors), matcher, block_size=3)
+
+    assert get_lines(actual) == get_lines(expected)
+
+
+@requires_numpy
+def test_block_scanner_long_line():
+    data = b'a\n' + b'x' * 100 + b'\r\n===\r' + b'y' * 100
+    matcher = ContainsTextMatcher('===')
+
+    blocks = list(BlockScanner(open_text(data), [matcher], block_size=7))
+
+    assert [line for lines, _ in blocks for line in lines] == ['a', 'x' * 100, '===', 'y' * 100]
+    assert get_lines(NumpySingleDelimiterContextFactory(open_text(data), matcher, block_size=7)) == [
+        ['a', 'x' * 100], ['y' * 100],
+    ]
+
+
+def test_empty_file():
+    assert get_lines(NumpySingleDelimiterContextFactory(open_text(b''), plan_regex_matcher('^$'))) == []
+
+
+@requires_numpy
+def test_can_scan():
+    matcher = plan_regex_matcher('^$')
+
+    assert can_scan(open_text(b''), [matcher])
+    assert can_scan(open_text(b'', encoding='latin-1'), [matcher])
+    assert not can_scan(open_text(b''), [matcher], track_positions=True)
+    assert not can_scan(open_text(b'', encoding='utf-16'), [matcher])
+    assert not can_scan(io.StringIO(''), [matcher])
+    assert not can_scan(open_text(b''), [matcher, plan_regex_matcher('^\\d+')])
+
+
+def test_can_scan_without_numpy(monkeypatch):
+    monkeypatch.setattr(vector, 'np', None)
+
+    assert not can_scan(open_text(b''), [plan_regex_matcher('^$')])
+    assert get_lines(NumpySingleDelimiterContextFactory(open_text(b'a\n\nb\n'), plan_regex_matcher('^$'))) == [
+        ['a'], ['b'],
+    ]
+
+
+def test_is_supported_matcher():
+    assert is_supported_matcher(plan_regex_matcher('^$'))
+    assert is_supported_matcher(plan_regex_matcher('^ERROR \\d+'))
+    assert is_supported_matcher(RegexMatcher('ERROR\\s+\\d+'))
+    assert is_supported_matcher(MemoizedMatcher(RegexMatcher('ERROR\\s+\\d+'), LineMemo(10)))
+    assert not is_supported_matcher(plan_regex_matcher('^\\d{4}'))
+    assert not is_supported_matcher(RegexMatcher('\\d+'))
+    assert not is_supported_matcher(ContainsTextMatcher('a\rb'))
+
+
+def test_nested_uses_python_engine():
+    data = b'BEGIN\na\nBEGIN\nb\nEND\nEND\n'
+    factory = NumpyStartAndEndDelimiterContextFactory(
+        open_text(data), plan_regex_matcher('^BEGIN'), plan_regex_matcher('^END'), nested=True,
+    )
+
+    assert get_lines(factory) == [['BEGIN', 'b', 'END'], ['BEGIN', 'a', 'BEGIN', 'b', 'END', 'END']]
@@ -0,0 +1,138 @@
+import os
+
+import pytest
+from mock import patch
+
+from context_cli.walk import FileWalker, PathRules, compile_ignore_pattern, get_relative_path
+
+
+def make_tree(root, paths):
+    for path in paths:
+        path = root / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('')
+
+
+def walk(root, **kwargs):
+    return [os.path.relpath(path, root) for path in FileWalker(**kwargs).walk(str(root))]
+
+
+@pytest.mark.parametrize('pattern,path,expected', [
+    ('*.log', 'app.log', True),
+    ('*.log', 'a/b/app.log', True),
+    ('*.log', 'app.log.1', False),
+    ('/app.log', 'app.log', True),
+    ('/app.log', 'a/app.log', False),
+    ('a/*.log', 'a/app.log', True),
+    ('a/*.log', 'a/b/app.log', False),
+    ('a/**/*.log', 'a/b/c/app.log', True),
+    ('a/**/*.log', 'a/app.log', True),
+    ('**/b', 'a/b', True),
+    ('**/b', 'b', True),
+    ('a/**', 'a/b/c', True),
+    ('app.lo?', 'app.log', True),
+    ('app.[lt]og', 'app.tog', True),
+    ('app.[!lt]og', 'app.log', False),
+    ('\\#name', '#name', True),
+])
+def test_compile_ignore_pattern(pattern, path, expected):
+    assert bool(compile_ignore_pattern(pattern).regexp.match(path)) == expected
+
+
+@pytest.mark.parametrize('pattern', ['', '   ', '# comment', '/'])
+def test_compile_ignore_pattern_skips_blank_lines_and_comments(pattern):
+    assert compile_ignore_pattern(pattern) is None
+
+
+def test_compile_ignore_pattern_options():
+    rule = compile_ignore_pattern('!build/ \n')
+
+    assert rule.negated
+    assert rule.directory_only
+    assert rule.regexp.match('build')
+
+
+def test_get_relative_path():
+    assert get_relative_path(os.path.join('a', 'b'), os.path.join('a', 'b', 'c', 'd')) == 'c/d'
+    assert get_relative_path(os.path.join('a', 'b'), os.path.join('a', 'bc')) is None
+
+
+def test_path_rules_last_match_wins():
+    rules = PathRules().extend('root', ['*.log', '!keep.log']).extend(os.path.join('root', 'a'), ['keep.log'])
+
+    assert rules.matches(os.path.join('root', 'app.log'))
+    assert not rules.matches(os.path.join('root', 'keep.log'))
+    assert rules.matches(os.path.join('root', 'a', 'keep.log'))
+    assert not rules.matches(os.path.join('root', 'app.txt'))
+
+
+def test_path_rules_directory_only():
+    rules = PathRules().extend('root', ['build/'])
+
+    assert rules.matches(os.path.join('root', 'build'), is_dir=True)
+    assert not rules.matches(os.path.join('root', 'build'))
+
+
+def test_file_walker(tmp_path):
+    make_tree(tmp_path, ['b.log', 'a/z.log', 'a/b/c.log', 'c/d.log', 'a.log'])
+
+    assert walk(tmp_path) == [
+        'a.log', 'b.log', os.path.join('a', 'z.log'), os.path.join('a', 'b', 'c.log'), os.path.join('c', 'd.log'),
+    ]
+
+
+def test_file_walker_includes_and_excludes(tmp_path):
+    make_tree(tmp_path, ['a.log', 'a.txt', 'b/c.log', 'node_modules/d.log', 'e/node_modules/f.log'])
+
+    assert walk(tmp_path, includes=['*.log'], excludes=['node_modules/']) == [
+        'a.log', os.path.join('b', 'c.log'),
+    ]
+    assert walk(tmp_path, excludes=['/b', '*.txt']) == [
+        'a.log', os.path.join('e', 'node_modules', 'f.log'), os.path.join('node_modules', 'd.log'),
+    ]
+
+
+def test_file_walker_ignore_files(tmp_path):
+    make_tree(tmp_path, ['a.log', 'a.tmp', 'keep.tmp', 'build/b.log', 'c/d.tmp', 'c/e.tmp'])
+    (tmp_path / '.gitignore').write_text('# build output\nbuild/\n*.tmp\n!keep.tmp\n')
+    (tmp_path / 'c' / '.ctxignore').write_text('!d.tmp\n')
+
+    assert walk(tmp_path) == ['.gitignore', 'a.log', 'keep.tmp', os.path.join('c', '.ctxignore'),
+                              os.path.join('c', 'd.tmp')]
+    assert len(walk(tmp_path, ignore_file_names=())) == 8
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='needs symbolic links')
+def test_file_walker_does_not_follow_symlinks(tmp_path):
+    make_tree(tmp_path, ['a/b.log'])
+    os.symlink(tmp_path / 'a', tmp_path / 'link')
+    os.symlink(tmp_path / 'a' / 'b.log', tmp_path / 'link.log')
+
+    assert walk(tmp_path) == [os.path.join('a', 'b.log')]
+
+
+def test_file_walker_stops_early(tmp_path):
+    make_tree(tmp_path, ['a.log', 'b/c.log', 'b/d/e.log'])
+
+    paths = FileWalker(workers=1).walk(str(tmp_path))
+    assert next(paths) == str(tmp_path / 'a.log')
+    paths.close()
+
+
+def test_file_walker_reports_unreadable_directories(tmp_path, caplog):
+    make_tree(tmp_path, ['a.log', 'b/c.log', 'd/e.log'])
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if path == str(tmp_path / 'b'):
+            raise PermissionError(13, 'Permission denied')
+        return scandir(path)
+
+    errors = []
+    with patch('os.scandir', side_effect=failing_scandir):
+        paths = list(FileWalker(workers=1).walk(str(tmp_path), on_error=errors.append))
+
+    # The rest of the tree is still walked
+    assert paths == [str(tmp_path / 'a.log'), str(tmp_path / 'd' / 'e.log')]
+    assert errors == [str(tmp_path / 'b')]
+    assert 'Cannot read directory' in caplog.text
@@ -0,0 +1,108 @@
+import random
+import pytest
+
+from context_cli.context import Context
+from context_cli.filter import ContainsTextContextFilter, ContainsTextLineFilter, NotEmptyContextFilter
+from context_cli.window import ContextWindow
+
+
+def get_contexts(names):
+    return [Context(lines=[name] if name else []) for name in names]
+
+
+def get_windowed_lines(contexts, text, before, after):
+    window = ContextWindow(iter(contexts), before=before, after=after)
+    pipeline = NotEmptyContextFilter(ContainsTextContextFilter(window, text))
+    return [context.lines for context in window.filter(pipeline)]
+
+
+def get_expected_lines(contexts, text, before, after):
+    # Empty contexts are never written so they don't count
+    contexts = [context for context in contexts if context.lines]
+    matches = [i for i, context in enumerate(contexts) if any(text in line for line in context.lines)]
+    written = set()
+    for i in matches:
+        written.update(range(max(0, i - before), i + after + 1))
+    return [contexts[i].lines for i in sorted(written) if i < len(contexts)]
+
+
+def test_context_window_before():
+    contexts = get_contexts(['a', 'b', 'c', 'x', 'd', 'e'])
+
+    assert get_windowed_lines(contexts, 'x', before=2, after=0) == [['b'], ['c'], ['x']]
+
+
+def test_context_window_after():
+    contexts = get_contexts(['a', 'x', 'b', 'c', 'd'])
+
+    assert get_windowed_lines(contexts, 'x', before=0, after=2) == [['x'], ['b'], ['c']]
+
+
+def test_context_window_overlapping_windows_are_merged():
+    contexts = get_contexts(['a', 'x1', 'b', 'x2', 'c', 'd', 'e', 'x3', 'f'])
+
+    assert get_windowed_lines(contexts, 'x', before=1, after=1) == [
+        ['a'], ['x1'], ['b'], ['x2'], ['c'], ['e'], ['x3'], ['f'],
+    ]
+
+
+def test_context_window_at_the_end():
+    contexts = get_contexts(['a', 'b', 'x'])
+
+    assert get_windowed_lines(contexts, 'x', before=5, after=5) == [['a'], ['b'], ['x']]
+
+
+def test_context_window_skips_empty_contexts():
+    contexts = get_contexts(['a', '', 'b', 'x', '', 'c'])
+
+    assert get_windowed_lines(contexts, 'x', before=2, after=1) == [['a'], ['b'], ['x'], ['c']]
+
+
+def test_context_window_writes_neighbors_unfiltered():
+    contexts = [Context(lines=['a1', 'a2']), Context(lines=['x1', 'x2']), Context(lines=['b1', 'b2'])]
+    window = ContextWindow(iter(contexts), before=1, after=1)
+    pipeline = NotEmptyContextFilter(ContainsTextLineFilter(window, 'x1'))
+
+    assert [context.lines for context in window.filter(pipeline)] == [['a1', 'a2'], ['x1'], ['b1', 'b2']]
+
+
+@pytest.mark.parametrize('limit,expected', [
+    (0, []),
+    (1, [['a'], ['x1'], ['b']]),
+    (2, [['a'], ['x1'], ['b'], ['x2'], ['c']]),
+    (3, [['a'], ['x1'], ['b'], ['x2'], ['c'], ['e'], ['x3']]),
+])
+def test_context_window_limit(limit, expected):
+    contexts = get_contexts(['a', 'x1', 'b', 'x2', '', 'c', 'd', 'e', 'x3'])
+    window = ContextWindow(iter(contexts), before=1, after=1)
+    pipeline = NotEmptyContextFilter(ContainsTextContextFilter(window, 'x'))
+
+    # Only the matches count, the contexts after the last one are still written
+    assert [context.lines for context in window.filter(pipeline, limit=limit)] == expected
+    assert window.matches == min(limit, 3)
+
+
+def test_context_window_keeps_at_most_before_contexts():
+    sizes = []
+
+    def generate_contexts():
+        for context in get_contexts(['a'] * 1000 + ['x']):
+            yield context
+            sizes.append(len(window.before_contexts))
+
+    window = ContextWindow(generate_contexts(), before=3)
+    pipeline = ContainsTextContextFilter(window, 'x')
+
+    assert [context.lines for context in window.filter(pipeline)] == [['a'], ['a'], ['a'], ['x']]
+    assert max(sizes) == 3
+
+
+@pytest.mark.parametrize('before', [0, 1, 3])
+@pytest.mark.parametrize('after', [0, 1, 4])
+@pytest.mark.parametrize('seed', range(5))
+def test_context_window_fuzz(before, after, seed):
+    rng = random.Random(seed)
+    names = [rng.choice(['a', 'b', '', 'x']) for _ in range(200)]
+    contexts = get_contexts(names)
+
+    assert get_windowed_lines(contexts, 'x', before, after) == get_expected_lines(contexts, 'x', before, after)